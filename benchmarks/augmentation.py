@@ -0,0 +1,70 @@
+""" Cost of data augmentation in lab2/mlpBonus cyclic learning: the per batch time of the former inline
+jitter (noise, re-standardization and per-sample np.fliplr) against the vectorized Augmenter, and the
+training time without augmentation and with the Augmenter running on the prefetch thread.
+
+    python benchmarks/augmentation.py [--shift 2] [--flip 0.5] [--noise 0.5]
+"""
+import argparse
+
+import numpy as np
+
+import common
+
+
+def inline_jitter(X, flip=0, sigma=1):
+    """ The former MLP.random_jitter """
+    X_jitter = np.copy(X)
+    X_jitter += np.random.normal(0, sigma, (X.shape))
+    mean, std = np.mean(X_jitter, axis=1), np.std(X_jitter, axis=1)
+    X_jitter -= np.outer(mean, np.ones(X_jitter.shape[1]))
+    X_jitter /= np.outer(std, np.ones(X.shape[1]))
+    d, n_batch = X.shape
+    if flip > 0.5:
+        X_jitter = X_jitter.reshape(n_batch, 3, 32, 32).transpose(0, 2, 3, 1)
+        X_jitter = np.array([np.fliplr(X_jitter[i]) for i in range(n_batch)])
+        X_jitter = X_jitter.reshape((d, n_batch))
+    return X_jitter
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n_train", type=int, default=10000)
+    parser.add_argument("--flip", type=float, default=0.5)
+    parser.add_argument("--shift", type=int, default=2)
+    parser.add_argument("--noise", type=float, default=0.5)
+    parser.add_argument("--ns", type=int, default=200)
+    parser.add_argument("--synthetic", action="store_true")
+    args = parser.parse_args()
+
+    common.use_lab("lab2")
+    import mlpBonus
+    from utils import Augmenter
+    data = common.load_data(args.n_train, synthetic=args.synthetic)
+    augmenter = Augmenter(flip=args.flip, shift=args.shift, noise=args.noise)
+    X_batch = np.ascontiguousarray(data["X_train"][:, :100])
+    out = np.empty_like(X_batch)
+    rng = np.random.default_rng(0)
+
+    n = 200
+    with common.Timer() as inline:
+        for _ in range(n):
+            inline_jitter(X_batch, flip=1)
+    with common.Timer() as vectorized:
+        for _ in range(n):
+            augmenter(X_batch, out, rng)
+    print(f'{"per batch of 100":<28} {"time (ms)":>10}')
+    print(f'{"inline jitter + flip":<28} {1000 * inline.elapsed / n:>10.3f}')
+    print(f'{"Augmenter":<28} {1000 * vectorized.elapsed / n:>10.3f}')
+
+    GDparams = {"n_cycles": 1, "n_batch": 100, "eta_min": 1e-5, "eta_max": 1e-1, "ns": args.ns, "freq": 2,
+                "exp": "benchmark_augmentation"}
+    print(f'{"cyclic learning":<28} {"time (s)":>10} {"val_acc":>8}')
+    for name, jitter in [("plain", False), ("Augmenter on prefetch", augmenter)]:
+        net = mlpBonus.MLP(lamda=0.001)
+        with common.Timer() as timer:
+            net.cyclic_learning(data, GDparams, verbose=False, jitter=jitter)
+        print(f'{name:<28} {timer.elapsed:>10.2f} {net.val_acc[-1]:>8.4f}')
+
+
+if __name__ == "__main__":
+    main()
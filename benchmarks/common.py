@@ -0,0 +1,64 @@
+""" Shared helpers of the benchmark scripts """
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def use_lab(lab):
+    """ Makes the modules of a lab importable and resolves its relative dataset paths """
+    lab_dir = os.path.join(ROOT, lab)
+    sys.path.insert(0, lab_dir)
+    os.chdir(lab_dir)
+    os.makedirs("History", exist_ok=True)
+
+
+def synthetic_cifar(n, seed=0, d=3072, K=10):
+    """ Learnable stand-in for cifar when the dataset is not available: noisy class prototypes """
+    rng = np.random.default_rng(seed)
+    prototypes = np.random.default_rng(1234).uniform(0, 1, (K, d)).astype(np.float32)
+    y = rng.integers(0, K, n)
+    X = 0.5 + 0.04 * (prototypes[y] - 0.5) + rng.normal(0, 0.25, (n, d)).astype(np.float32)
+    return np.clip(X, 0, 1).T, y
+
+
+def load_data(n_train=10000, n_val=1000, synthetic=False):
+    """ Standardized train/val/test splits from the cifar cache of the current lab
+    (data_batch_1 for training, data_batch_2 for validation and testing) """
+    import utils
+    try:
+        if synthetic:
+            raise FileNotFoundError
+        X, y, _ = utils.loadCachedData('data_batch_1')
+        X_val, y_val, _ = utils.loadCachedData('data_batch_2')
+        X, y = np.array(X[:, :n_train]), y[:n_train]
+        X_val, y_val = np.array(X_val[:, :2*n_val]), y_val[:2*n_val]
+    except FileNotFoundError:
+        print("cifar-10 not found, using synthetic data")
+        X, y = synthetic_cifar(n_train, seed=0)
+        X_val, y_val = synthetic_cifar(2*n_val, seed=1)
+
+    mean, std = np.mean(X, axis=1, keepdims=True), np.std(X, axis=1, keepdims=True)
+    X = (X - mean) / std
+    X_val = (X_val - mean) / std
+
+    def split(X, y):
+        return X, y, utils.one_hot(y).T
+
+    data = {}
+    for name, (X_s, y_s) in {"train": (X, y), "val": (X_val[:, :n_val], y_val[:n_val]),
+                             "test": (X_val[:, n_val:], y_val[n_val:])}.items():
+        data[f"X_{name}"], data[f"y_{name}"], data[f"Y_{name}"] = split(X_s, y_s)
+    return data
+
+
+class Timer():
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.perf_counter() - self.start
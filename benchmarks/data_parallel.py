@@ -0,0 +1,74 @@
+""" Steps per second of data parallel training of the lab3 MLP for 1 to --max_workers worker processes,
+against the single process training loop, and the largest parameter difference between the two.
+
+    python benchmarks/data_parallel.py [--max_workers 4] [--n_batch 400] [--no_bn]
+"""
+import argparse
+import os
+
+import numpy as np
+
+import common
+
+
+def train(net, loader, n_steps, eta=1e-2):
+    """ Runs n_steps of minibatch gradient descent, loader being a BatchLoader or a DataParallel """
+    step = 0
+    while step < n_steps:
+        for batch in loader.epoch(seed=step):
+            if hasattr(loader, "train_step"):
+                loader.train_step(batch, init=(step == 0))
+            else:
+                X_batch, _, y_batch = batch
+                P_batch = net.forward_pass(X_batch, train_mode=True, init=(step == 0))
+                net.compute_gradients(X_batch, y_batch, P_batch)
+            net.update_parameters(eta)
+            step += 1
+            if step == n_steps:
+                break
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dims", type=int, nargs="+", default=[3072, 50, 50, 10])
+    parser.add_argument("--n_batch", type=int, default=400)
+    parser.add_argument("--n_steps", type=int, default=50)
+    parser.add_argument("--max_workers", type=int, default=os.cpu_count())
+    parser.add_argument("--no_bn", action="store_true")
+    args = parser.parse_args()
+
+    common.use_lab("lab3")
+    import mlp
+    from parallel import DataParallel
+    from utils import BatchLoader
+    data = common.load_data(10 * args.n_batch, 1, synthetic=True)
+    X, y = data["X_train"], data["y_train"]
+
+    def make_net():
+        return mlp.MLP(k=len(args.dims) - 1, dims=args.dims, lamda=0.005, batch_norm=not args.no_bn)
+
+    reference = make_net()
+    loader = BatchLoader(X, None, y, args.n_batch)
+    with common.Timer() as timer:
+        train(reference, loader, args.n_steps)
+    loader.close()
+    base = args.n_steps / timer.elapsed
+    print(f"{os.cpu_count()} cpus")
+    print(f'{"workers":<8} {"steps/s":>9} {"speedup":>8} {"efficiency":>11} {"max |diff|":>11}')
+    print(f'{"single":<8} {base:>9.1f} {1:>8.2f} {1:>11.2f} {0:>11.1e}')
+
+    for n_workers in range(1, args.max_workers + 1):
+        net = make_net()
+        # the workers are started before the timer
+        with DataParallel(net, X, y, args.n_batch, n_workers) as loader:
+            with common.Timer() as timer:
+                train(net, loader, args.n_steps)
+        diff = max(np.max(np.abs(getattr(layer, p) - getattr(ref, p)))
+                   for layer, ref in zip(net.layers, reference.layers) for p in layer.params)
+        speedup = args.n_steps / timer.elapsed / base
+        print(f'{n_workers:<8} {args.n_steps / timer.elapsed:>9.1f} {speedup:>8.2f} '
+              f'{speedup / n_workers:>11.2f} {diff:>11.1e}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+""" Throughput and final accuracy of the MLP for each compute precision.
+
+    python benchmarks/dtype_policy.py [--lab lab3] [--n_train 10000] [--n_cycles 1]
+"""
+import argparse
+
+import numpy as np
+
+import common
+
+POLICIES = [("float64", np.float64, False), ("float32", np.float32, False),
+            ("float32 + master", np.float32, True)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lab", default="lab3", choices=["lab2", "lab3"])
+    parser.add_argument("--n_train", type=int, default=10000)
+    parser.add_argument("--n_cycles", type=int, default=1)
+    parser.add_argument("--synthetic", action="store_true")
+    args = parser.parse_args()
+
+    common.use_lab(args.lab)
+    import mlp
+    data = common.load_data(args.n_train, synthetic=args.synthetic)
+    GDparams = {"n_cycles": args.n_cycles, "n_batch": 100, "eta_min": 1e-5, "eta_max": 1e-1,
+                "ns": 2 * args.n_train // 100, "freq": 1, "exp": "bench_dtype"}
+    n_steps = 2 * GDparams["ns"] * args.n_cycles
+
+    print(f'{"policy":<18} {"steps/s":>9} {"val_acc":>8} {"test_acc":>9}')
+    for name, dtype, master in POLICIES:
+        if args.lab == "lab3":
+            net = mlp.MLP(k=3, dims=[3072, 50, 50, 10], lamda=0.005, batch_norm=True,
+                          dtype=dtype, master_weights=master)
+        else:
+            net = mlp.MLP(lamda=0.005, dtype=dtype, master_weights=master)
+        with common.Timer() as timer:
+            net.cyclic_learning(data, GDparams, verbose=False)
+        # with freq=1 the timing includes a single history evaluation, made at step 0
+        val_acc = net.compute_accuracy(data["X_val"], data["y_val"])
+        test_acc = net.compute_accuracy(data["X_test"], data["y_test"])
+        print(f'{name:<18} {n_steps / timer.elapsed:>9.1f} {val_acc:>8.4f} {test_acc:>9.4f}')
+
+
+if __name__ == "__main__":
+    main()
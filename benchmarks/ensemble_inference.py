@@ -0,0 +1,56 @@
+""" Snapshot ensemble inference of lab2/mlpBonus: the members reloaded from disk, one forward pass each and
+a Counter vote per column, against the in-memory Ensemble with batched forward passes and bincount voting.
+
+    python benchmarks/ensemble_inference.py [--n_members 5] [--n_test 10000]
+"""
+import argparse
+from collections import Counter
+
+import numpy as np
+
+import common
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n_train", type=int, default=2000)
+    parser.add_argument("--n_test", type=int, default=10000)
+    parser.add_argument("--n_members", type=int, default=5)
+    parser.add_argument("--ns", type=int, default=20)
+    parser.add_argument("--synthetic", action="store_true")
+    args = parser.parse_args()
+
+    common.use_lab("lab2")
+    import mlpBonus
+    data = common.load_data(args.n_train, n_val=args.n_test, synthetic=args.synthetic)
+    X, y = data["X_val"], data["y_val"]
+    GDparams = {"n_cycles": args.n_members, "n_batch": 100, "eta_min": 1e-5, "eta_max": 1e-1, "ns": args.ns,
+                "freq": 2, "exp": "ensemble_learning"}
+    ensemble = mlpBonus.Ensemble()
+    mlpBonus.MLP(lamda=0.01).cyclic_learning(data, GDparams, verbose=False, ensemble=ensemble)
+    for c in range(args.n_members):
+        # the same members on disk, for the reload path
+        net = mlpBonus.MLP(lamda=0.01)
+        net.layers = [mlpBonus.Layer(W.shape[2], W.shape[1], W[c], b[c], None, None, None)
+                      for W, b in zip(ensemble.W, ensemble.b)]
+        net.backup_cyclic(GDparams, cycle=c)
+
+    with common.Timer() as reload:
+        predictions = np.array([np.argmax(mlpBonus.MLP.load_mlp(GDparams, cycle=c, lamda=0.01).forward_pass(X), axis=0)
+                                for c in range(args.n_members)])
+        classes = np.array([Counter(predictions[:, i]).most_common(1)[0][0] for i in range(X.shape[1])])
+    with common.Timer() as hard:
+        hard_classes = ensemble.predict(X)
+    with common.Timer() as soft:
+        soft_classes = ensemble.predict(X, soft=True)
+    assert np.array_equal(classes, hard_classes)
+
+    print(f"{args.n_members} members, {X.shape[1]} samples")
+    print(f'{"inference":<24} {"time (s)":>9} {"speedup":>8} {"acc":>7}')
+    for name, timer, pred in [("reload + Counter", reload, classes), ("in memory, hard vote", hard, hard_classes),
+                              ("in memory, soft vote", soft, soft_classes)]:
+        print(f'{name:<24} {timer.elapsed:>9.3f} {reload.elapsed / timer.elapsed:>8.2f} {np.mean(pred == y):>7.4f}')
+
+
+if __name__ == "__main__":
+    main()
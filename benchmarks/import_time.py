@@ -0,0 +1,62 @@
+""" Cold-start import latency of the lab modules.
+
+Every measurement runs in a fresh interpreter started from the lab directory,
+so it includes everything a forked worker or headless job pays at import time.
+
+    python benchmarks/import_time.py [--repeat 5]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = [("lab1", "utils"), ("lab1", "bonus"), ("lab2", "utils"), ("lab2", "mlp"),
+           ("lab2", "mlpBonus"), ("lab3", "utils"), ("lab3", "mlp")]
+
+HEAVY = ["keras", "tensorflow", "sklearn", "matplotlib", "tqdm"]
+
+PROBE = """
+import sys, time
+t = time.perf_counter()
+import {module}
+t = time.perf_counter() - t
+print(t, ",".join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+
+def import_time(lab, module):
+    """ Imports a module in a fresh interpreter, returns the latency and the heavy modules it pulled in """
+    out = subprocess.run([sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY)],
+                         cwd=os.path.join(ROOT, lab), capture_output=True, text=True)
+    if out.returncode != 0:
+        return None, out.stderr.strip().splitlines()[-1]
+    t, loaded = out.stdout.split(" ", 1) if " " in out.stdout else (out.stdout, "")
+    return float(t), loaded.strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f'{"module":<16} {"median (ms)":>12} {"min (ms)":>10}  heavy deps loaded')
+    for lab, module in MODULES:
+        times, loaded = [], ""
+        for _ in range(args.repeat):
+            t, loaded = import_time(lab, module)
+            if t is None:
+                break
+            times.append(t * 1000)
+        name = f'{lab}/{module}'
+        if not times:
+            print(f'{name:<16} {"failed":>12} {"":>10}  {loaded}')
+        else:
+            print(f'{name:<16} {np.median(times):>12.1f} {np.min(times):>10.1f}  {loaded or "-"}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+""" Time of the lab1 numerical gradient checks: per-entry loops against the batched engine.
+
+    python benchmarks/lab1_gradient_check.py [--n 100] [--d 3072] [--h 1e-6]
+"""
+import argparse
+
+import numpy as np
+
+import common
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n", type=int, default=100)
+    parser.add_argument("--d", type=int, default=3072)
+    parser.add_argument("--h", type=float, default=1e-6)
+    parser.add_argument("--lamda", type=float, default=0.1)
+    parser.add_argument("--skip_loops", action="store_true",
+                        help="only time the batched engine")
+    args = parser.parse_args()
+
+    common.use_lab("lab1")
+    from functions import (ComputeGradsNum, ComputeGradsNumSlow, ComputeGradsNumBatched,
+                           ComputeGradients, EvaluateClassifier, compare_gradients)
+
+    X, y = common.synthetic_cifar(args.n)
+    X = X[:args.d].astype(np.float64)
+    rng = np.random.default_rng(0)
+    W, b = rng.normal(0, 0.01, (10, X.shape[0])), rng.normal(0, 0.01, (10, 1))
+    P = EvaluateClassifier(X, W, b)
+    grad_W, grad_b = ComputeGradients(X, y, P.copy(), W, args.lamda)
+
+    methods = [("batched central", lambda: ComputeGradsNumBatched(X, y, W, b, args.lamda, args.h)),
+               ("batched forward", lambda: ComputeGradsNumBatched(
+                   X, y, W, b, args.lamda, args.h, centered=False))]
+    if not args.skip_loops:
+        methods += [("ComputeGradsNum", lambda: ComputeGradsNum(X, y, P, W, b, args.lamda, args.h)),
+                    ("ComputeGradsNumSlow", lambda: ComputeGradsNumSlow(X, y, W, b, args.lamda, args.h))]
+
+    print(f'{"method":<20} {"time (s)":>9} {"max rel err W":>14} {"max rel err b":>14}')
+    for name, fn in methods:
+        with common.Timer() as timer:
+            gn_W, gn_b = fn()
+        err_W = np.max(compare_gradients(grad_W, gn_W, 1e-10))
+        err_b = np.max(compare_gradients(grad_b, gn_b.ravel(), 1e-10))
+        print(f'{name:<20} {timer.elapsed:>9.3f} {err_W:>14.2e} {err_b:>14.2e}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+""" Wall clock time for the lab1 linear classifier to reach a target validation accuracy, with the serial
+minibatch loop and with Hogwild training on 1 to --max_workers processes, for both losses.
+
+    python benchmarks/lab1_hogwild.py [--target 0.35] [--max_workers 4] [--loss hinge]
+"""
+import argparse
+import os
+
+import numpy as np
+
+import common
+
+
+def serial(bonus, data, GDparams, W, b, loss, target):
+    """ Serial minibatch loop of bonus.minibatchGD with reordering, stopped at the target accuracy """
+    X, y = data["X_train"], data["y_train"]
+    train_loss, val_loss, train_acc, val_acc = [], [], [], []
+    _, n = X.shape
+    batch_size, eta, _lambda = GDparams["n_batch"], GDparams["eta"], GDparams["lambda"]
+    for epoch in range(GDparams["n_epochs"]):
+        perm = np.random.RandomState(epoch).permutation(n)
+        for j in range(n//batch_size):
+            cols = perm[j*batch_size:(j+1)*batch_size]
+            grad_W, grad_b = bonus.batch_gradients(X[:, cols], y[cols], W, b, _lambda, loss)
+            W -= eta * grad_W
+            b -= eta * grad_b.reshape(len(b), 1)
+        # same evaluation as the history of the Hogwild snapshots
+        bonus.history(X, None, y, data["X_val"], None, data["y_val"], epoch, W, b, _lambda,
+                      train_loss, val_loss, train_acc, val_acc, verbose=False)
+        if val_acc[-1] >= target:
+            break
+    return epoch + 1, val_acc[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n_train", type=int, default=10000)
+    parser.add_argument("--n_batch", type=int, default=100)
+    parser.add_argument("--eta", type=float, default=0.001)
+    parser.add_argument("--target", type=float, default=0.35)
+    parser.add_argument("--max_epochs", type=int, default=40)
+    parser.add_argument("--max_workers", type=int, default=os.cpu_count())
+    parser.add_argument("--loss", default="cross_entropy", choices=["cross_entropy", "hinge"])
+    parser.add_argument("--synthetic", action="store_true")
+    args = parser.parse_args()
+
+    common.use_lab("lab1")
+    import bonus
+    data = common.load_data(args.n_train, synthetic=args.synthetic)
+    GDparams = {"n_epochs": args.max_epochs, "n_batch": args.n_batch, "eta": args.eta, "lambda": 0.01}
+
+    def init():
+        rng = np.random.RandomState(42)
+        return rng.normal(0, 0.01, (10, data["X_train"].shape[0])), rng.normal(0, 0.01, (10, 1))
+
+    print(f"{os.cpu_count()} cpus, {args.loss} loss")
+    print(f'{"mode":<10} {"epochs":>7} {"time (s)":>9} {"speedup":>8} {"val_acc":>8}')
+    W, b = init()
+    with common.Timer() as timer:
+        epochs, val_acc = serial(bonus, data, GDparams, W, b, args.loss, args.target)
+    base = timer.elapsed
+    print(f'{"serial":<10} {epochs:>7} {base:>9.2f} {1:>8.2f} {val_acc:>8.4f}')
+
+    for n_workers in range(1, args.max_workers + 1):
+        W, b = init()
+        with common.Timer() as timer:
+            _, _, _, _, _, val_accs = bonus.hogwildGD(
+                data["X_train"], data["Y_train"], data["y_train"], data["X_val"], data["Y_val"], data["y_val"],
+                GDparams, W, b, n_workers=n_workers, verbose=False, loss=args.loss, target_acc=args.target,
+                experiment="benchmark_hogwild")
+        print(f'{"hogwild " + str(n_workers):<10} {len(val_accs) - 1:>7} {timer.elapsed:>9.2f} '
+              f'{base / timer.elapsed:>8.2f} {val_accs[-1]:>8.4f}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+""" Time of the sampled and directional gradient checks of a deep BN network, against the
+estimated time of the exhaustive compute_gradients_num.
+
+    python benchmarks/lab3_gradient_check.py [--n_samples 20] [--n_directions 10] [--n_workers 4]
+"""
+import argparse
+
+import numpy as np
+
+import common
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dims", type=int, nargs="+", default=[3072, 50, 50, 10])
+    parser.add_argument("--n_batch", type=int, default=20)
+    parser.add_argument("--n_samples", type=int, default=20)
+    parser.add_argument("--n_directions", type=int, default=10)
+    parser.add_argument("--n_workers", type=int, default=None)
+    args = parser.parse_args()
+
+    common.use_lab("lab3")
+    import mlp
+    data = common.load_data(args.n_batch, 1, synthetic=True)
+    X, Y = data["X_train"][:args.dims[0]].astype(np.float64), data["Y_train"]
+    net = mlp.MLP(k=len(args.dims) - 1, dims=args.dims, lamda=0.005, batch_norm=True)
+    net.forward_pass(X, init=True)
+
+    n_params = sum(getattr(layer, p).size for layer in net.layers for p in layer.params)
+    with common.Timer() as timer:
+        for _ in range(10):
+            net.compute_cost(X, Y)
+    print(f"compute_gradients_num: ~{2 * n_params * timer.elapsed / 10:.0f} s estimated "
+          f"({2 * n_params} cost evaluations)")
+
+    with common.Timer() as timer:
+        errors = net.check_gradients(X, Y, args.n_samples, args.n_directions, seed=0, n_workers=args.n_workers)
+    print(f"check_gradients: {timer.elapsed:.2f} s")
+    for key, rerr in errors.items():
+        print(f"  {key:<10} max rel err {np.max(rerr):.2e}")
+
+
+if __name__ == "__main__":
+    main()
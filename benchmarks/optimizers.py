@@ -0,0 +1,58 @@
+""" Time and epochs for the MLP to reach a target validation accuracy with each optimizer.
+
+    python benchmarks/optimizers.py [--lab lab3] [--target 0.45] [--max_epochs 20]
+"""
+import argparse
+
+import common
+
+# optimizer, its arguments and the learning rate it is trained with
+SETUPS = [("SGD", {}, 0.05), ("Momentum", {"momentum": 0.9}, 0.005),
+          ("Nesterov", {"momentum": 0.9, "nesterov": True}, 0.005), ("Adam", {}, 0.001)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lab", default="lab3", choices=["lab2", "lab3"])
+    parser.add_argument("--n_train", type=int, default=10000)
+    parser.add_argument("--n_batch", type=int, default=100)
+    parser.add_argument("--target", type=float, default=0.45)
+    parser.add_argument("--max_epochs", type=int, default=20)
+    parser.add_argument("--synthetic", action="store_true")
+    args = parser.parse_args()
+
+    common.use_lab(args.lab)
+    import mlp
+    import optimizers
+    from utils import BatchLoader
+    data = common.load_data(args.n_train, synthetic=args.synthetic)
+    loader = BatchLoader(data["X_train"], None, data["y_train"], args.n_batch)
+
+    print(f'{"optimizer":<10} {"eta":>7} {"epochs":>7} {"train time (s)":>15} {"val_acc":>8}')
+    for name, kwargs, eta in SETUPS:
+        optimizer = optimizers.OPTIMIZERS["Momentum" if name == "Nesterov" else name](**kwargs)
+        if args.lab == "lab3":
+            net = mlp.MLP(k=3, dims=[3072, 50, 50, 10], lamda=0.005, batch_norm=True, optimizer=optimizer)
+        else:
+            net = mlp.MLP(lamda=0.005, optimizer=optimizer)
+
+        elapsed, val_acc, epoch = 0., 0., 0
+        while val_acc < args.target and epoch < args.max_epochs:
+            with common.Timer() as timer:
+                for j, (X_batch, _, y_batch) in enumerate(loader.epoch(seed=epoch)):
+                    if args.lab == "lab3":
+                        P_batch = net.forward_pass(X_batch, train_mode=True, init=(epoch == 0 and j == 0))
+                    else:
+                        P_batch = net.forward_pass(X_batch)
+                    net.compute_gradients(X_batch, y_batch, P_batch)
+                    net.update_parameters(eta)
+            elapsed += timer.elapsed
+            epoch += 1
+            val_acc = net.compute_accuracy(data["X_val"], data["y_val"])
+        reached = f"{epoch:>7}" if val_acc >= args.target else f'{">" + str(epoch):>7}'
+        print(f'{name:<10} {eta:>7} {reached} {elapsed:>15.2f} {val_acc:>8.4f}')
+    loader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+""" Aggregate training throughput (updates per second over all the models) of P lab2 MLPs with different
+lambdas: trained one after the other, by random_search on a process pool, and as a single Population.
+
+    python benchmarks/population_training.py [--population 8] [--n_workers 4]
+"""
+import argparse
+import os
+
+import numpy as np
+
+import common
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n_train", type=int, default=5000)
+    parser.add_argument("--population", type=int, default=8)
+    parser.add_argument("--n_cycles", type=int, default=1)
+    parser.add_argument("--ns", type=int, default=100)
+    parser.add_argument("--n_workers", type=int, default=os.cpu_count())
+    parser.add_argument("--synthetic", action="store_true")
+    args = parser.parse_args()
+
+    common.use_lab("lab2")
+    import mlp
+    data = common.load_data(args.n_train, synthetic=args.synthetic)
+    GDparams = {"n_cycles": args.n_cycles, "n_batch": 100, "eta_min": 1e-5, "eta_max": 1e-1, "ns": args.ns,
+                "freq": 5, "exp": "benchmark_population"}
+    lamdas = list(np.logspace(-5, -1, args.population))
+    updates = args.population * 2 * args.ns * args.n_cycles
+
+    with common.Timer() as loop:
+        accs = []
+        for lamda in lamdas:
+            net = mlp.MLP(lamda=lamda)
+            net.cyclic_learning(data, GDparams, verbose=False)
+            accs.append(net.val_acc[-1])
+    search = mlp.Search(store=None)
+    with common.Timer() as pool:
+        search.random_search(data, GDparams, lamdas=lamdas, n_workers=args.n_workers, verbose=False)
+    with common.Timer() as batched:
+        population = mlp.Population(lamdas)
+        population.cyclic_learning(data, GDparams, verbose=False)
+    assert np.allclose(accs, population.val_acc[-1])
+
+    print(f"{args.population} models, {os.cpu_count()} cpus")
+    print(f'{"training":<22} {"time (s)":>9} {"updates/s":>10} {"speedup":>8}')
+    for name, timer in [("loop", loop), (f"process pool ({args.n_workers})", pool), ("population", batched)]:
+        print(f'{name:<22} {timer.elapsed:>9.2f} {updates / timer.elapsed:>10.1f} {loop.elapsed / timer.elapsed:>8.2f}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+""" Load generator of the lab3 prediction server: concurrent clients on keep-alive connections send single
+images and the client side p50/p99 latency and throughput are reported with the server side statistics.
+Without --url, a server is started on a checkpoint (a freshly initialized BN network by default) for every
+--max_batch value, 1 meaning no micro batching. With --in_process the clients call the MicroBatcher directly,
+which measures the batching without the cost of the HTTP stack.
+
+    python benchmarks/serve_load.py [--concurrency 32] [--requests 4000] [--max_batch 1,16,64] [--in_process]
+    python benchmarks/serve_load.py --url http://127.0.0.1:8000
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+import numpy as np
+
+import common
+
+
+def request(conn, method, path, body=None, headers={}):
+    conn.request(method, path, body, headers)
+    response = conn.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def client(host, port, images, latencies, errors):
+    """ Sends the images one request at a time on a single connection """
+    conn = http.client.HTTPConnection(host, port)
+    headers = {"Content-Type": "application/octet-stream"}
+    for x in images:
+        start = time.perf_counter()
+        status, _ = request(conn, "POST", "/predict", x.tobytes(), headers)
+        latencies.append(time.perf_counter() - start)
+        if status != 200:
+            errors.append(status)
+    conn.close()
+
+
+def run_load(host, port, X, concurrency):
+    """ Sends the columns of X from concurrency clients, returning the client and server statistics """
+    conn = http.client.HTTPConnection(host, port)
+    request(conn, "DELETE", "/stats")
+    latencies, errors = [], []
+    threads = [threading.Thread(target=client, args=(host, port, X.T[i::concurrency], latencies, errors))
+               for i in range(concurrency)]
+    with common.Timer() as timer:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    _, server = request(conn, "GET", "/stats")
+    conn.close()
+    latencies = 1000 * np.array(latencies)
+    return {"p50_ms": np.percentile(latencies, 50), "p99_ms": np.percentile(latencies, 99),
+            "throughput": len(latencies) / timer.elapsed, "errors": len(errors)}, server
+
+
+def run_in_process(batcher, X, concurrency):
+    """ Same load as run_load, the clients calling batcher.predict """
+    latencies = []
+
+    def client(images):
+        for x in images:
+            start = time.perf_counter()
+            batcher.predict(x)
+            latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client, args=(X.T[i::concurrency],)) for i in range(concurrency)]
+    with common.Timer() as timer:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    latencies = 1000 * np.array(latencies)
+    return {"p50_ms": np.percentile(latencies, 50), "p99_ms": np.percentile(latencies, 99),
+            "throughput": len(latencies) / timer.elapsed, "errors": 0}, batcher.stats()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(checkpoint, port, max_batch, max_delay):
+    server = subprocess.Popen([sys.executable, "serve.py", checkpoint, "--port", str(port), "--max_batch",
+                               str(max_batch), "--max_delay", str(max_delay)], stdout=subprocess.DEVNULL)
+    for _ in range(200):
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                return server
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("the server did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="running server, started here if not given")
+    parser.add_argument("--checkpoint", help="checkpoint directory of the started servers")
+    parser.add_argument("--max_batch", default="1,16,64", help="comma separated, for the started servers")
+    parser.add_argument("--max_delay", type=float, default=0.002)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=4000)
+    parser.add_argument("--in_process", action="store_true", help="call the MicroBatcher without HTTP")
+    args = parser.parse_args()
+
+    common.use_lab("lab3")
+    import mlp
+    from checkpoint import save_checkpoint
+    from serve import MicroBatcher
+    X = np.random.default_rng(0).standard_normal((3072, args.requests)).astype(np.float32)
+    print(f'{"server":<24} {"p50 (ms)":>9} {"p99 (ms)":>9} {"req/s":>8} {"batch":>6} {"server p99":>11}')
+
+    def report(name, stats, server):
+        print(f'{name:<24} {stats["p50_ms"]:>9.2f} {stats["p99_ms"]:>9.2f} {stats["throughput"]:>8.1f} '
+              f'{server.get("mean_batch", 0):>6.1f} {server.get("p99_ms", 0):>11.2f}'
+              + (f' {stats["errors"]} errors' if stats["errors"] else ""))
+
+    if args.url:
+        url = urlparse(args.url)
+        report(args.url, *run_load(url.hostname, url.port, X, args.concurrency))
+        return
+
+    checkpoint = args.checkpoint
+    if checkpoint is None:
+        checkpoint = "History/benchmark_serve_checkpoint"
+        save_checkpoint(checkpoint, *mlp.MLP(k=3, dims=[3072, 50, 50, 10], batch_norm=True).checkpoint())
+    checkpoint = os.path.abspath(checkpoint)
+    for max_batch in map(int, args.max_batch.split(",")):
+        if args.in_process:
+            batcher = MicroBatcher(mlp.MLP.from_checkpoint(checkpoint), max_batch, args.max_delay)
+            report(f"in process max_batch={max_batch}", *run_in_process(batcher, X, args.concurrency))
+            batcher.close()
+            continue
+        port = free_port()
+        server = start_server(checkpoint, port, max_batch, args.max_delay)
+        try:
+            report(f"max_batch={max_batch}", *run_load("127.0.0.1", port, X, args.concurrency))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+""" Cost of a lambda search with successive halving against the full random search: wall clock time,
+update steps and the best lambda each of them finds.
+
+    python benchmarks/successive_halving.py [--lab lab3] [--n_lambda 9] [--reduction 3]
+"""
+import argparse
+
+import common
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lab", default="lab3", choices=["lab2", "lab3"])
+    parser.add_argument("--n_train", type=int, default=5000)
+    parser.add_argument("--n_lambda", type=int, default=9)
+    parser.add_argument("--n_cycles", type=int, default=3)
+    parser.add_argument("--ns", type=int, default=100)
+    parser.add_argument("--reduction", type=int, default=3)
+    parser.add_argument("--n_workers", type=int, default=1)
+    parser.add_argument("--synthetic", action="store_true")
+    args = parser.parse_args()
+
+    common.use_lab(args.lab)
+    import mlp
+    data = common.load_data(args.n_train, synthetic=args.synthetic)
+    GDparams = {"n_cycles": args.n_cycles, "n_batch": 100, "eta_min": 1e-5, "eta_max": 1e-1, "ns": args.ns,
+                "freq": 5, "exp": "benchmark_search"}
+    kwargs = {"dims": [3072, 50, 10], "k": 2} if args.lab == "lab3" else {}
+
+    search = mlp.Search(l_min=-5, l_max=-1, n_lambda=args.n_lambda)
+    with common.Timer() as timer:
+        results = search.random_search(data, GDparams, n_workers=args.n_workers, verbose=False, **kwargs)
+    full_time, full_steps = timer.elapsed, len(results) * 2 * args.ns * args.n_cycles
+    full_best = max(results, key=lambda r: r.get("val_acc", -1))["lamda"]
+
+    with common.Timer() as timer:
+        best, _ = search.successive_halving(data, GDparams, reduction=args.reduction, n_workers=args.n_workers,
+                                            verbose=False, **kwargs)
+    steps, previous = 0, 0
+    for rung in search.rungs:
+        steps += len(rung["ranking"]) * (rung["steps"] - previous)
+        previous = rung["steps"]
+
+    print(f'{"search":<20} {"time (s)":>9} {"steps":>7} {"cost":>6}  best lambda')
+    print(f'{"random search":<20} {full_time:>9.2f} {full_steps:>7} {1:>6.2f}  {full_best:.3g}')
+    print(f'{"successive halving":<20} {timer.elapsed:>9.2f} {steps:>7} {steps / full_steps:>6.2f}  {best:.3g}')
+    for i, rung in enumerate(search.rungs):
+        print(f'rung {i + 1}: {len(rung["ranking"])} candidates after {rung["steps"]} steps')
+        search.print_ranking(rung["ranking"])
+
+
+if __name__ == "__main__":
+    main()
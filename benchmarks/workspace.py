@@ -0,0 +1,66 @@
+""" Steps per second and peak memory allocated within a training step of the lab3 MLP,
+with and without the preallocated layer workspace, and with the numba kernels when installed.
+
+    python benchmarks/workspace.py [--n_batch 100] [--dtype float32] [--no_bn]
+"""
+import argparse
+import tracemalloc
+
+import common
+
+MODES = [("default", False, "numpy"), ("workspace", True, "numpy"), ("numba", True, "numba")]
+
+
+def steps(net, batches, init=False):
+    for X_batch, y_batch in batches:
+        P_batch = net.forward_pass(X_batch, train_mode=True, init=init)
+        net.compute_gradients(X_batch, y_batch, P_batch)
+        net.update_parameters(1e-3)
+        init = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dims", type=int, nargs="+", default=[3072, 50, 50, 10])
+    parser.add_argument("--n_batch", type=int, default=100)
+    parser.add_argument("--n_steps", type=int, default=200)
+    parser.add_argument("--dtype", default="float64", choices=["float64", "float32"])
+    parser.add_argument("--no_bn", action="store_true")
+    args = parser.parse_args()
+
+    common.use_lab("lab3")
+    import mlp
+    data = common.load_data(20 * args.n_batch, 1, synthetic=True)
+    X, y = data["X_train"].astype(args.dtype), data["y_train"]
+    batches = [(X[:, j:j+args.n_batch], y[j:j+args.n_batch]) for j in range(0, X.shape[1], args.n_batch)]
+    batches = [batches[j % len(batches)] for j in range(args.n_steps)]
+
+    print(f'{"mode":<10} {"steps/s":>9} {"MB allocated/step":>18}')
+    for name, workspace, kernels in MODES:
+        net = mlp.MLP(k=len(args.dims) - 1, dims=args.dims, lamda=0.005, batch_norm=not args.no_bn,
+                      dtype=args.dtype, workspace=workspace, kernels=kernels)
+        if net.kernels.name != kernels:
+            continue
+        if workspace:
+            net.allocate_workspace(args.n_batch)
+        # the first steps also compile the numba kernels
+        steps(net, batches[:2], init=True)
+
+        with common.Timer() as timer:
+            steps(net, batches)
+
+        # memory allocated on top of the live arrays during a step, as traced by numpy
+        tracemalloc.start()
+        peak = 0
+        for batch in batches[:20]:
+            start, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            steps(net, [batch])
+            peak += tracemalloc.get_traced_memory()[1] - start
+        tracemalloc.stop()
+        print(f'{name:<10} {args.n_steps / timer.elapsed:>9.1f} '
+              f'{peak / 20 / 2**20:>18.3f}')
+
+
+if __name__ == "__main__":
+    main()
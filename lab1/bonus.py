@@ -1,15 +1,18 @@
 from six.moves import cPickle
-from keras.utils.np_utils import to_categorical
-from sklearn.metrics import accuracy_score
-from sklearn.utils import shuffle
-import matplotlib.pyplot as plt
+import multiprocessing as mp
+from multiprocessing import resource_tracker, shared_memory
+import time
 import numpy as np
-from tqdm import tqdm
+from utils import cross_entropy, cross_entropy_grad, labels, one_hot
 
 
 def softmax(x):
-    """ Standard definition of the softmax function """
-    return np.exp(x) / np.sum(np.exp(x), axis=0)
+    """ Standard definition of the softmax function, shifted by the column max for stability """
+    e = np.exp(x - np.max(x, axis=0))
+    e /= np.sum(e, axis=0)
+    return e
+
+
 
 def loadData(filename, reshape=False, clipping=False):
     """ Loads data and creates one hot encoded labels """
@@ -31,7 +34,7 @@ def loadData(filename, reshape=False, clipping=False):
 
     y = np.array(y)
     # One hot Encode labels
-    Y = to_categorical(y, num_classes=10)
+    Y = one_hot(y, num_classes=10)
     Y = Y.T
 
     return X, y, Y
@@ -39,6 +42,7 @@ def loadData(filename, reshape=False, clipping=False):
 
 def plotCifar(X, Y):
     """ Util function to plot cifar original images along with their labels """
+    import matplotlib.pyplot as plt
     fig, axes1 = plt.subplots(5, 5, figsize=(12, 12))
     print(X.shape)
     for j in range(5):
@@ -55,9 +59,9 @@ def EvaluateClassifier(x, W, b):
 
 
 def ComputeCost(X, Y, W, b, _lambda):
-    """ Computes the cost function: cross entropy loss + L2 regularization """
-    P = EvaluateClassifier(X, W, b)
-    l = -np.log(np.sum(np.multiply(Y, P), axis=0))
+    """ Computes the cost function: cross entropy loss + L2 regularization.
+    Y can be one hot encoded (K, n) or integer labels (n,) """
+    l, _ = cross_entropy(W @ X + b, labels(Y))
     r = np.linalg.norm(W)**2
     J = np.sum(l)/X.shape[1] + _lambda*r
     return J
@@ -67,12 +71,12 @@ def ComputeAccuracy(X, y, W, b):
     """ Computes the prediction accuracy of a given state of the network """ 
     P = EvaluateClassifier(X, W, b)
     y_pred = np.argmax(P, axis=0)
-    return accuracy_score(y, y_pred)
+    return np.mean(y_pred == y)
 
 
 def ComputeGradients(X, Y, P, W, _lambda):
-    """ Computes gradients for cross entropy loss """
-    G = -(Y - P)
+    """ Computes gradients for cross entropy loss, P is overwritten by the gradient w.r.t. the scores """
+    G = cross_entropy_grad(P, labels(Y))
     nb = X.shape[1]
     grad_W = G @ X.T / nb + 2 * _lambda * W
     grad_b = np.sum(G, axis=1) / nb
@@ -82,16 +86,17 @@ def ComputeGradients(X, Y, P, W, _lambda):
 def ComputeGradientsHinge(X, Y, W, b, _lambda):
     """ Computes gradients for hinge loss """
     n_batch = X.shape[1]
+    y = labels(Y)
     scores = W @ X + b
-    yi_scores = scores[np.argmax(Y, axis=0), np.arange(X.shape[1])]
+    yi_scores = scores[y, np.arange(X.shape[1])]
     
     margins = np.maximum(0, scores - np.asarray(yi_scores) + 1)
-    margins[np.argmax(Y, axis=0), np.arange(X.shape[1])] = 0
+    margins[y, np.arange(X.shape[1])] = 0
 
     binary = margins
     binary[margins > 0] = 1
     row_sum = np.sum(binary, axis=0)
-    binary[np.argmax(Y, axis=0), np.arange(X.shape[1])] = -row_sum.T
+    binary[y, np.arange(X.shape[1])] = -row_sum.T
     
     grad_W = binary @ X.T / n_batch + 2 * _lambda * W
     gradb = np.sum(binary, axis=1)/n_batch
@@ -99,6 +104,13 @@ def ComputeGradientsHinge(X, Y, W, b, _lambda):
     return grad_W, gradb
 
 
+def batch_gradients(X, y, W, b, _lambda, loss="cross_entropy"):
+    """ Gradients of the cross entropy or of the hinge loss on a minibatch """
+    if loss == "cross_entropy":
+        return ComputeGradients(X, y, EvaluateClassifier(X, W, b), W, _lambda)
+    return ComputeGradientsHinge(X, y, W, b, _lambda)
+
+
 def compare_gradients(ga, gn, eps):
     """ Compares analytical and numerical gradients given a certain epsilon """
     K, d = ga.shape
@@ -112,8 +124,8 @@ def compare_gradients(ga, gn, eps):
 
 def history(X, Y, y, X_val, Y_val, y_val, epoch, W, b, _lambda, train_loss, val_loss, train_acc, val_acc, verbose=True):
     """ Creates history of the training """ 
-    J_train = ComputeCost(X, Y, W, b, _lambda)
-    J_val = ComputeCost(X_val, Y_val, W, b, _lambda)
+    J_train = ComputeCost(X, y, W, b, _lambda)
+    J_val = ComputeCost(X_val, y_val, W, b, _lambda)
 
     t_acc = ComputeAccuracy(X, y, W, b)
     v_acc = ComputeAccuracy(X_val, y_val, W, b)
@@ -130,6 +142,8 @@ def history(X, Y, y, X_val, Y_val, y_val, epoch, W, b, _lambda, train_loss, val_
 
 def minibatchGD(X, Y, y,  X_val, Y_val, y_val, GDparams, W, b, verbose=True, patience=0, annealing=False, reorder=False, loss="cross_entropy", experiment="mandatory"):
     """ Performas minibatch gradient descent """
+    from tqdm import tqdm
+
     _, n = X.shape
 
     train_loss, val_loss = [], []
@@ -147,22 +161,16 @@ def minibatchGD(X, Y, y,  X_val, Y_val, y_val, GDparams, W, b, verbose=True, pat
 
     for epoch in tqdm(range(epochs)):
         if reorder:
-            X, Y, y = shuffle(X.T, Y.T, y.T, random_state=epoch)
-            X, Y, y = X.T, Y.T, y.T
+            perm = np.random.RandomState(epoch).permutation(n)
+            X, Y, y = X[:, perm], Y[:, perm], y[perm]
 
         for j in range(n//batch_size):
             j_start = j * batch_size
             j_end = (j+1) * batch_size
             X_batch = X[:, j_start:j_end]
-            Y_batch = Y[:, j_start:j_end]
+            y_batch = y[j_start:j_end]
 
-            P_batch = EvaluateClassifier(X_batch, W, b)
-            if loss == "cross_entropy":
-                grad_W, grad_b = ComputeGradients(
-                X_batch, Y_batch, P_batch, W, _lambda)
-            else:
-                grad_W, grad_b = ComputeGradientsHinge(
-                    X_batch, Y_batch, W, b, _lambda)
+            grad_W, grad_b = batch_gradients(X_batch, y_batch, W, b, _lambda, loss)
 
             W -= eta * grad_W
             b -= eta * grad_b.reshape(len(b), 1)
@@ -188,6 +196,159 @@ def minibatchGD(X, Y, y,  X_val, Y_val, y_val, GDparams, W, b, verbose=True, pat
     return W, b, train_loss, val_loss, train_acc, val_acc
 
 
+class SharedArray():
+    """ Numpy array backed by a shared memory block, attached by name when unpickled """
+
+    def __init__(self, shape, dtype, name=None):
+        self.shape, self.dtype = tuple(shape), np.dtype(dtype)
+        size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def __getstate__(self):
+        return self.shape, self.dtype, self.shm.name
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+        # the block belongs to the training process, which unlinks it
+        resource_tracker.unregister(self.shm._name, "shared_memory")
+
+    def close(self, unlink=False):
+        del self.array
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def hogwild_worker(rank, n_workers, shared, GDparams, loss, annealing):
+    """ Runs the minibatches rank, rank + n_workers, ... of every epoch, updating the shared W and b without locks """
+    try:
+        try:
+            from threadpoolctl import threadpool_limits
+            threadpool_limits(1)
+        except ImportError:
+            pass
+        X, y, W, b, counts, done, release, stop = (
+            shared[key].array for key in ["X", "y", "W", "b", "counts", "done", "release", "stop"])
+        epochs, batch_size, eta, _lambda = GDparams["n_epochs"], GDparams[
+            "n_batch"], GDparams["eta"],  GDparams["lambda"]
+        _, n = X.shape
+
+        for epoch in range(epochs):
+            # same permutation in every worker, which share the minibatches out
+            perm = np.random.RandomState(epoch).permutation(n)
+            for j in range(rank, n//batch_size, n_workers):
+                if stop[0]:
+                    return
+                cols = perm[j*batch_size:(j+1)*batch_size]
+                grad_W, grad_b = batch_gradients(X[:, cols], y[cols], W, b, _lambda, loss)
+
+                # the other workers may read or update W and b in between
+                W -= np.multiply(grad_W, eta, out=grad_W)
+                b -= eta * grad_b.reshape(len(b), 1)
+                counts[rank] += 1
+
+            # the epoch is snapshotted once every worker has finished it, the next one starts after the copy
+            done[rank] = epoch + 1
+            while release[0] <= epoch and epoch + 1 < epochs:
+                if stop[0]:
+                    return
+                time.sleep(0.0005)
+
+            if annealing:
+                eta = update_eta(eta, GDparams['eta_decay'], GDparams['eta_decay_freq'], epoch)
+    finally:
+        for array in shared.values():
+            array.close()
+
+
+def hogwildGD(X, Y, y,  X_val, Y_val, y_val, GDparams, W, b, n_workers=4, verbose=True, patience=0, annealing=False, loss="cross_entropy", target_acc=None, experiment="hogwild"):
+    """ Asynchronous lock free (Hogwild) minibatch gradient descent: n_workers processes update W and b
+    in shared memory, each on its own share of the shuffled minibatches of every epoch. The workers pause
+    at the end of every epoch while W and b are copied, and the history is computed on these snapshots
+    while they go on with the next one. Training stops early with patience or once the validation
+    accuracy reaches target_acc """
+    from tqdm import tqdm
+
+    train_loss, val_loss = [], []
+    train_acc, val_acc = [], []
+
+    epochs, _lambda = GDparams["n_epochs"], GDparams["lambda"]
+
+    history(X, Y, y,  X_val, Y_val, y_val, 0, W, b,
+            _lambda, train_loss, val_loss, train_acc, val_acc, verbose)
+
+    ctx = mp.get_context("fork" if "fork" in mp.get_all_start_methods() else "spawn")
+    shared = {"X": SharedArray(X.shape, X.dtype), "y": SharedArray(y.shape, y.dtype),
+              "W": SharedArray(W.shape, W.dtype), "b": SharedArray(b.shape, b.dtype),
+              # updates made and epochs finished by each worker, epochs snapshotted, and stop flag
+              "counts": SharedArray((n_workers,), np.int64), "done": SharedArray((n_workers,), np.int64),
+              "release": SharedArray((1,), np.int64), "stop": SharedArray((1,), np.int64)}
+    for key, value in {"X": X, "y": y, "W": W, "b": b, "counts": 0, "done": 0, "release": 0, "stop": 0}.items():
+        shared[key].array[...] = value
+    counts, done, release = shared["counts"].array, shared["done"].array, shared["release"].array
+
+    workers = [ctx.Process(target=hogwild_worker, daemon=True, args=(
+        rank, n_workers, shared, GDparams, loss, annealing)) for rank in range(n_workers)]
+    try:
+        for worker in workers:
+            worker.start()
+
+        progress = tqdm(total=epochs)
+        epoch = 0
+        while epoch < epochs:
+            # checked before the epochs done, which are final once no worker is alive
+            alive = any(worker.is_alive() for worker in workers)
+            failed = any(worker.exitcode not in (None, 0) for worker in workers)
+            if np.min(done) > epoch:
+                # the workers wait for the copy, then update W and b during the evaluation of the snapshot
+                W_snap, b_snap = shared["W"].array.copy(), shared["b"].array.copy()
+                release[0] = epoch + 1
+                history(X, Y, y,  X_val, Y_val, y_val, epoch, W_snap, b_snap,
+                        _lambda, train_loss, val_loss, train_acc, val_acc, verbose)
+                epoch += 1
+                progress.update()
+
+                if early_stopping(val_loss, patience) and patience > 0:
+                    print(f"Early Stopping @ Epoch: {epoch}")
+                    break
+                if target_acc is not None and val_acc[-1] >= target_acc:
+                    break
+            elif failed or not alive:
+                break
+            else:
+                time.sleep(0.001)
+        progress.close()
+
+        shared["stop"].array[0] = 1
+        for worker in workers:
+            worker.join()
+        failed = [rank for rank, worker in enumerate(workers) if worker.exitcode != 0]
+        if failed:
+            raise RuntimeError(f"Hogwild workers {failed} failed")
+        if verbose:
+            print(f"Updates per worker: {counts.tolist()}")
+
+        W[...] = shared["W"].array
+        b[...] = shared["b"].array
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        for array in shared.values():
+            array.close(unlink=True)
+
+    backup(GDparams, W, b, train_loss, val_loss, train_acc,
+           val_acc, patience=patience, annealing=annealing, reorder=True, experiment=experiment)
+
+    train_loss = np.array(train_loss)
+    val_loss = np.array(val_loss)
+    train_acc = np.array(train_acc)
+    val_acc = np.array(val_acc)
+
+    return W, b, train_loss, val_loss, train_acc, val_acc
+
+
 def backup(GDparams, W, b, train_loss, val_loss, train_acc, val_acc, patience=0, annealing=False, reorder=False, experiment="mandatory"):
     """ Saves networks params in order to be able to reuse it """
     epochs, batch_size, eta, _lambda = GDparams["n_epochs"], GDparams[
@@ -208,6 +369,7 @@ def backup(GDparams, W, b, train_loss, val_loss, train_acc, val_acc, patience=0,
 
 def montage(W, GDparams, patience=0, annealing=False, reorder=False, experiment="mandatory"):
     """ Display the image for each label in W """
+    import matplotlib.pyplot as plt
     epochs, batch_size, eta, _lambda = GDparams["n_epochs"], GDparams[
         "n_batch"], GDparams["eta"],  GDparams["lambda"]
     _, ax = plt.subplots(2, 5)
@@ -226,6 +388,7 @@ def montage(W, GDparams, patience=0, annealing=False, reorder=False, experiment=
 
 def plot_metric(train_loss, val_loss, GDparams, patience=0, annealing=False, reorder=False, type="loss", experiment="mandatory"):
     """ Plots a given metric (loss or accuracy) """
+    import matplotlib.pyplot as plt
     epochs, batch_size, eta, _lambda = GDparams["n_epochs"], GDparams[
         "n_batch"], GDparams["eta"],  GDparams["lambda"]
 
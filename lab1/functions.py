@@ -1,6 +1,9 @@
 import numpy as np
 from utils import *
-from numba import jit, cuda
+try:
+	from numba import jit, cuda
+except ImportError:
+	pass
 def softmax(x):
     """ Standard definition of the softmax function """
     return np.exp(x) / np.sum(np.exp(x), axis=0)
@@ -71,6 +74,41 @@ def ComputeGradsNumSlow(X, Y, W, b, lamda, h):
 
 	return [grad_W, grad_b]
 
+def ComputeGradsNumBatched(X, Y, W, b, lamda, h, centered=True, block=256):
+	""" Finite differences of ComputeCost for every entry of W and b, evaluated in blocks.
+	The model is linear: perturbing W[i,j] only shifts row i of the scores by h*X[j,:],
+	so the perturbed log-sum-exp of a whole block of entries is an update of the unperturbed one """
+	K, n = W.shape[0], X.shape[1]
+	y = labels(Y)
+
+	S = W @ X + b
+	E = np.exp(S - np.max(S, axis=0))
+	Z = np.sum(E, axis=0)
+	E /= Z
+
+	def row_grads(i, D):
+		""" Differences of the cost when row i of the scores is shifted by D (m, n) """
+		if centered:
+			# log Z(+hD) - log Z(-hD), with Z(-hD) = Z (1 + E (exp(-hD) - 1))
+			lse = np.log1p(2*E[i]*np.sinh(h*D) / (1 + E[i]*np.expm1(-h*D)))
+			label = 2*h*np.sum(D[:, y == i], axis=1)
+			return (np.sum(lse, axis=1) - label) / (2*h*n)
+		lse = np.log1p(E[i]*np.expm1(h*D))
+		label = h*np.sum(D[:, y == i], axis=1)
+		return (np.sum(lse, axis=1) - label) / (h*n)
+
+	grad_W = np.zeros(W.shape)
+	grad_b = np.zeros((K, 1))
+	ones = np.ones((1, n))
+	for i in range(K):
+		grad_b[i] = row_grads(i, ones)
+		for j in range(0, W.shape[1], block):
+			grad_W[i, j:j+block] = row_grads(i, X[j:j+block])
+
+	# regularization: (lamda*||W + h e_ij||^2 - lamda*||W - h e_ij||^2) / 2h
+	grad_W += 2*lamda*W if centered else lamda*(2*W + h)
+	return [grad_W, grad_b]
+
 def montage(W):
 	""" Display the image for each label in W """
 	import matplotlib.pyplot as plt
@@ -1,15 +1,43 @@
 from six.moves import cPickle
-from keras.utils.np_utils import to_categorical
-from sklearn.metrics import accuracy_score
-from sklearn.utils import shuffle
-import matplotlib.pyplot as plt
+import json
+import os
 import numpy as np
-from tqdm import tqdm
 
 
 def softmax(x):
-    """ Standard definition of the softmax function """
-    return np.exp(x) / np.sum(np.exp(x), axis=0)
+    """ Standard definition of the softmax function, shifted by the column max for stability """
+    e = np.exp(x - np.max(x, axis=0))
+    e /= np.sum(e, axis=0)
+    return e
+
+
+def labels(Y):
+    """ Integer labels from either integer labels or one hot encoded labels (K, n) """
+    return Y if Y.ndim == 1 else np.argmax(Y, axis=0)
+
+
+def cross_entropy(S, y):
+    """ Fused log-softmax cross entropy of the scores S (K, n) against the integer labels y:
+    log-sum-exp over the shifted scores minus the score of the label, no one hot matrix involved.
+    Returns the per-sample losses and the softmax probabilities """
+    S = S - np.max(S, axis=0)
+    P = np.exp(S)
+    Z = np.sum(P, axis=0)
+    losses = np.log(Z) - S[y, np.arange(S.shape[1])]
+    P /= Z
+    return losses, P
+
+
+def cross_entropy_grad(P, y):
+    """ Gradient of the cross entropy w.r.t. the scores, P - Y, computed in place in P """
+    P[y, np.arange(P.shape[1])] -= 1
+    return P
+
+
+def one_hot(y, num_classes=10):
+    """ One hot encodes integer labels as a (n, num_classes) float32 matrix """
+    return np.eye(num_classes, dtype=np.float32)[y]
+
 
 def loadData(filename, reshape=False, clipping=False):
     """ Loads data and creates one hot encoded labels """
@@ -31,14 +59,86 @@ def loadData(filename, reshape=False, clipping=False):
 
     y = np.array(y)
     # One hot Encoded labels
-    Y = to_categorical(y, num_classes=10)
+    Y = one_hot(y, num_classes=10)
     Y = Y.T
 
     return X, y, Y
 
 
+CACHE_VERSION = 1
+CACHE_DIR = '../Dataset/cifar-10-cache/'
+BATCHES = ['data_batch_1', 'data_batch_2', 'data_batch_3',
+           'data_batch_4', 'data_batch_5', 'test_batch']
+
+
+def cache_batch(filename, cache_dir=CACHE_DIR, stats=True):
+    """ Converts a cifar batch into a versioned, memory-mappable cache entry:
+    feature-major float32 X (d, n), int labels and optionally the per-feature mean/std """
+    X, y, _ = loadData(filename, clipping=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    prefix = cache_dir + filename
+    # an existing entry is invalidated before its arrays are overwritten
+    if os.path.exists(prefix + '_meta.json'):
+        os.remove(prefix + '_meta.json')
+
+    X_map = np.lib.format.open_memmap(
+        prefix + '_X.npy', mode='w+', dtype=np.float32, shape=X.shape)
+    X_map[:] = X
+    X_map.flush()
+    del X_map
+    np.save(prefix + '_y.npy', y.astype(np.int64))
+
+    if stats:
+        np.save(prefix + '_mean.npy', np.mean(X, axis=1))
+        np.save(prefix + '_std.npy', np.std(X, axis=1))
+
+    # the meta file is written last so that an interrupted conversion is never picked up
+    meta = {"version": CACHE_VERSION, "shape": list(X.shape),
+            "dtype": "float32", "stats": stats}
+    with open(prefix + '_meta.json', 'w') as f:
+        json.dump(meta, f)
+
+
+def cache_dataset(filenames=BATCHES, cache_dir=CACHE_DIR, stats=True):
+    """ One-time conversion of the cifar batches into the on-disk cache """
+    for filename in filenames:
+        cache_batch(filename, cache_dir, stats)
+
+
+def is_cached(filename, cache_dir=CACHE_DIR):
+    """ Checks that a valid cache entry of the current version exists """
+    try:
+        with open(cache_dir + filename + '_meta.json') as f:
+            return json.load(f)["version"] == CACHE_VERSION
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def loadCachedData(filename, cache_dir=CACHE_DIR, mmap_mode='r'):
+    """ Drop-in replacement of loadData(filename, clipping=True) backed by the memory-mapped cache.
+    X is shared through the page cache between processes, use mmap_mode='c' to modify it locally """
+    if not is_cached(filename, cache_dir):
+        cache_batch(filename, cache_dir)
+
+    X = np.load(cache_dir + filename + '_X.npy', mmap_mode=mmap_mode)
+    y = np.load(cache_dir + filename + '_y.npy')
+    # One hot Encoded labels
+    Y = one_hot(y, num_classes=10)
+    Y = Y.T
+
+    return X, y, Y
+
+
+def loadCachedStats(filename, cache_dir=CACHE_DIR):
+    """ Loads the precomputed per-feature mean and std of a cached batch """
+    if not is_cached(filename, cache_dir) or not os.path.exists(cache_dir + filename + '_mean.npy'):
+        cache_batch(filename, cache_dir)
+    return np.load(cache_dir + filename + '_mean.npy'), np.load(cache_dir + filename + '_std.npy')
+
+
 def plotCifar(X, Y):
     """ Util function to plot cifar original images along with their labels """
+    import matplotlib.pyplot as plt
     fig, axes1 = plt.subplots(5, 5, figsize=(12, 12))
     print(X.shape)
     for j in range(5):
@@ -55,9 +155,9 @@ def EvaluateClassifier(x, W, b):
 
 
 def ComputeCost(X, Y, W, b, _lambda):
-    """ Computes the cost function: cross entropy loss + L2 regularization """
-    P = EvaluateClassifier(X, W, b)
-    l = -np.log(np.sum(np.multiply(Y, P), axis=0))
+    """ Computes the cost function: cross entropy loss + L2 regularization.
+    Y can be one hot encoded (K, n) or integer labels (n,) """
+    l, _ = cross_entropy(W @ X + b, labels(Y))
     r = np.linalg.norm(W)**2
     J = np.sum(l)/X.shape[1] + _lambda*r
     return J
@@ -67,12 +167,12 @@ def ComputeAccuracy(X, y, W, b):
     """ Computes the prediction accuracy of a given state of the network """ 
     P = EvaluateClassifier(X, W, b)
     y_pred = np.argmax(P, axis=0)
-    return accuracy_score(y, y_pred)
+    return np.mean(y_pred == y)
 
 
 def ComputeGradients(X, Y, P, W, _lambda):
-    """ Computes gradients for cross entropy loss """
-    G = -(Y - P)
+    """ Computes gradients for cross entropy loss, P is overwritten by the gradient w.r.t. the scores """
+    G = cross_entropy_grad(P, labels(Y))
     nb = X.shape[1]
     grad_W = G @ X.T / nb + 2 * _lambda * W
     grad_b = np.sum(G, axis=1) / nb
@@ -82,19 +182,13 @@ def ComputeGradients(X, Y, P, W, _lambda):
 
 def compare_gradients(ga, gn, eps):
     """ Compares analytical and numerical gradients given a certain epsilon """
-    K, d = ga.shape
-    rerr = np.zeros((K, d))
-    for i in range(K):
-        for j in range(d):
-            rerr[i, j] = abs(ga[i, j] - gn[i, j]) / \
-                max(eps, abs(ga[i, j]) + abs(gn[i, j]))
-    return rerr
+    return np.abs(ga - gn) / np.maximum(eps, np.abs(ga) + np.abs(gn))
 
 
 def history(X, Y, y, X_val, Y_val, y_val, epoch, W, b, _lambda, train_loss, val_loss, train_acc, val_acc, verbose=True):
     """ Creates history of the training """ 
-    J_train = ComputeCost(X, Y, W, b, _lambda)
-    J_val = ComputeCost(X_val, Y_val, W, b, _lambda)
+    J_train = ComputeCost(X, y, W, b, _lambda)
+    J_val = ComputeCost(X_val, y_val, W, b, _lambda)
 
     t_acc = ComputeAccuracy(X, y, W, b)
     v_acc = ComputeAccuracy(X_val, y_val, W, b)
@@ -111,6 +205,8 @@ def history(X, Y, y, X_val, Y_val, y_val, epoch, W, b, _lambda, train_loss, val_
 
 def minibatchGD(X, Y, y,  X_val, Y_val, y_val, GDparams, W, b, verbose=True, experiment="mandatory"):
     """ Performas minibatch gradient descent """
+    from tqdm import tqdm
+
     _, n = X.shape
 
     train_loss, val_loss = [], []
@@ -128,12 +224,12 @@ def minibatchGD(X, Y, y,  X_val, Y_val, y_val, GDparams, W, b, verbose=True, exp
             j_start = j * batch_size
             j_end = (j+1) * batch_size
             X_batch = X[:, j_start:j_end]
-            Y_batch = Y[:, j_start:j_end]
+            y_batch = y[j_start:j_end]
 
             P_batch = EvaluateClassifier(X_batch, W, b)
 
             grad_W, grad_b = ComputeGradients(
-            X_batch, Y_batch, P_batch, W, _lambda)
+            X_batch, y_batch, P_batch, W, _lambda)
 
 
             W -= eta * grad_W
@@ -173,6 +269,7 @@ def backup(GDparams, W, b, train_loss, val_loss, train_acc, val_acc, experiment=
 
 def montage(W, GDparams, experiment="mandatory"):
     """ Display the image for each label in W """
+    import matplotlib.pyplot as plt
     epochs, batch_size, eta, _lambda = GDparams["n_epochs"], GDparams[
         "n_batch"], GDparams["eta"],  GDparams["lambda"]
     _, ax = plt.subplots(2, 5)
@@ -191,6 +288,7 @@ def montage(W, GDparams, experiment="mandatory"):
 
 def plot_metric(train_loss, val_loss, GDparams, type="loss", experiment="mandatory"):
     """ Plots a given metric (loss or accuracy) """
+    import matplotlib.pyplot as plt
     epochs, batch_size, eta, _lambda = GDparams["n_epochs"], GDparams[
         "n_batch"], GDparams["eta"],  GDparams["lambda"]
 
@@ -1,17 +1,74 @@
-from sklearn.utils import shuffle
-import matplotlib.pyplot as plt
-from sklearn.metrics import accuracy_score
+import copy
+import json
+import multiprocessing as mp
+import os
+import time
 import numpy as np
-from tqdm import tqdm
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from utils import BatchLoader, cross_entropy, cross_entropy_grad, labels
+from optimizers import SGD, load_optimizer
+from results import RESULTS_DB, ResultsStore
+from checkpoint import (is_checkpoint, layer_arrays, load_checkpoint, optimizer_arrays, optimizer_state,
+                        save_checkpoint, set_layer_arrays)
 
 
 def softmax(x):
-    """ Standard definition of the softmax function """
-    return np.exp(x) / np.sum(np.exp(x), axis=0)
+    """ Standard definition of the softmax function, shifted by the column max for stability """
+    e = np.exp(x - np.max(x, axis=0))
+    e /= np.sum(e, axis=0)
+    return e
+
+
+# state of the search workers: the dataset, inherited through fork rather than pickled for every trial
+_search = {}
+
+
+def _init_search_worker(data, threads):
+    _search["data"] = data
+    if threads is not None:
+        # one BLAS pool per worker, sized so that the workers do not oversubscribe the cores
+        try:
+            from threadpoolctl import threadpool_limits
+            threadpool_limits(threads)
+        except ImportError:
+            pass
+
+
+def _search_trial(lamda, GDparams, store):
+    """ Trains the MLP of one lambda of a search, returning its summary, which is also appended to the
+    results store if any """
+    mlp = MLP(lamda=lamda)
+    mlp.cyclic_learning(_search["data"], GDparams, verbose=False, backup=True)
+    summary = mlp.summary(GDparams)
+    if store is not None:
+        with ResultsStore(store) as results:
+            results.add(**summary)
+    return summary
+
+
+def _halving_trial(mlp, GDparams, n_steps, backup, store):
+    """ Resumes the cyclic learning of mlp for n_steps updates (up to the end of the cycles if None) and
+    evaluates it without adding to its history, returning the trained network and the metrics it is ranked
+    by. The summaries of the backed up networks are stored """
+    data = _search["data"]
+    mlp.cyclic_learning(data, GDparams, verbose=False, backup=backup, n_steps=n_steps)
+    t_loss, _, t_acc, v_loss, _, v_acc = mlp.history_metrics(data, GDparams.get("eval_subsample"))
+    if backup and store is not None:
+        with ResultsStore(store) as results:
+            results.add(**mlp.summary(GDparams))
+    # the activations and gradients of the last passes are not sent back to the search process
+    for layer in mlp.layers:
+        layer.input = None
+        for p in layer.params:
+            setattr(layer, "grad_" + p, None)
+    return mlp, {"train_acc": t_acc, "val_acc": v_acc, "val_loss": v_loss}
 
 
 class Layer():
+    params = ["W", "b"]
+    master = None
+
     def __init__(self, d_in, d_out, W, b, grad_W, grad_b, x):
         self.d_in = d_in
         self.d_out = d_out
@@ -21,57 +78,87 @@ class Layer():
         self.grad_b = grad_b
         self.input = input
 
+    def keep_master_copy(self):
+        """ Keeps float64 master copies of the parameters, updates are accumulated in full precision """
+        self.master = {p: getattr(self, p).astype(np.float64) for p in self.params}
+
+    def apply_update(self, p, delta):
+        """ Subtracts delta from parameter p in place, going through its master copy if any """
+        param = getattr(self, p)
+        if self.master is None:
+            param -= delta
+        else:
+            self.master[p] -= delta
+            param[...] = self.master[p]
+
 
 class MLP():
-    def __init__(self, k=2, dims=[3072, 50, 10], lamda=0, seed=42) -> None:
+    def __init__(self, k=2, dims=[3072, 50, 10], lamda=0, seed=42, dtype=np.float64, master_weights=False, optimizer=None) -> None:
         np.random.seed(seed)
         self.seed = seed
         self.k = k
         self.lamda = lamda
         self.dims = dims
+        # compute precision of parameters, activations and gradients
+        self.dtype = np.dtype(dtype)
         self.layers = []
         for i in range(k):
             d_in, d_out = self.dims[i], self.dims[i+1]
             self.layers.append(Layer(d_in, d_out, np.random.normal(
-                0, 1/np.sqrt(d_in), (d_out, d_in)), np.zeros((d_out, 1)), None, None, None))
+                0, 1/np.sqrt(d_in), (d_out, d_in)).astype(self.dtype), np.zeros((d_out, 1), dtype=self.dtype), None, None, None))
+            if master_weights:
+                self.layers[-1].keep_master_copy()
 
         self.train_loss, self.val_loss = [], []
         self.train_cost, self.val_cost = [], []
         self.train_acc, self.val_acc = [], []
-
-    def forward_pass(self, X):
-        input = X.copy()
-        for layer in self.layers:
-            layer.input = input.copy()
+        self.evaluator, self.pending = None, []
+        self.optimizer = optimizer if optimizer is not None else SGD()
+        self.patience, self.monitor = 0, "val_loss"
+        self.best, self.stale = None, 0
+        self.best_eval, self.stop_reason, self.stop_step = None, None, None
+        # updates made by cyclic_learning so far, from which it resumes
+        self.step = 0
+        # wall time spent in cyclic_learning
+        self.train_time = 0.
+
+    def forward_pass(self, X, logits=False):
+        """ Returns the class probabilities, or the scores of the last layer if logits """
+        input = X.astype(self.dtype, copy=False)
+        for layer in self.layers[:-1]:
+            layer.input = input
             input = np.maximum(
                 0, layer.W @ layer.input + layer.b)
-        return softmax(layer.W @ layer.input + layer.b)
+        layer = self.layers[-1]
+        layer.input = input
+        scores = layer.W @ layer.input + layer.b
+        return scores if logits else softmax(scores)
 
     def compute_cost(self, X, Y):
-        """ Computes the cost function: cross entropy loss + L2 regularization """
-        P = self.forward_pass(X)
-        loss = np.log(np.sum(np.multiply(Y, P), axis=0))
-        loss = - np.sum(loss)/X.shape[1]
+        """ Computes the cost function: cross entropy loss + L2 regularization.
+        Y can be one hot encoded (K, n) or integer labels (n,) """
+        loss, _ = cross_entropy(self.forward_pass(X, logits=True), labels(Y))
+        loss = np.sum(loss)/X.shape[1]
         r = np.sum([np.linalg.norm(layer.W) ** 2 for layer in self.layers])
         cost = loss + self.lamda * r
         return loss, cost
 
     def compute_gradients(self, X, Y, P):
-        G = - (Y - P)
+        """ Backpropagates the cross entropy of the probabilities P (overwritten)
+        against the labels Y, one hot encoded or integers """
+        G = cross_entropy_grad(P, labels(Y))
         nb = X.shape[1]
 
         for layer in reversed(self.layers):
             layer.grad_W = G @ layer.input.T / nb + \
-                2 * self.lamda * layer.W
+                2 * float(self.lamda) * layer.W
             layer.grad_b = (
                 np.sum(G, axis=1) / nb).reshape(layer.d_out, 1)
             G = layer.W.T @ G
             G = np.multiply(G, np.heaviside(layer.input, 0))
 
     def update_parameters(self, eta=1e-2):
-        for layer in self.layers:
-            layer.W -= eta * layer.grad_W
-            layer.b -= eta * layer.grad_b
+        self.optimizer.step(self.layers, eta)
 
     def compute_gradients_num(self, X_batch, Y_batch, h=1e-5):
         """ Numerically computes the gradients of the weight and bias parameters
@@ -139,43 +226,55 @@ class MLP():
         """ Computes the prediction accuracy of a given state of the network """
         P = self.forward_pass(X)
         y_pred = np.argmax(P, axis=0)
-        return accuracy_score(y, y_pred)
+        return np.mean(y_pred == y)
 
-    def mini_batch_gd(self, data, GDparams, verbose=True, backup=False):
+    def mini_batch_gd(self, data, GDparams, verbose=True, backup=False, async_history=False, patience=0,
+                      monitor="val_loss"):
         """ Performas minibatch gradient descent """
+        from tqdm import tqdm
+        self.start_evaluator(async_history)
+        self.start_early_stopping(patience, monitor)
 
         X, Y, y = data["X_train"], data["Y_train"], data["y_train"]
 
-        _, n = X.shape
-
         epochs, batch_size, eta = GDparams["n_epochs"], GDparams["n_batch"], GDparams["eta"]
 
-        self.history(data, 0, verbose, cyclic=False)
+        # epoch of the last evaluation, the one training stops at
+        epoch = 0
+        self.history(data, epoch, verbose, cyclic=False, subsample=GDparams.get("eval_subsample"))
 
-        for epoch in tqdm(range(epochs)):
+        loader = BatchLoader(X, None, y, batch_size)
 
-            X, Y, y = shuffle(X.T, Y.T, y.T, random_state=epoch)
-            X, Y, y = X.T, Y.T, y.T
-
-            for j in range(n//batch_size):
-                j_start = j * batch_size
-                j_end = (j+1) * batch_size
-                X_batch = X[:, j_start:j_end]
-                Y_batch = Y[:, j_start:j_end]
+        for epoch in tqdm(range(epochs)):
+            for X_batch, _, y_batch in loader.epoch(seed=epoch):
 
                 P_batch = self.forward_pass(X_batch)
 
-                self.compute_gradients(X_batch, Y_batch, P_batch)
+                self.compute_gradients(X_batch, y_batch, P_batch)
 
                 self.update_parameters(eta)
 
-            self.history(data, epoch, verbose, cyclic=False)
+            self.history(data, epoch, verbose, cyclic=False, subsample=GDparams.get("eval_subsample"))
+
+            if self.patience > 0:
+                self.collect_history(verbose, wait=True)
+                if self.early_stop(epoch, cyclic=False, verbose=verbose):
+                    break
+
+        loader.close()
+        self.stop_evaluator(verbose)
+        self.finish_early_stopping(epoch)
 
         if backup:
             self.backup(GDparams)
 
-    def cyclic_learning(self, data, GDparams, verbose=True, backup=False):
-        """ Performas minibatch gradient descent """
+    def cyclic_learning(self, data, GDparams, verbose=True, backup=False, async_history=False, patience=0,
+                        monitor="val_loss", n_steps=None):
+        """ Performas minibatch gradient descent, early stopping being decided at the end of the cycles.
+        Training resumes from self.step, for n_steps updates or up to the end of the n_cycles """
+        from tqdm import tqdm
+        self.start_evaluator(async_history)
+        self.start_early_stopping(patience, monitor)
         X, Y, y = data["X_train"], data["Y_train"], data["y_train"]
 
         _, n = X.shape
@@ -183,48 +282,131 @@ class MLP():
         n_cycles, batch_size, eta_min, eta_max, ns, freq = GDparams["n_cycles"], GDparams[
             "n_batch"], GDparams["eta_min"], GDparams["eta_max"], GDparams["ns"], GDparams['freq']
 
-        eta = eta_min
-        t = 0
-
         epochs = batch_size * 2 * ns * n_cycles // n
 
-        for epoch in tqdm(range(epochs)):
-            X, Y, y = shuffle(X.T, Y.T, y.T, random_state=epoch)
-            X, Y, y = X.T, Y.T, y.T
-            for j in range(n//batch_size):
-                j_start = j * batch_size
-                j_end = (j+1) * batch_size
-                X_batch = X[:, j_start:j_end]
-                Y_batch = Y[:, j_start:j_end]
+        loader = BatchLoader(X, None, y, batch_size)
+
+        start, start_time = self.step, time.perf_counter()
+        end = epochs * len(loader) if n_steps is None else start + n_steps
+        t = start % (2*ns)
+        eta = eta_min if start == 0 else self.cyclic_eta((start - 1) % (2*ns), eta_min, eta_max, ns)
+
+        for epoch in tqdm(range(start // len(loader), -(-end // len(loader)))):
+            offset = max(start - epoch * len(loader), 0)
+            for j, (X_batch, _, y_batch) in enumerate(loader.epoch(seed=epoch, start=offset), start=offset):
 
                 P_batch = self.forward_pass(X_batch)
 
-                self.compute_gradients(X_batch, Y_batch, P_batch)
+                self.compute_gradients(X_batch, y_batch, P_batch)
                 self.update_parameters(eta)
 
                 if t % (2*ns//freq) == 0:
-                    self.history(data, t, verbose)
+                    self.history(data, t, verbose, subsample=GDparams.get("eval_subsample"))
 
-                if t <= ns:
-                    eta = eta_min + t/ns * (eta_max - eta_min)
-                else:
-                    eta = eta_max - (t - ns)/ns * (eta_max - eta_min)
+                eta = self.cyclic_eta(t, eta_min, eta_max, ns)
 
                 t = (t+1) % (2*ns)
+                self.step = epoch * len(loader) + j + 1
+
+                if t == 0 and self.patience > 0:
+                    self.collect_history(verbose, wait=True)
+                    if self.early_stop(self.step, verbose=verbose):
+                        break
+                if self.step == end:
+                    break
+            else:
+                continue
+            break
+        loader.close()
+        self.stop_evaluator(verbose)
+        self.finish_early_stopping(self.step)
+        self.train_time += time.perf_counter() - start_time
+
         if backup:
             self.backup_cyclic(GDparams)
 
-    def history(self, data, epoch, verbose=True, cyclic=True):
-        """ Creates history of the training """
+    def summary(self, GDparams):
+        """ Hyperparameters, final and best metrics, wall time and checkpoint of a cyclic learning run,
+        as a row of the results store """
+        n_cycles, batch_size, eta_min, eta_max, ns, exp = GDparams["n_cycles"], GDparams[
+            "n_batch"], GDparams["eta_min"], GDparams["eta_max"], GDparams["ns"], GDparams["exp"]
+        return {"exp": exp, "lamda": self.lamda, "seed": self.seed, "n_cycles": n_cycles, "n_batch": batch_size,
+                "eta_min": eta_min, "eta_max": eta_max, "ns": ns, "steps": self.step,
+                "train_acc": self.train_acc[-1], "val_acc": self.val_acc[-1], "val_loss": self.val_loss[-1],
+                "best_val_acc": max(self.val_acc), "best_val_loss": min(self.val_loss), "wall_time": self.train_time,
+                "checkpoint": f'History/{exp}_checkpoint_{self.backup_name(GDparams, lamda=self.lamda, seed=self.seed)}',
+                "params": {"k": self.k, "dims": self.dims}}
 
-        X, Y, y, X_val, Y_val, y_val = data["X_train"], data["Y_train"], data[
-            "y_train"], data["X_val"], data["Y_val"], data["y_val"]
+    @staticmethod
+    def cyclic_eta(t, eta_min, eta_max, ns):
+        """ Learning rate of the triangular schedule at step t of a cycle of 2 ns steps """
+        if t <= ns:
+            return eta_min + t/ns * (eta_max - eta_min)
+        return eta_max - (t - ns)/ns * (eta_max - eta_min)
+
+    def evaluate(self, X, y, chunk_size=5000):
+        """ Computes loss, cost and accuracy with a single forward pass, made over chunks
+        of columns so that the peak memory does not grow with the number of samples """
+        n = X.shape[1]
+        loss, correct = 0., 0
+        for j in range(0, n, chunk_size):
+            S = self.forward_pass(X[:, j:j+chunk_size], logits=True)
+            losses, _ = cross_entropy(S, y[j:j+chunk_size])
+            loss += np.sum(losses, dtype=np.float64)
+            correct += np.count_nonzero(np.argmax(S, axis=0) == y[j:j+chunk_size])
+        loss = loss / n
+        r = np.sum([np.linalg.norm(layer.W) ** 2 for layer in self.layers])
+        cost = loss + self.lamda * r
+        return loss, cost, correct / n
 
-        t_loss, t_cost = self.compute_cost(X, Y)
-        v_loss, v_cost = self.compute_cost(X_val, Y_val)
+    def eval_subset(self, n, subsample):
+        """ Fixed random subset of the training set used for the train-side metrics """
+        return np.sort(np.random.RandomState(self.seed).choice(n, subsample, replace=False))
 
-        t_acc = self.compute_accuracy(X, y)
-        v_acc = self.compute_accuracy(X_val, y_val)
+    def snapshot(self):
+        """ Copy of the network holding its own copies of the parameters, cheap enough to be
+        taken at every history step and evaluated while the original keeps training """
+        net = copy.copy(self)
+        net.layers = []
+        for layer in self.layers:
+            clone = copy.copy(layer)
+            clone.master = None
+            for p in layer.params:
+                setattr(clone, p, getattr(layer, p).copy())
+            net.layers.append(clone)
+        net.evaluator, net.pending = None, []
+        return net
+
+    def history(self, data, epoch, verbose=True, cyclic=True, subsample=None):
+        """ Creates history of the training, the train metrics being computed on a fixed
+        subset of subsample columns if given. When an evaluator is running, the metrics of a
+        snapshot are computed in the background and recorded in step order by collect_history """
+
+        if self.evaluator is None:
+            self.record_history(epoch, cyclic, self.history_metrics(data, subsample), verbose)
+            return
+
+        # backpressure: never let more than two evaluations queue behind training
+        if len(self.pending) >= 2:
+            self.pending[0][2].result()
+        net = self.snapshot()
+        self.pending.append((epoch, cyclic, self.evaluator.submit(
+            net.history_metrics, data, subsample), net))
+        self.collect_history(verbose)
+
+    def history_metrics(self, data, subsample=None):
+        X, y, X_val, y_val = data["X_train"], data["y_train"], data["X_val"], data["y_val"]
+
+        if subsample is not None and subsample < X.shape[1]:
+            idx = self.eval_subset(X.shape[1], subsample)
+            X, y = X[:, idx], y[idx]
+
+        t_loss, t_cost, t_acc = self.evaluate(X, y)
+        v_loss, v_cost, v_acc = self.evaluate(X_val, y_val)
+        return t_loss, t_cost, t_acc, v_loss, v_cost, v_acc
+
+    def record_history(self, epoch, cyclic, metrics, verbose=True, net=None):
+        t_loss, t_cost, t_acc, v_loss, v_cost, v_acc = metrics
 
         if verbose:
             pref = "Update Step " if cyclic else "Epoch "
@@ -238,37 +420,139 @@ class MLP():
         self.train_acc.append(t_acc)
         self.val_acc.append(v_acc)
 
-    def backup(self, GDparams):
-        """ Saves networks params in order to be able to reuse it """
-
-        epochs, batch_size, eta, exp = GDparams["n_epochs"], GDparams["n_batch"], GDparams["eta"], GDparams["exp"]
+        if self.patience > 0:
+            self.track_best(net)
+
+    def start_evaluator(self, async_history):
+        if async_history:
+            self.evaluator = ThreadPoolExecutor(max_workers=1)
+
+    def collect_history(self, verbose=True, wait=False):
+        """ Records the finished background evaluations in step order, waiting for all of them if asked """
+        while self.pending and (wait or self.pending[0][2].done()):
+            epoch, cyclic, future, net = self.pending.pop(0)
+            self.record_history(epoch, cyclic, future.result(), verbose, net)
+
+    def stop_evaluator(self, verbose=True):
+        if self.evaluator is not None:
+            self.collect_history(verbose, wait=True)
+            self.evaluator.shutdown()
+            self.evaluator = None
+
+    def start_early_stopping(self, patience=0, monitor="val_loss"):
+        """ Stops the training once the monitored validation metric (val_loss, val_cost or val_acc)
+        has not improved for patience evaluations, 0 disables early stopping """
+        self.patience, self.monitor = patience, monitor
+        self.best, self.stale = None, 0
+        self.best_eval, self.stop_reason, self.stop_step = None, None, None
+
+    def track_best(self, net=None):
+        """ Keeps a copy of the parameters of the best evaluation so far, net being the evaluated
+        snapshot if any, and counts the evaluations without improvement since """
+        values = getattr(self, self.monitor)
+        value = values[-1]
+        if self.monitor.endswith("acc"):
+            value = -value
+        if self.best is None or value < self.best["value"]:
+            self.best = {"value": value, "net": net if net is not None else self.snapshot()}
+            self.best_eval, self.stale = len(values) - 1, 0
+        else:
+            self.stale += 1
+
+    def early_stop(self, step, cyclic=True, verbose=True):
+        if self.patience > 0 and self.stale >= self.patience:
+            self.stop_reason, self.stop_step = "patience", step
+            if verbose:
+                pref = "Update Step " if cyclic else "Epoch "
+                print(f"Early Stopping @ {pref}{step}")
+            return True
+        return False
+
+    def finish_early_stopping(self, step):
+        """ Records the stop of a completed training and restores the best parameters """
+        if self.stop_reason is None:
+            self.stop_reason, self.stop_step = "completed", step
+        if self.best is not None:
+            self.restore(self.best["net"])
+            self.best = None
+
+    def restore(self, net):
+        """ Copies the parameters of net, a snapshot of this network, into its layers """
+        for layer, saved in zip(self.layers, net.layers):
+            for p in layer.params:
+                getattr(layer, p)[...] = getattr(saved, p)
+            if layer.master is not None:
+                layer.keep_master_copy()
 
-        np.save(
-            f'History/{exp}_layers_{epochs}_{batch_size}_{eta}_{self.lamda}_{self.seed}.npy', self.layers)
+    @staticmethod
+    def backup_name(GDparams, cyclic=True, lamda=None, seed=None):
+        """ Training parameters, lambda and seed identifying a backup """
+        if cyclic:
+            name = f'{GDparams["n_cycles"]}_{GDparams["n_batch"]}_{GDparams["eta_min"]}_{GDparams["eta_max"]}_{GDparams["ns"]}'
+        else:
+            name = f'{GDparams["n_epochs"]}_{GDparams["n_batch"]}_{GDparams["eta"]}'
+        return f'{name}_{lamda}_{seed}'
+
+    def hist(self):
+        """ History and training state saved with the parameters """
+        return {"train_loss": self.train_loss, "train_acc": self.train_acc, "train_cost": self.train_cost,
+                "val_loss": self.val_loss, "val_acc": self.val_acc, "val_cost": self.val_cost,
+                "best_eval": self.best_eval, "stop_reason": self.stop_reason, "stop_step": self.stop_step,
+                "step": self.step}
+
+    def load_hist(self, hist):
+        self.train_acc = hist['train_acc']
+        self.train_loss = hist["train_loss"]
+        self.train_cost = hist["train_cost"]
+        self.val_acc = hist['val_acc']
+        self.val_loss = hist["val_loss"]
+        self.val_cost = hist["val_cost"]
+        self.best_eval, self.stop_reason, self.stop_step = (
+            hist.get(key) for key in ["best_eval", "stop_reason", "stop_step"])
+        self.step = hist.get("step", 0)
+
+    def checkpoint(self):
+        """ Arrays and meta data of the network for save_checkpoint: parameters, BN statistics and
+        optimizer state as arrays, architecture, optimizer hyperparameters and history as meta data """
+        arrays = layer_arrays(self.layers)
+        state, optimizer = optimizer_arrays(self.optimizer.state_dict())
+        arrays.update(state)
+        meta = {"k": self.k, "dims": self.dims, "lamda": self.lamda, "seed": self.seed,
+                "dtype": self.dtype.name, "optimizer": optimizer, "history": self.hist()}
+        return arrays, meta
+
+    def restore_checkpoint(self, arrays, meta):
+        """ Sets the parameters, optimizer and history of the output of load_checkpoint """
+        set_layer_arrays(self.layers, arrays)
+        for layer in self.layers:
+            if layer.master is not None:
+                layer.keep_master_copy()
+        if "optimizer" in meta:
+            self.optimizer = load_optimizer(optimizer_state(meta["optimizer"], arrays))
+        if "history" in meta:
+            self.load_hist(meta["history"])
 
-        hist = {"train_loss": self.train_loss, "train_acc": self.train_acc, "train_cost": self.train_cost,
-                "val_loss": self.val_loss, "val_acc": self.val_acc, "val_cost": self.val_cost}
+    @staticmethod
+    def from_checkpoint(path, mmap_mode=None):
+        """ Network saved in the checkpoint directory path, see checkpoint.load_checkpoint for mmap_mode """
+        arrays, meta = load_checkpoint(path, mmap_mode)
+        mlp = MLP(meta["k"], meta["dims"], meta.get("lamda", 0), meta.get("seed", 42), dtype=meta["dtype"])
+        mlp.restore_checkpoint(arrays, meta)
+        return mlp
 
-        np.save(
-            f'History/{exp}_hist_{epochs}_{batch_size}_{eta}_{self.lamda}_{self.seed}.npy', hist)
+    def backup(self, GDparams):
+        """ Saves networks params in order to be able to reuse it """
+        name = self.backup_name(GDparams, cyclic=False, lamda=self.lamda, seed=self.seed)
+        save_checkpoint(f'History/{GDparams["exp"]}_checkpoint_{name}', *self.checkpoint())
 
     def backup_cyclic(self, GDparams):
         """ Saves networks params in order to be able to reuse it for cyclic learning"""
-
-        n_cycles, batch_size, eta_min, eta_max, ns, exp = GDparams["n_cycles"], GDparams[
-            "n_batch"], GDparams["eta_min"], GDparams["eta_max"], GDparams["ns"], GDparams["exp"]
-
-        np.save(
-            f'History/{exp}_layers_{n_cycles}_{batch_size}_{eta_min}_{eta_max}_{ns}_{self.lamda}_{self.seed}.npy', self.layers)
-
-        hist = {"train_loss": self.train_loss, "train_acc": self.train_acc, "train_cost": self.train_cost,
-                "val_loss": self.val_loss, "val_acc": self.val_acc, "val_cost": self.val_cost}
-
-        np.save(
-            f'History/{exp}_hist_{n_cycles}_{batch_size}_{eta_min}_{eta_max}_{ns}_{self.lamda}_{self.seed}.npy', hist)
+        name = self.backup_name(GDparams, lamda=self.lamda, seed=self.seed)
+        save_checkpoint(f'History/{GDparams["exp"]}_checkpoint_{name}', *self.checkpoint())
 
     def plot_metric(self, GDparams, metric="loss", cyclic=True):
         """ Plots a given metric (loss or accuracy) """
+        import matplotlib.pyplot as plt
 
         if cyclic:
             n_cycles, batch_size, eta_min, eta_max, ns = GDparams["n_cycles"], GDparams[
@@ -307,43 +591,182 @@ class MLP():
         plt.show()
 
     @staticmethod
-    def load_mlp(GDparams, cyclic=True, k=2, dims=[3072, 50, 10], lamda=0, seed=42):
+    def load_mlp(GDparams, cyclic=True, k=2, dims=[3072, 50, 10], lamda=0, seed=42, mmap_mode=None):
+        """ Loads a network saved by backup or backup_cyclic, from its checkpoint directory, the arrays
+        being memory mapped with mmap_mode, or from the pickled files of older backups """
         mlp = MLP(k, dims, lamda, seed)
-        if cyclic:
+        exp, name = GDparams["exp"], MLP.backup_name(GDparams, cyclic, mlp.lamda, mlp.seed)
+        if is_checkpoint(f'History/{exp}_checkpoint_{name}'):
+            mlp.restore_checkpoint(*load_checkpoint(f'History/{exp}_checkpoint_{name}', mmap_mode))
+            return mlp
 
-            n_cycles, batch_size, eta_min, eta_max, ns, exp = GDparams["n_cycles"], GDparams[
-                "n_batch"], GDparams["eta_min"], GDparams["eta_max"], GDparams["ns"], GDparams["exp"]
-            layers = np.load(
-                f'History/{exp}_layers_{n_cycles}_{batch_size}_{eta_min}_{eta_max}_{ns}_{mlp.lamda}_{mlp.seed}.npy', allow_pickle=True)
-            hist = np.load(
-                f'History/{exp}_hist_{n_cycles}_{batch_size}_{eta_min}_{eta_max}_{ns}_{mlp.lamda}_{mlp.seed}.npy', allow_pickle=True)
-        else:
+        mlp.layers = np.load(f'History/{exp}_layers_{name}.npy', allow_pickle=True)
+        optimizer = f'History/{exp}_optimizer_{name}.npy'
+        if os.path.exists(optimizer):
+            mlp.optimizer = load_optimizer(np.load(optimizer, allow_pickle=True).item())
+        mlp.load_hist(np.load(f'History/{exp}_hist_{name}.npy', allow_pickle=True).item())
+
+        return mlp
 
-            epochs, batch_size, eta, exp = GDparams["n_epochs"], GDparams[
-                "n_batch"], GDparams["eta"], GDparams["exp"]
+    
+class Population():
+    """ Networks of the same architecture and initialization but different lambdas (and learning rates),
+    trained together on the same minibatches. The parameters of each layer are stacked in (P, d_out, d_in)
+    arrays: the first layer, whose input is shared, is computed as a single (P d_out, d_in) matmul and the
+    other ones as batched matmuls, which keeps BLAS busy where P separate small networks do not.
+    The updates are plain SGD steps """
+
+    def __init__(self, lamdas, k=2, dims=[3072, 50, 10], seed=42, dtype=np.float64):
+        self.lamdas = np.asarray(lamdas, dtype=np.float64)
+        self.P = len(self.lamdas)
+        self.k, self.dims, self.seed = k, dims, seed
+        self.dtype = np.dtype(dtype)
+        # same initialization as MLP(k, dims, lamda, seed)
+        net = MLP(k, dims, seed=seed, dtype=dtype)
+        self.W = [np.repeat(layer.W[None], self.P, axis=0) for layer in net.layers]
+        self.b = [np.repeat(layer.b[None], self.P, axis=0) for layer in net.layers]
+        self.train_loss, self.val_loss = [], []
+        self.train_cost, self.val_cost = [], []
+        self.train_acc, self.val_acc = [], []
+        self.step = 0
+        self.train_time = 0.
 
-            layers = np.load(
-                f'History/{exp}_layers_{epochs}_{batch_size}_{eta}_{mlp.lamda}_{mlp.seed}.npy', allow_pickle=True)
+    def per_member(self, value):
+        """ Scalar or one value per member, as a (P, 1, 1) array broadcasting over the stacked parameters """
+        return np.broadcast_to(np.asarray(value, dtype=self.dtype), (self.P,)).reshape(self.P, 1, 1)
 
-            hist = np.load(
-                f'History/{exp}_hist_{epochs}_{batch_size}_{eta}_{mlp.lamda}_{mlp.seed}.npy', allow_pickle=True)
+    def forward_pass(self, X):
+        """ Scores of the last layer of every member (P, K, n) and the inputs of the layers """
+        X = X.astype(self.dtype, copy=False)
+        inputs = [X]
+        W = self.W[0]
+        H = (W.reshape(-1, W.shape[2]) @ X).reshape(self.P, W.shape[1], -1) + self.b[0]
+        for W, b in zip(self.W[1:], self.b[1:]):
+            H = np.maximum(0, H)
+            inputs.append(H)
+            H = np.matmul(W, H) + b
+        return H, inputs
+
+    def compute_gradients(self, inputs, S, y):
+        """ Backpropagates the cross entropy of the scores S (P, K, n) against the labels y,
+        returning the gradients of the stacked W and b """
+        nb = S.shape[2]
+        G = np.exp(S - np.max(S, axis=1, keepdims=True))
+        G /= np.sum(G, axis=1, keepdims=True)
+        G[:, y, np.arange(nb)] -= 1
+        lamdas = 2 * self.per_member(self.lamdas)
+        grads_W, grads_b = [], []
+        for i in reversed(range(self.k)):
+            W, input = self.W[i], inputs[i]
+            if i == 0:
+                grad_W = (G.reshape(-1, nb) @ input.T).reshape(W.shape)
+            else:
+                grad_W = np.matmul(G, input.transpose(0, 2, 1))
+            grad_W /= nb
+            grad_W += lamdas * W
+            grads_W.append(grad_W)
+            grads_b.append(np.sum(G, axis=2, keepdims=True) / nb)
+            if i > 0:
+                G = np.matmul(W.transpose(0, 2, 1), G)
+                G *= input > 0
+        return grads_W[::-1], grads_b[::-1]
+
+    def update_parameters(self, grads_W, grads_b, eta):
+        eta = self.per_member(eta)
+        for W, b, grad_W, grad_b in zip(self.W, self.b, grads_W, grads_b):
+            W -= eta * grad_W
+            b -= eta * grad_b
+
+    def cyclic_learning(self, data, GDparams, verbose=True):
+        """ Cyclic learning of all the members as MLP.cyclic_learning does for one of them, eta_min and
+        eta_max being scalars or one value per member """
+        from tqdm import tqdm
+        X, y = data["X_train"], data["y_train"]
 
-        mlp.layers = layers
+        _, n = X.shape
 
-        mlp.train_acc = hist.item()['train_acc']
-        mlp.train_loss = hist.item()["train_loss"]
-        mlp.train_cost = hist.item()["train_cost"]
-        mlp.val_acc = hist.item()['val_acc']
-        mlp.val_loss = hist.item()["val_loss"]
-        mlp.val_cost = hist.item()["val_cost"]
+        n_cycles, batch_size, eta_min, eta_max, ns, freq = GDparams["n_cycles"], GDparams[
+            "n_batch"], GDparams["eta_min"], GDparams["eta_max"], GDparams["ns"], GDparams['freq']
+        eta_min, eta_max = np.asarray(eta_min), np.asarray(eta_max)
+
+        epochs = batch_size * 2 * ns * n_cycles // n
+
+        loader = BatchLoader(X, None, y, batch_size)
+        start_time = time.perf_counter()
+        eta, t = eta_min, 0
+
+        for epoch in tqdm(range(epochs), disable=not verbose):
+            for X_batch, _, y_batch in loader.epoch(seed=epoch):
+
+                S, inputs = self.forward_pass(X_batch)
+                self.update_parameters(*self.compute_gradients(inputs, S, y_batch), eta)
+
+                if t % (2*ns//freq) == 0:
+                    self.history(data, t, verbose, subsample=GDparams.get("eval_subsample"))
+
+                eta = MLP.cyclic_eta(t, eta_min, eta_max, ns)
+
+                t = (t+1) % (2*ns)
+                self.step += 1
+        loader.close()
+        self.train_time += time.perf_counter() - start_time
+
+    def evaluate(self, X, y, chunk_size=5000):
+        """ Loss, cost and accuracy of every member, as (P,) arrays """
+        n = X.shape[1]
+        loss, correct = np.zeros(self.P), np.zeros(self.P)
+        for j in range(0, n, chunk_size):
+            S, _ = self.forward_pass(X[:, j:j+chunk_size])
+            y_chunk = y[j:j+chunk_size]
+            S = S - np.max(S, axis=1, keepdims=True)
+            losses = np.log(np.sum(np.exp(S), axis=1)) - S[:, y_chunk, np.arange(len(y_chunk))]
+            loss += np.sum(losses, axis=1, dtype=np.float64)
+            correct += np.count_nonzero(np.argmax(S, axis=1) == y_chunk, axis=1)
+        loss = loss / n
+        r = sum(np.sum(W.astype(np.float64) ** 2, axis=(1, 2)) for W in self.W)
+        return loss, loss + self.lamdas * r, correct / n
+
+    def history(self, data, step, verbose=True, subsample=None):
+        X, y, X_val, y_val = data["X_train"], data["y_train"], data["X_val"], data["y_val"]
+
+        if subsample is not None and subsample < X.shape[1]:
+            idx = np.sort(np.random.RandomState(self.seed).choice(X.shape[1], subsample, replace=False))
+            X, y = X[:, idx], y[idx]
+
+        t_loss, t_cost, t_acc = self.evaluate(X, y)
+        v_loss, v_cost, v_acc = self.evaluate(X_val, y_val)
+        if verbose:
+            print(f'Update Step {step}: best val_acc={np.max(v_acc)} (lamda={self.lamdas[np.argmax(v_acc)]})')
 
+        self.train_loss.append(t_loss)
+        self.val_loss.append(v_loss)
+        self.train_cost.append(t_cost)
+        self.val_cost.append(v_cost)
+        self.train_acc.append(t_acc)
+        self.val_acc.append(v_acc)
+
+    def member(self, i):
+        """ The i-th member as an MLP holding copies of its parameters and its history """
+        mlp = MLP(self.k, self.dims, float(self.lamdas[i]), self.seed, self.dtype)
+        for layer, W, b in zip(mlp.layers, self.W, self.b):
+            layer.W, layer.b = W[i].copy(), b[i].copy()
+        mlp.load_hist({name: [float(v[i]) for v in getattr(self, name)] for name in
+                       ["train_loss", "train_acc", "train_cost", "val_loss", "val_acc", "val_cost"]})
+        mlp.step = self.step
+        # the population is trained as a whole, every member is charged an equal share of its time
+        mlp.train_time = self.train_time / self.P
         return mlp
 
-    
+    def members(self):
+        return [self.member(i) for i in range(self.P)]
+
+
 class Search():
 
-    def __init__(self, l_min=-5, l_max=-1, n_lambda=20, sample=True, seed=42):
+    def __init__(self, l_min=-5, l_max=-1, n_lambda=20, sample=True, seed=42, store=RESULTS_DB):
         np.random.seed(seed)
+        # SQLite file the trials append their summaries to, None to disable
+        self.store = store
         self.l_min = l_min
         self.l_max = l_max
         self.n_lambda = n_lambda
@@ -358,27 +781,156 @@ class Search():
         lambdas = [10**e for e in exp]
         return lambdas
 
-    def random_search(self, data, GDparams, lamdas=None):
+    def random_search(self, data, GDparams, lamdas=None, n_workers=1, threads=None, verbose=True):
+        """ Trains an MLP per lambda with cyclic learning, on n_workers processes sharing the dataset through fork,
+        each with threads BLAS threads (cpu count // n_workers by default). The results are collected in
+        self.results as the trials finish, a failed trial being recorded with its error, and appended to
+        the results store """
         if lamdas is not None:
             self.lambdas = lamdas
-        for lmda in self.lambdas:
-            mlp = MLP(lamda=lmda)
-            mlp.cyclic_learning(
-                data, GDparams, verbose=False, backup=True)
-
-    def random_search_perf(self, GDparams, lamdas=None):
+        self.results = []
+        trials = [(lmda, _search_trial, (lmda, GDparams, self.store)) for lmda in self.lambdas]
+        for lmda, result in self.run_trials(data, trials, n_workers, threads):
+            if isinstance(result, Exception):
+                result = {"lamda": lmda, "error": repr(result)}
+            self.collect(result, len(trials), verbose)
+        return self.results
+
+    def population_search(self, data, GDparams, lamdas=None, verbose=True):
+        """ Trains the MLPs of all the lambdas at once as a Population, then backs them up and stores
+        their summaries as random_search does """
+        if lamdas is not None:
+            self.lambdas = lamdas
+        population = Population(self.lambdas)
+        population.cyclic_learning(data, GDparams, verbose=False)
+        self.results = []
+        for mlp in population.members():
+            mlp.backup_cyclic(GDparams)
+            summary = mlp.summary(GDparams)
+            if self.store is not None:
+                with ResultsStore(self.store) as results:
+                    results.add(**summary)
+            self.collect(summary, population.P, verbose)
+        return self.results
+
+    def successive_halving(self, data, GDparams, lamdas=None, min_steps=None, reduction=3, n_workers=1,
+                           threads=None, verbose=True):
+        """ Successive halving over the lambdas: every candidate is trained for min_steps updates (one cycle
+        by default), the 1/reduction best ones by validation accuracy are resumed with reduction times more
+        updates, and so on until the survivors reach the end of the n_cycles. The ranking of every rung
+        is kept in self.rungs, and the final networks are backed up as by random_search.
+        Returns the best lambda and its network """
         if lamdas is not None:
             self.lambdas = lamdas
+        n_cycles, ns = GDparams["n_cycles"], GDparams["ns"]
+        total = 2 * ns * n_cycles
+        budget = min(2 * ns if min_steps is None else min_steps, total)
+
+        nets = {lmda: MLP(lamda=lmda) for lmda in self.lambdas}
+        self.rungs = []
+        while nets:
+            final = budget >= total
+            trials = [(lmda, _halving_trial, (mlp, GDparams, None if final else budget - mlp.step, final,
+                                                    self.store))
+                      for lmda, mlp in nets.items()]
+            self.results = []
+            for lmda, result in self.run_trials(data, trials, n_workers, threads):
+                if isinstance(result, Exception):
+                    del nets[lmda]
+                    self.collect({"lamda": lmda, "error": repr(result)}, len(trials), verbose)
+                    continue
+                nets[lmda], metrics = result
+                self.collect({"lamda": lmda, **metrics}, len(trials), verbose)
+
+            ranking = sorted((r for r in self.results if "error" not in r), key=lambda r: -r["val_acc"])
+            self.rungs.append({"steps": budget, "ranking": ranking})
+            if verbose:
+                print(f"Rung {len(self.rungs)}: {len(ranking)} candidates after {budget} steps")
+                self.print_ranking(ranking)
+            if final or not ranking:
+                break
+
+            keep = max(1, len(ranking) // reduction)
+            nets = {r["lamda"]: nets[r["lamda"]] for r in ranking[:keep]}
+            budget = total if keep == 1 else min(budget * reduction, total)
+
+        best = self.rungs[-1]["ranking"][0]["lamda"] if ranking else None
+        return best, nets.get(best)
+
+    def run_trials(self, data, trials, n_workers=1, threads=None):
+        """ Runs the trials, (key, function, args) tuples, on n_workers processes and yields the (key, result)
+        pairs as they finish, result being the exception raised by a failed trial """
+        if n_workers == 1:
+            _search["data"] = data
+            try:
+                for key, fn, args in trials:
+                    try:
+                        result = fn(*args)
+                    except Exception as e:
+                        result = e
+                    yield key, result
+            finally:
+                _search.clear()
+            return
+
+        if threads is None:
+            threads = max(1, os.cpu_count() // n_workers)
+        ctx = mp.get_context("fork" if "fork" in mp.get_all_start_methods() else "spawn")
+        with ProcessPoolExecutor(n_workers, mp_context=ctx, initializer=_init_search_worker,
+                                 initargs=(data, threads)) as pool:
+            futures = {pool.submit(fn, *args): key for key, fn, args in trials}
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = e
+                yield futures[future], result
+
+    def collect(self, result, n_trials, verbose=True):
+        """ Records the result of a finished trial """
+        self.results.append(result)
+        if verbose:
+            if "error" in result:
+                print(f'lamda={result["lamda"]} failed: {result["error"]}')
+            else:
+                print(f'[{len(self.results)}/{n_trials}] lamda={result["lamda"]} | '
+                      f'train_acc={result["train_acc"]} | val_acc={result["val_acc"]}')
+
+    @staticmethod
+    def print_ranking(results):
+        """ Prints lambda, train and validation accuracies as LaTeX table rows, best validation accuracy first """
         models = defaultdict(list)
-        for lmda in self.lambdas:
-            model = MLP.load_mlp(GDparams, cyclic=True, lamda=lmda)
-            models[model.val_acc[-1]*100
-                ].append({"lamda": round(lmda,7), "train_acc": round(model.train_acc[-1]*100, 5)})
+        for result in results:
+            models[result["val_acc"]*100
+                ].append({"lamda": round(result["lamda"],7), "train_acc": round(result["train_acc"]*100, 5)})
         for acc in sorted(models.keys(), reverse=True):
             for v in models[acc]:
                 print(f'{v["lamda"]} & {v["train_acc"]} & {round(acc,5)} \\\\')
-        
 
-
-
- 
+    def random_search_perf(self, GDparams, lamdas=None):
+        """ Prints the ranking of the lambdas, from the results store when it has all of them,
+        from the backed up histories otherwise """
+        if lamdas is not None:
+            self.lambdas = lamdas
+        results = self.stored_results(GDparams)
+        if results is None:
+            results = []
+            for lmda in self.lambdas:
+                model = MLP.load_mlp(GDparams, cyclic=True, lamda=lmda)
+                results.append({"lamda": lmda, "train_acc": model.train_acc[-1], "val_acc": model.val_acc[-1]})
+        self.print_ranking(results)
+
+    def stored_results(self, GDparams, seed=42, **params):
+        """ Latest stored summary of every lambda trained with GDparams and the network params,
+        None if the store misses some of them """
+        if self.store is None or not os.path.exists(self.store):
+            return None
+        with ResultsStore(self.store) as store:
+            rows = store.query(order_by="id", descending=False, exp=GDparams["exp"], seed=seed,
+                               n_cycles=GDparams["n_cycles"], n_batch=GDparams["n_batch"], eta_min=GDparams["eta_min"],
+                               eta_max=GDparams["eta_max"], ns=GDparams["ns"], lamda=list(self.lambdas))
+        latest = {row["lamda"]: row for row in rows
+                  if all(json.loads(row["params"]).get(key) == value for key, value in params.items())}
+        if not all(lmda in latest for lmda in self.lambdas):
+            return None
+        return [latest[lmda] for lmda in self.lambdas]
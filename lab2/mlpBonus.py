@@ -1,19 +1,27 @@
 
-from collections import Counter
-from sklearn.utils import shuffle
-import matplotlib.pyplot as plt
-from sklearn.metrics import accuracy_score
+import copy
+import os
 import numpy as np
-from tqdm import tqdm
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from utils import Augmenter, BatchLoader, cross_entropy, cross_entropy_grad, labels
+from optimizers import SGD, load_optimizer
+from checkpoint import (is_checkpoint, layer_arrays, load_checkpoint, optimizer_arrays, optimizer_state,
+                        save_checkpoint, set_layer_arrays)
 
 
 def softmax(x):
-    """ Standard definition of the softmax function """
-    return np.exp(x) / np.sum(np.exp(x), axis=0)
+    """ Standard definition of the softmax function, shifted by the column max for stability """
+    e = np.exp(x - np.max(x, axis=0))
+    e /= np.sum(e, axis=0)
+    return e
+
+
 
 
 class Layer():
+    params = ["W", "b"]
+
     def __init__(self, d_in, d_out, W, b, grad_W, grad_b, x):
         self.d_in = d_in
         self.d_out = d_out
@@ -23,9 +31,14 @@ class Layer():
         self.grad_b = grad_b
         self.input = input
 
+    def apply_update(self, p, delta):
+        """ Subtracts delta from parameter p in place """
+        param = getattr(self, p)
+        param -= delta
+
 
 class MLP():
-    def __init__(self, k=2, dims=[3072, 50, 10], lamda=0, seed=42) -> None:
+    def __init__(self, k=2, dims=[3072, 50, 10], lamda=0, seed=42, optimizer=None) -> None:
         np.random.seed(seed)
         self.seed = seed
         self.k = k
@@ -40,27 +53,35 @@ class MLP():
         self.train_loss, self.val_loss = [], []
         self.train_cost, self.val_cost = [], []
         self.train_acc, self.val_acc = [], []
+        self.evaluator, self.pending = None, []
         self.etas = []
+        self.optimizer = optimizer if optimizer is not None else SGD()
 
-    def forward_pass(self, X):
+    def forward_pass(self, X, logits=False):
+        """ Returns the class probabilities, or the scores of the last layer if logits """
         input = X.copy()
-        for layer in self.layers:
-            layer.input = input.copy()
+        for layer in self.layers[:-1]:
+            layer.input = input
             input = np.maximum(
                 0, layer.W @ layer.input + layer.b)
-        return softmax(layer.W @ layer.input + layer.b)
+        layer = self.layers[-1]
+        layer.input = input
+        scores = layer.W @ layer.input + layer.b
+        return scores if logits else softmax(scores)
 
     def compute_cost(self, X, Y):
-        """ Computes the cost function: cross entropy loss + L2 regularization """
-        P = self.forward_pass(X)
-        loss = np.log(np.sum(np.multiply(Y, P), axis=0))
-        loss = - np.sum(loss)/X.shape[1]
+        """ Computes the cost function: cross entropy loss + L2 regularization.
+        Y can be one hot encoded (K, n) or integer labels (n,) """
+        loss, _ = cross_entropy(self.forward_pass(X, logits=True), labels(Y))
+        loss = np.sum(loss)/X.shape[1]
         r = np.sum([np.linalg.norm(layer.W) ** 2 for layer in self.layers])
         cost = loss + self.lamda * r
         return loss, cost
 
     def compute_gradients(self, X, Y, P):
-        G = - (Y - P)
+        """ Backpropagates the cross entropy of the probabilities P (overwritten)
+        against the labels Y, one hot encoded or integers """
+        G = cross_entropy_grad(P, labels(Y))
         nb = X.shape[1]
 
         for layer in reversed(self.layers):
@@ -72,9 +93,7 @@ class MLP():
             G = np.multiply(G, np.heaviside(layer.input, 0))
 
     def update_parameters(self, eta=1e-2):
-        for layer in self.layers:
-            layer.W -= eta * layer.grad_W
-            layer.b -= eta * layer.grad_b
+        self.optimizer.step(self.layers, eta)
 
     def compute_gradients_num(self, X_batch, Y_batch, h=1e-5):
         """ Numerically computes the gradients of the weight and bias parameters
@@ -142,43 +161,45 @@ class MLP():
         """ Computes the prediction accuracy of a given state of the network """
         P = self.forward_pass(X)
         y_pred = np.argmax(P, axis=0)
-        return accuracy_score(y, y_pred)
+        return np.mean(y_pred == y)
 
-    def mini_batch_gd(self, data, GDparams, verbose=True, backup=False):
+    def mini_batch_gd(self, data, GDparams, verbose=True, backup=False, async_history=False):
         """ Performas minibatch gradient descent """
+        from tqdm import tqdm
+        self.start_evaluator(async_history)
 
         X, Y, y = data["X_train"], data["Y_train"], data["y_train"]
 
-        _, n = X.shape
-
         epochs, batch_size, eta = GDparams["n_epochs"], GDparams["n_batch"], GDparams["eta"]
 
-        self.history(data, 0, verbose, cyclic=False)
-
-        for epoch in tqdm(range(epochs)):
+        self.history(data, 0, verbose, cyclic=False, subsample=GDparams.get("eval_subsample"))
 
-            X, Y, y = shuffle(X.T, Y.T, y.T, random_state=epoch)
-            X, Y, y = X.T, Y.T, y.T
+        loader = BatchLoader(X, None, y, batch_size)
 
-            for j in range(n//batch_size):
-                j_start = j * batch_size
-                j_end = (j+1) * batch_size
-                X_batch = X[:, j_start:j_end]
-                Y_batch = Y[:, j_start:j_end]
+        for epoch in tqdm(range(epochs)):
+            for X_batch, _, y_batch in loader.epoch(seed=epoch):
 
                 P_batch = self.forward_pass(X_batch)
 
-                self.compute_gradients(X_batch, Y_batch, P_batch)
+                self.compute_gradients(X_batch, y_batch, P_batch)
 
                 self.update_parameters(eta)
 
-            self.history(data, epoch, verbose, cyclic=False)
+            self.history(data, epoch, verbose, cyclic=False, subsample=GDparams.get("eval_subsample"))
+
+        loader.close()
+        self.stop_evaluator(verbose)
 
         if backup:
             self.backup(GDparams)
 
-    def cyclic_learning(self, data, GDparams, verbose=True, backup=False, jitter=False):
-        """ Performas minibatch gradient descent """
+    def cyclic_learning(self, data, GDparams, verbose=True, backup=False, async_history=False, jitter=False,
+                        ensemble=None):
+        """ Performas minibatch gradient descent on batches augmented by jitter, an Augmenter (True for noise on
+        half of the samples). With exp "ensemble_learning" the network at the end of each cycle is added
+        to ensemble if given, else saved with backup_cyclic """
+        from tqdm import tqdm
+        self.start_evaluator(async_history)
         X, Y, y = data["X_train"], data["Y_train"], data["y_train"]
 
         _, n = X.shape
@@ -191,30 +212,20 @@ class MLP():
 
         epochs = batch_size * 2 * ns * n_cycles // n
 
+        if jitter is True:
+            jitter = Augmenter(noise=0.5)
+        loader = BatchLoader(X, None, y, batch_size, augment=jitter or None)
+
         for epoch in tqdm(range(epochs)):
+            for X_batch, _, y_batch in loader.epoch(seed=epoch):
 
-            X, Y, y = shuffle(X.T, Y.T, y.T, random_state=epoch)
-            X, Y, y = X.T, Y.T, y.T
-
-            for j in range(n//batch_size):
-                j_start = j * batch_size
-                j_end = (j+1) * batch_size
-                X_batch = X[:, j_start:j_end]
-                Y_batch = Y[:, j_start:j_end]
-                X_batch_copy = X_batch.copy()
-                
-                if jitter and np.random.random() > 0.5:
-                    X_batch = self.random_jitter(X_batch, flip=0)
-                
                 P_batch = self.forward_pass(X_batch)
 
-                self.compute_gradients(X_batch, Y_batch, P_batch)
+                self.compute_gradients(X_batch, y_batch, P_batch)
                 self.update_parameters(eta)
 
-                X_batch = X_batch_copy
-
                 if t % (2*ns/freq) == 0:
-                    self.history(data, t, verbose)
+                    self.history(data, t, verbose, subsample=GDparams.get("eval_subsample"))
 
                 if t <= ns:
                     eta = eta_min + t/ns * (eta_max - eta_min)
@@ -223,24 +234,80 @@ class MLP():
 
                 t = (t+1) % (2*ns)
                 if t == 0 and exp == "ensemble_learning":
+                    if ensemble is not None:
+                        ensemble.add(self)
+                    else:
+                        self.backup_cyclic(GDparams, cycle=c)
                     if verbose:
-                        print(f"Cycle {c} saved")
-                    self.backup_cyclic(GDparams, cycle=c)
+                        print(f"Cycle {c} {'added' if ensemble is not None else 'saved'}")
                     c += 1
+        loader.close()
+        self.stop_evaluator(verbose)
+
         if backup:
             self.backup_cyclic(GDparams)
 
-    def history(self, data, epoch, verbose=True, cyclic=True):
-        """ Creates history of the training """
-
-        X, Y, y, X_val, Y_val, y_val = data["X_train"], data["Y_train"], data[
-            "y_train"], data["X_val"], data["Y_val"], data["y_val"]
+    def evaluate(self, X, y, chunk_size=5000):
+        """ Computes loss, cost and accuracy with a single forward pass, made over chunks
+        of columns so that the peak memory does not grow with the number of samples """
+        n = X.shape[1]
+        loss, correct = 0., 0
+        for j in range(0, n, chunk_size):
+            S = self.forward_pass(X[:, j:j+chunk_size], logits=True)
+            losses, _ = cross_entropy(S, y[j:j+chunk_size])
+            loss += np.sum(losses, dtype=np.float64)
+            correct += np.count_nonzero(np.argmax(S, axis=0) == y[j:j+chunk_size])
+        loss = loss / n
+        r = np.sum([np.linalg.norm(layer.W) ** 2 for layer in self.layers])
+        cost = loss + self.lamda * r
+        return loss, cost, correct / n
 
-        t_loss, t_cost = self.compute_cost(X, Y)
-        v_loss, v_cost = self.compute_cost(X_val, Y_val)
+    def eval_subset(self, n, subsample):
+        """ Fixed random subset of the training set used for the train-side metrics """
+        return np.sort(np.random.RandomState(self.seed).choice(n, subsample, replace=False))
 
-        t_acc = self.compute_accuracy(X, y)
-        v_acc = self.compute_accuracy(X_val, y_val)
+    def snapshot(self):
+        """ Copy of the network holding its own copies of the parameters, cheap enough to be
+        taken at every history step and evaluated while the original keeps training """
+        net = copy.copy(self)
+        net.layers = []
+        for layer in self.layers:
+            clone = copy.copy(layer)
+            for p in layer.params:
+                setattr(clone, p, getattr(layer, p).copy())
+            net.layers.append(clone)
+        net.evaluator, net.pending = None, []
+        return net
+
+    def history(self, data, epoch, verbose=True, cyclic=True, subsample=None):
+        """ Creates history of the training, the train metrics being computed on a fixed
+        subset of subsample columns if given. When an evaluator is running, the metrics of a
+        snapshot are computed in the background and recorded in step order by collect_history """
+
+        if self.evaluator is None:
+            self.record_history(epoch, cyclic, self.history_metrics(data, subsample), verbose)
+            return
+
+        # backpressure: never let more than two evaluations queue behind training
+        if len(self.pending) >= 2:
+            self.pending[0][2].result()
+        self.pending.append((epoch, cyclic, self.evaluator.submit(
+            self.snapshot().history_metrics, data, subsample)))
+        self.collect_history(verbose)
+
+    def history_metrics(self, data, subsample=None):
+        X, y, X_val, y_val = data["X_train"], data["y_train"], data["X_val"], data["y_val"]
+
+        if subsample is not None and subsample < X.shape[1]:
+            idx = self.eval_subset(X.shape[1], subsample)
+            X, y = X[:, idx], y[idx]
+
+        t_loss, t_cost, t_acc = self.evaluate(X, y)
+        v_loss, v_cost, v_acc = self.evaluate(X_val, y_val)
+        return t_loss, t_cost, t_acc, v_loss, v_cost, v_acc
+
+    def record_history(self, epoch, cyclic, metrics, verbose=True):
+        t_loss, t_cost, t_acc, v_loss, v_cost, v_acc = metrics
 
         if verbose:
             pref = "Update Step " if cyclic else "Epoch "
@@ -254,19 +321,65 @@ class MLP():
         self.train_acc.append(t_acc)
         self.val_acc.append(v_acc)
 
+    def start_evaluator(self, async_history):
+        if async_history:
+            self.evaluator = ThreadPoolExecutor(max_workers=1)
+
+    def collect_history(self, verbose=True, wait=False):
+        """ Records the finished background evaluations in step order, waiting for all of them if asked """
+        while self.pending and (wait or self.pending[0][2].done()):
+            epoch, cyclic, future = self.pending.pop(0)
+            self.record_history(epoch, cyclic, future.result(), verbose)
+
+    def stop_evaluator(self, verbose=True):
+        if self.evaluator is not None:
+            self.collect_history(verbose, wait=True)
+            self.evaluator.shutdown()
+            self.evaluator = None
+
+    def restore(self, net):
+        """ Copies the parameters of net, a snapshot of this network, into its layers """
+        for layer, saved in zip(self.layers, net.layers):
+            for p in layer.params:
+                getattr(layer, p)[...] = getattr(saved, p)
+
+    def hist(self):
+        """ History saved with the parameters """
+        return {"train_loss": self.train_loss, "train_acc": self.train_acc, "train_cost": self.train_cost,
+                "val_loss": self.val_loss, "val_acc": self.val_acc, "val_cost": self.val_cost}
+
+    def load_hist(self, hist):
+        self.train_acc = hist['train_acc']
+        self.train_loss = hist["train_loss"]
+        self.train_cost = hist["train_cost"]
+        self.val_acc = hist['val_acc']
+        self.val_loss = hist["val_loss"]
+        self.val_cost = hist["val_cost"]
+
+    def checkpoint(self):
+        """ Arrays and meta data of the network for save_checkpoint """
+        arrays = layer_arrays(self.layers)
+        state, optimizer = optimizer_arrays(self.optimizer.state_dict())
+        arrays.update(state)
+        meta = {"k": self.k, "dims": self.dims, "lamda": self.lamda, "seed": self.seed,
+                "optimizer": optimizer, "history": self.hist()}
+        return arrays, meta
+
+    def restore_checkpoint(self, arrays, meta):
+        """ Sets the parameters, optimizer and history of the output of load_checkpoint """
+        set_layer_arrays(self.layers, arrays)
+        if "optimizer" in meta:
+            self.optimizer = load_optimizer(optimizer_state(meta["optimizer"], arrays))
+        if "history" in meta:
+            self.load_hist(meta["history"])
+
     def backup(self, GDparams):
         """ Saves networks params in order to be able to reuse it """
 
         epochs, batch_size, eta, exp = GDparams["n_epochs"], GDparams["n_batch"], GDparams["eta"], GDparams["exp"]
 
-        np.save(
-            f'History/{exp}_layers_{epochs}_{batch_size}_{eta}_{self.lamda}_{self.seed}.npy', self.layers)
-
-        hist = {"train_loss": self.train_loss, "train_acc": self.train_acc, "train_cost": self.train_cost,
-                "val_loss": self.val_loss, "val_acc": self.val_acc, "val_cost": self.val_cost}
-
-        np.save(
-            f'History/{exp}_hist_{epochs}_{batch_size}_{eta}_{self.lamda}_{self.seed}.npy', hist)
+        save_checkpoint(
+            f'History/{exp}_checkpoint_{epochs}_{batch_size}_{eta}_{self.lamda}_{self.seed}', *self.checkpoint())
 
     def backup_cyclic(self, GDparams, cycle=-1):
         """ Saves networks params in order to be able to reuse it for cyclic learning"""
@@ -274,17 +387,12 @@ class MLP():
         n_cycles, batch_size, eta_min, eta_max, ns, exp = GDparams["n_cycles"], GDparams[
             "n_batch"], GDparams["eta_min"], GDparams["eta_max"], GDparams["ns"], GDparams["exp"]
 
-        np.save(
-            f'History/{exp}_layers_{n_cycles}_{cycle}_{batch_size}_{eta_min}_{eta_max}_{ns}_{self.lamda}_{self.seed}.npy', self.layers)
-
-        hist = {"train_loss": self.train_loss, "train_acc": self.train_acc, "train_cost": self.train_cost,
-                "val_loss": self.val_loss, "val_acc": self.val_acc, "val_cost": self.val_cost}
-
-        np.save(
-            f'History/{exp}_hist_{n_cycles}_{cycle}_{batch_size}_{eta_min}_{eta_max}_{ns}_{self.lamda}_{self.seed}.npy', hist)
+        save_checkpoint(
+            f'History/{exp}_checkpoint_{n_cycles}_{cycle}_{batch_size}_{eta_min}_{eta_max}_{ns}_{self.lamda}_{self.seed}', *self.checkpoint())
 
     def plot_metric(self, GDparams, metric="loss", cyclic=True):
         """ Plots a given metric (loss or accuracy) """
+        import matplotlib.pyplot as plt
 
         if cyclic:
             n_cycles, batch_size, eta_min, eta_max, ns = GDparams["n_cycles"], GDparams[
@@ -323,51 +431,92 @@ class MLP():
         plt.show()
 
     @staticmethod
-    def load_mlp(GDparams, cyclic=True, k=2, dims=[3072, 50, 10], lamda=0, seed=42, cycle=-1):
+    def load_mlp(GDparams, cyclic=True, k=2, dims=[3072, 50, 10], lamda=0, seed=42, cycle=-1, mmap_mode=None):
+        """ Loads a network saved by backup or backup_cyclic, from its checkpoint directory, the arrays
+        being memory mapped with mmap_mode, or from the pickled files of older backups """
         mlp = MLP(k, dims, lamda, seed)
         if cyclic:
             n_cycles, batch_size, eta_min, eta_max, ns, exp = GDparams["n_cycles"], GDparams[
                 "n_batch"], GDparams["eta_min"], GDparams["eta_max"], GDparams["ns"], GDparams["exp"]
-            layers = np.load(
-                f'History/{exp}_layers_{n_cycles}_{cycle}_{batch_size}_{eta_min}_{eta_max}_{ns}_{mlp.lamda}_{mlp.seed}.npy', allow_pickle=True)
-            hist = np.load(
-                f'History/{exp}_hist_{n_cycles}_{cycle}_{batch_size}_{eta_min}_{eta_max}_{ns}_{mlp.lamda}_{mlp.seed}.npy', allow_pickle=True)
+            name = f'{n_cycles}_{cycle}_{batch_size}_{eta_min}_{eta_max}_{ns}_{mlp.lamda}_{mlp.seed}'
         else:
-
             epochs, batch_size, eta, exp = GDparams["n_epochs"], GDparams[
                 "n_batch"], GDparams["eta"], GDparams["exp"]
+            name = f'{epochs}_{batch_size}_{eta}_{mlp.lamda}_{mlp.seed}'
 
-            layers = np.load(
-                f'History/{exp}_layers_{epochs}_{batch_size}_{eta}_{mlp.lamda}_{mlp.seed}.npy', allow_pickle=True)
-
-            hist = np.load(
-                f'History/{exp}_hist_{epochs}_{batch_size}_{eta}_{mlp.lamda}_{mlp.seed}.npy', allow_pickle=True)
-
-        mlp.layers = layers
+        if is_checkpoint(f'History/{exp}_checkpoint_{name}'):
+            mlp.restore_checkpoint(*load_checkpoint(f'History/{exp}_checkpoint_{name}', mmap_mode))
+            return mlp
 
-        mlp.train_acc = hist.item()['train_acc']
-        mlp.train_loss = hist.item()["train_loss"]
-        mlp.train_cost = hist.item()["train_cost"]
-        mlp.val_acc = hist.item()['val_acc']
-        mlp.val_loss = hist.item()["val_loss"]
-        mlp.val_cost = hist.item()["val_cost"]
+        mlp.layers = np.load(f'History/{exp}_layers_{name}.npy', allow_pickle=True)
+        optimizer = f'History/{exp}_optimizer_{name}.npy'
+        if os.path.exists(optimizer):
+            mlp.optimizer = load_optimizer(np.load(optimizer, allow_pickle=True).item())
+        mlp.load_hist(np.load(f'History/{exp}_hist_{name}.npy', allow_pickle=True).item())
 
         return mlp
 
     @staticmethod
-    def majority_voting(X, y, GDparams, n_cycle=3, lamda=0.1):
-
-        predictions = []
-        for c in range(n_cycle):
-            model = MLP.load_mlp(GDparams, cyclic=True, cycle=c, lamda=lamda)
-            P = model.forward_pass(X)
-            predictions.append(np.argmax(P, axis=0))
-        predictions = np.array(predictions)
-        majority_voting_class = [Counter(predictions[:, i]).most_common(1)[
-            0][0] for i in range(X.shape[1])]
-        return majority_voting_class, accuracy_score(y, majority_voting_class)
+    def majority_voting(X, y, GDparams, n_cycle=3, lamda=0.1, soft=False):
+        """ Predictions and accuracy of the networks saved at the end of the first n_cycle cycles """
+        ensemble = Ensemble.load(GDparams, n_cycle, lamda=lamda)
+        classes = ensemble.predict(X, soft=soft)
+        return classes, np.mean(classes == y)
+
+    def lr_finder(self, data, batch_size=100, eta_min=1e-7, eta_max=10., n_steps=100, beta=0.98, divergence=4.,
+                  drop=0.05, verbose=True):
+        """ Learning rate range test: eta grows exponentially from eta_min to eta_max over n_steps updates
+        while the minibatch loss is tracked with a bias corrected exponential moving average (beta), no
+        evaluation on the full sets involved. The test stops as soon as the smoothed loss exceeds divergence
+        times its minimum or is not finite, and the parameters and optimizer are restored afterwards.
+        Returns the suggested bounds of cyclic_learning as a dict to update GDparams with, eta_max being a
+        tenth of the eta of the lowest loss and eta_min the eta at which the loss has dropped by the fraction drop
+        (at most eta_max / 4), along with the etas and the smoothed losses """
+        X, y = data["X_train"], data["y_train"]
+        etas = eta_min * (eta_max / eta_min) ** (np.arange(n_steps) / max(n_steps - 1, 1))
+        net, optimizer = self.snapshot(), self.optimizer
+        self.optimizer = copy.deepcopy(optimizer)
+        loader = BatchLoader(X, None, y, batch_size)
+        losses, avg, best = [], 0., np.inf
+        try:
+            for step, eta in enumerate(etas):
+                # the test is meant to take a fraction of an epoch, longer ones go on with the next permutation
+                if step % len(loader) == 0:
+                    batches = loader.epoch(seed=step // len(loader))
+                X_batch, _, y_batch = next(batches)
+                P_batch = self.forward_pass(X_batch)
+                p_label = P_batch[y_batch, np.arange(len(y_batch))]
+                loss = -np.mean(np.log(np.maximum(p_label, np.finfo(P_batch.dtype).tiny)))
+                self.compute_gradients(X_batch, y_batch, P_batch)
+                self.update_parameters(eta)
+
+                avg = beta * avg + (1 - beta) * loss
+                smoothed = avg / (1 - beta ** (step + 1))
+                losses.append(smoothed)
+                best = min(best, smoothed)
+                if not np.isfinite(smoothed) or smoothed > divergence * best:
+                    if verbose:
+                        print(f"Diverged at step {step}, eta={eta:.3g}")
+                    break
+        finally:
+            loader.close()
+            self.restore(net)
+            self.optimizer = optimizer
+
+        etas = etas[:len(losses)]
+        losses = np.array(losses)
+        i = int(np.nanargmin(np.where(np.isfinite(losses), losses, np.nan)))
+        suggested_max = float(etas[i]) / 10
+        # the drop is measured from a tenth of the test on, the first averages being those of a few batches
+        warmup = min(len(losses) // 10, i)
+        started = np.nonzero(losses[warmup:i+1] < (1 - drop) * losses[warmup])[0]
+        suggested_min = min(float(etas[warmup + started[0]]) if len(started) else suggested_max / 4, suggested_max / 4)
+        if verbose:
+            print(f"Lowest loss {losses[i]:.4f} at eta={etas[i]:.3g}: eta_min={suggested_min:.3g}, eta_max={suggested_max:.3g}")
+        return {"eta_min": suggested_min, "eta_max": suggested_max}, etas, losses
 
     def lr_range_test(self, data, GDparams, freq=20):
+        from tqdm import tqdm
 
         X, Y, y, X_val, y_val = data["X_train"], data["Y_train"], data["y_train"], data["X_val"], data["y_val"],
 
@@ -383,20 +532,14 @@ class MLP():
         v_acc = self.compute_accuracy(X_val, y_val)
         self.val_acc.append(v_acc)
 
-        for epoch in tqdm(range(epochs)):
-
-            X, Y, y = shuffle(X.T, Y.T, y.T, random_state=epoch)
-            X, Y, y = X.T, Y.T, y.T
+        loader = BatchLoader(X, None, y, batch_size)
 
-            for j in range(n//batch_size):
-                j_start = j * batch_size
-                j_end = (j+1) * batch_size
-                X_batch = X[:, j_start:j_end]
-                Y_batch = Y[:, j_start:j_end]
+        for epoch in tqdm(range(epochs)):
+            for j, (X_batch, _, y_batch) in enumerate(loader.epoch(seed=epoch)):
 
                 P_batch = self.forward_pass(X_batch)
 
-                self.compute_gradients(X_batch, Y_batch, P_batch)
+                self.compute_gradients(X_batch, y_batch, P_batch)
 
                 self.update_parameters(eta)
                 if j % freq == 0:
@@ -406,10 +549,12 @@ class MLP():
                     v_acc = self.compute_accuracy(X_val, y_val)
                     self.val_acc.append(v_acc)
 
+        loader.close()
         return etas, self.val_acc
 
     @staticmethod
     def plot_accuracies(etas, accuracies, lamda, h, metric="Accuracy"):
+        import matplotlib.pyplot as plt
         plt.plot(etas, accuracies)
         plt.xlabel("Learning Rate")
         plt.ylabel(metric)
@@ -417,21 +562,76 @@ class MLP():
         plt.legend()
         plt.savefig(f'History/boundaries_{lamda}_{h}.png')
         plt.show()
-    
+
+
+class Ensemble():
+    """ Networks of the same architecture evaluated together: the parameters of each layer are stacked
+    in (n_members, d_out, d_in) arrays so that a forward pass is one batched matmul per layer """
+
+    def __init__(self, nets=()):
+        self.W, self.b = [], []
+        self.n_members = 0
+        for net in nets:
+            self.add(net)
+
+    def add(self, net):
+        """ Adds a copy of the parameters of net """
+        if self.n_members == 0:
+            self.W = [layer.W[None].copy() for layer in net.layers]
+            self.b = [layer.b[None].copy() for layer in net.layers]
+        else:
+            self.W = [np.concatenate([W, layer.W[None]]) for W, layer in zip(self.W, net.layers)]
+            self.b = [np.concatenate([b, layer.b[None]]) for b, layer in zip(self.b, net.layers)]
+        self.n_members += 1
+
+    @staticmethod
+    def load(GDparams, n_cycle=3, k=2, dims=[3072, 50, 10], lamda=0, seed=42):
+        """ Ensemble of the networks saved by backup_cyclic at the end of the first n_cycle cycles """
+        return Ensemble(MLP.load_mlp(GDparams, cyclic=True, k=k, dims=dims, lamda=lamda, seed=seed,
+                                     cycle=c, mmap_mode="r") for c in range(n_cycle))
+
+    def scores(self, X):
+        """ Scores of the last layer of every member (n_members, K, n) """
+        H = X
+        for W, b in zip(self.W[:-1], self.b[:-1]):
+            H = np.maximum(0, np.matmul(W, H) + b)
+        return np.matmul(self.W[-1], H) + self.b[-1]
+
+    def vote(self, S):
+        """ Majority vote of the members on the scores S, vectorized over the columns: the votes are counted
+        with a single bincount and ties go to the class voted first, as Counter.most_common does """
+        m, K, n = S.shape
+        votes = np.argmax(S, axis=1)
+        cols = np.arange(n)
+        counts = np.bincount((cols * K + votes).ravel(), minlength=n * K).reshape(n, K)
+        first = np.full((n, K), m)
+        for i in reversed(range(m)):
+            first[cols, votes[i]] = i
+        return np.argmax(counts * (m + 1) - first, axis=1)
+
+    def predict(self, X, soft=False, chunk_size=5000):
+        """ Predicted classes by majority voting, or by averaging the class probabilities if soft,
+        computed over chunks of columns so that the peak memory does not grow with the number of samples """
+        n = X.shape[1]
+        classes = np.empty(n, dtype=np.int64)
+        for j in range(0, n, chunk_size):
+            S = self.scores(X[:, j:j+chunk_size])
+            if soft:
+                classes[j:j+chunk_size] = np.argmax(self.probabilities(S), axis=0)
+            else:
+                classes[j:j+chunk_size] = self.vote(S)
+        return classes
+
     @staticmethod
-    def random_jitter(X, flip=0, sigma=1):
-        X_jitter = np.copy(X) 
-        noise = np.random.normal(0, sigma, (X.shape))
-        X_jitter += noise
-        mean, std = np.mean(X_jitter, axis=1), np.std(X_jitter, axis = 1)
-        X_jitter -= np.outer(mean, np.ones(X_jitter.shape[1]))
-        X_jitter /= np.outer(std, np.ones(X.shape[1]))
-        d, n_batch = X.shape
-        if flip > 0.5:
-            X_jitter = X_jitter.reshape(n_batch, 3, 32, 32).transpose(0, 2, 3, 1)
-            X_jitter = np.array([np.fliplr(X_jitter[i]) for i in range(n_batch)])
-            X_jitter = X_jitter.reshape((d, n_batch))
-        return X_jitter
+    def probabilities(S):
+        """ Class probabilities averaged over the members """
+        P = np.exp(S - np.max(S, axis=1, keepdims=True))
+        P /= np.sum(P, axis=1, keepdims=True)
+        return np.mean(P, axis=0)
+
+    def compute_accuracy(self, X, y, soft=False, chunk_size=5000):
+        return np.mean(self.predict(X, soft, chunk_size) == y)
+
 
 class Search():
     
@@ -0,0 +1,112 @@
+""" Optimizers of the MLP: they keep a state per layer parameter (W, b, and gamma, beta for BN layers)
+and update the parameters in place through Layer.apply_update """
+import numpy as np
+
+
+class Optimizer():
+    """ Subclasses define delta(state, grad, eta, out), the step to subtract from a parameter, computed
+    in place in its state buffers and written to out """
+    # state buffers kept for every parameter, shaped like its gradient
+    slots = []
+    hyperparams = []
+
+    def __init__(self):
+        self.t = 0
+        self.state = {}
+        # scratch buffer of every parameter receiving its step, never saved
+        self.scratch = {}
+
+    def buffers(self, i, p, grad):
+        """ State and scratch buffer of the parameter p of the i-th layer, created at the first step """
+        key = f"{i}.{p}"
+        if key not in self.state:
+            self.state[key] = {slot: np.zeros_like(grad) for slot in self.slots}
+        if key not in self.scratch:
+            self.scratch[key] = np.empty_like(grad)
+        return self.state[key], self.scratch[key]
+
+    def step(self, layers, eta):
+        """ Updates the parameters of the layers from their gradients with learning rate eta """
+        self.t += 1
+        for i, layer in enumerate(layers):
+            for p in layer.params:
+                grad = getattr(layer, "grad_" + p)
+                state, out = self.buffers(i, p, grad)
+                layer.apply_update(p, self.delta(state, grad, float(eta), out))
+
+    def state_dict(self):
+        return {"name": type(self).__name__, "hyperparams": {h: getattr(self, h) for h in self.hyperparams},
+                "t": self.t, "state": self.state}
+
+    def load_state_dict(self, state_dict):
+        self.t = state_dict["t"]
+        # the step buffers saved by former checkpoints are not state
+        self.state = {key: {slot: buffers[slot] for slot in self.slots}
+                      for key, buffers in state_dict["state"].items()}
+        self.scratch = {}
+
+
+class SGD(Optimizer):
+
+    def delta(self, state, grad, eta, out):
+        return np.multiply(grad, eta, out=out)
+
+
+class Momentum(Optimizer):
+    """ Heavy ball momentum, v = momentum v + grad, or Nesterov momentum if nesterov """
+    slots = ["velocity"]
+    hyperparams = ["momentum", "nesterov"]
+
+    def __init__(self, momentum=0.9, nesterov=False):
+        super().__init__()
+        self.momentum = momentum
+        self.nesterov = nesterov
+
+    def delta(self, state, grad, eta, delta):
+        v = state["velocity"]
+        v *= self.momentum
+        v += grad
+        if self.nesterov:
+            # look ahead: grad + momentum v
+            np.multiply(v, self.momentum, out=delta)
+            delta += grad
+        else:
+            delta[...] = v
+        delta *= eta
+        return delta
+
+
+class Adam(Optimizer):
+    slots = ["m", "v"]
+    hyperparams = ["beta1", "beta2", "eps"]
+
+    def __init__(self, beta1=0.9, beta2=0.999, eps=1e-8):
+        super().__init__()
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.eps = eps
+
+    def delta(self, state, grad, eta, delta):
+        m, v = state["m"], state["v"]
+        m *= self.beta1
+        m += np.multiply(grad, 1 - self.beta1, out=delta)
+        v *= self.beta2
+        v += np.multiply(np.square(grad, out=delta), 1 - self.beta2, out=delta)
+
+        # bias corrections folded into the learning rate and epsilon
+        c1, c2 = 1 - self.beta1 ** self.t, np.sqrt(1 - self.beta2 ** self.t)
+        np.sqrt(v, out=delta)
+        delta += self.eps * c2
+        np.divide(m, delta, out=delta)
+        delta *= eta * c2 / c1
+        return delta
+
+
+OPTIMIZERS = {optimizer.__name__: optimizer for optimizer in [SGD, Momentum, Adam]}
+
+
+def load_optimizer(state_dict):
+    """ Optimizer saved with state_dict, with its hyperparameters and state """
+    optimizer = OPTIMIZERS[state_dict["name"]](**state_dict["hyperparams"])
+    optimizer.load_state_dict(state_dict)
+    return optimizer
@@ -0,0 +1,85 @@
+""" Summary rows of the training runs (hyperparameters, final and best metrics, wall time and checkpoint)
+in an indexed SQLite table, so that searches are ranked and filtered without loading the History files.
+Every process opens its own connection: WAL journaling lets readers run alongside the writer, and the
+busy timeout makes concurrent writers wait for the lock instead of failing """
+import json
+import sqlite3
+import time
+
+RESULTS_DB = "History/results.db"
+
+COLUMNS = {"exp": "TEXT", "lamda": "REAL", "seed": "INTEGER", "n_cycles": "INTEGER", "n_batch": "INTEGER",
+           "eta_min": "REAL", "eta_max": "REAL", "ns": "INTEGER", "steps": "INTEGER",
+           "train_acc": "REAL", "val_acc": "REAL", "val_loss": "REAL", "best_val_acc": "REAL",
+           "best_val_loss": "REAL", "wall_time": "REAL", "checkpoint": "TEXT", "params": "TEXT", "created": "REAL"}
+
+
+class ResultsStore():
+
+    def __init__(self, path=RESULTS_DB, timeout=60.):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"PRAGMA busy_timeout={int(timeout * 1000)}")
+        columns = ", ".join(f"{name} {kind}" for name, kind in COLUMNS.items())
+        with self.conn:
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY, {columns})")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS results_exp_val_acc ON results (exp, val_acc)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS results_exp_lamda ON results (exp, lamda)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def check_columns(names):
+        unknown = set(names) - set(COLUMNS) - {"id"}
+        if unknown:
+            raise KeyError(f"unknown results columns {sorted(unknown)}")
+
+    def add(self, **row):
+        """ Appends a row, params being stored as JSON. Returns its id """
+        self.check_columns(row)
+        row.setdefault("created", time.time())
+        if not isinstance(row.get("params", ""), str):
+            row["params"] = json.dumps(row["params"])
+        # numpy scalars as python numbers
+        values = [value.item() if hasattr(value, "item") else value for value in row.values()]
+        with self.conn:
+            cursor = self.conn.execute(f"INSERT INTO results ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                                       values)
+        return cursor.lastrowid
+
+    def query(self, order_by="val_acc", descending=True, limit=None, **filters):
+        """ Rows matching the filters as dicts, a filter being a value, a (low, high) range or a list of values """
+        self.check_columns([order_by, *filters])
+        clauses, values = [], []
+        for name, value in filters.items():
+            if isinstance(value, tuple):
+                clauses.append(f"{name} BETWEEN ? AND ?")
+                values.extend(value)
+            elif isinstance(value, list):
+                clauses.append(f"{name} IN ({', '.join('?' * len(value))})")
+                values.extend(value)
+            else:
+                clauses.append(f"{name} = ?")
+                values.append(value)
+        values = [value.item() if hasattr(value, "item") else value for value in values]
+        sql = "SELECT * FROM results"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += f" ORDER BY {order_by} {'DESC' if descending else 'ASC'}, id DESC"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        return [dict(row) for row in self.conn.execute(sql, values)]
+
+    def best(self, metric="val_acc", **filters):
+        """ Best row for the metric, the highest accuracy or the lowest loss """
+        rows = self.query(order_by=metric, descending=metric.endswith("acc"), limit=1, **filters)
+        return rows[0] if rows else None
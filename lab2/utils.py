@@ -1,8 +1,37 @@
 from six.moves import cPickle
-from keras.utils.np_utils import to_categorical
-import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
 import numpy as np
 
+def labels(Y):
+    """ Integer labels from either integer labels or one hot encoded labels (K, n) """
+    return Y if Y.ndim == 1 else np.argmax(Y, axis=0)
+
+
+def cross_entropy(S, y):
+    """ Fused log-softmax cross entropy of the scores S (K, n) against the integer labels y:
+    log-sum-exp over the shifted scores minus the score of the label, no one hot matrix involved.
+    Returns the per-sample losses and the softmax probabilities """
+    S = S - np.max(S, axis=0)
+    P = np.exp(S)
+    Z = np.sum(P, axis=0)
+    losses = np.log(Z) - S[y, np.arange(S.shape[1])]
+    P /= Z
+    return losses, P
+
+
+def cross_entropy_grad(P, y):
+    """ Gradient of the cross entropy w.r.t. the scores, P - Y, computed in place in P """
+    P[y, np.arange(P.shape[1])] -= 1
+    return P
+
+
+def one_hot(y, num_classes=10):
+    """ One hot encodes integer labels as a (n, num_classes) float32 matrix """
+    return np.eye(num_classes, dtype=np.float32)[y]
+
+
 def loadData(filename, reshape=False, clipping=False):
     """ Loads data and creates one hot encoded labels """
 
@@ -23,14 +52,230 @@ def loadData(filename, reshape=False, clipping=False):
 
     y = np.array(y)
     # One hot Encoded labels
-    Y = to_categorical(y, num_classes=10)
+    Y = one_hot(y, num_classes=10)
     Y = Y.T
 
     return X, y, Y
 
 
+CACHE_VERSION = 1
+CACHE_DIR = '../Dataset/cifar-10-cache/'
+BATCHES = ['data_batch_1', 'data_batch_2', 'data_batch_3',
+           'data_batch_4', 'data_batch_5', 'test_batch']
+
+
+def cache_batch(filename, cache_dir=CACHE_DIR, stats=True):
+    """ Converts a cifar batch into a versioned, memory-mappable cache entry:
+    feature-major float32 X (d, n), int labels and optionally the per-feature mean/std """
+    X, y, _ = loadData(filename, clipping=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    prefix = cache_dir + filename
+    # an existing entry is invalidated before its arrays are overwritten
+    if os.path.exists(prefix + '_meta.json'):
+        os.remove(prefix + '_meta.json')
+
+    X_map = np.lib.format.open_memmap(
+        prefix + '_X.npy', mode='w+', dtype=np.float32, shape=X.shape)
+    X_map[:] = X
+    X_map.flush()
+    del X_map
+    np.save(prefix + '_y.npy', y.astype(np.int64))
+
+    if stats:
+        np.save(prefix + '_mean.npy', np.mean(X, axis=1))
+        np.save(prefix + '_std.npy', np.std(X, axis=1))
+
+    # the meta file is written last so that an interrupted conversion is never picked up
+    meta = {"version": CACHE_VERSION, "shape": list(X.shape),
+            "dtype": "float32", "stats": stats}
+    with open(prefix + '_meta.json', 'w') as f:
+        json.dump(meta, f)
+
+
+def cache_dataset(filenames=BATCHES, cache_dir=CACHE_DIR, stats=True):
+    """ One-time conversion of the cifar batches into the on-disk cache """
+    for filename in filenames:
+        cache_batch(filename, cache_dir, stats)
+
+
+def is_cached(filename, cache_dir=CACHE_DIR):
+    """ Checks that a valid cache entry of the current version exists """
+    try:
+        with open(cache_dir + filename + '_meta.json') as f:
+            return json.load(f)["version"] == CACHE_VERSION
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def loadCachedData(filename, cache_dir=CACHE_DIR, mmap_mode='r'):
+    """ Drop-in replacement of loadData(filename, clipping=True) backed by the memory-mapped cache.
+    X is shared through the page cache between processes, use mmap_mode='c' to modify it locally """
+    if not is_cached(filename, cache_dir):
+        cache_batch(filename, cache_dir)
+
+    X = np.load(cache_dir + filename + '_X.npy', mmap_mode=mmap_mode)
+    y = np.load(cache_dir + filename + '_y.npy')
+    # One hot Encoded labels
+    Y = one_hot(y, num_classes=10)
+    Y = Y.T
+
+    return X, y, Y
+
+
+def loadCachedStats(filename, cache_dir=CACHE_DIR):
+    """ Loads the precomputed per-feature mean and std of a cached batch """
+    if not is_cached(filename, cache_dir) or not os.path.exists(cache_dir + filename + '_mean.npy'):
+        cache_batch(filename, cache_dir)
+    return np.load(cache_dir + filename + '_mean.npy'), np.load(cache_dir + filename + '_std.npy')
+
+
+class Augmenter():
+    """ Random horizontal flips, translations of up to shift pixels (edges replicated) and Gaussian noise of
+    a batch of images stored as columns, each sample drawing its own flags. Flips and translations are
+    pixel permutations: one gather index per combination is precomputed, so that a batch is transformed
+    by a single np.take. Fresh Gaussian noise of std sigma, drawn from the rng of the batch, is added to a
+    fraction noise of the samples, which are scaled back by 1/sqrt(1 + sigma^2) so that the standardized
+    features keep their variance """
+
+    def __init__(self, flip=0., shift=0, noise=0., sigma=1., shape=(3, 32, 32)):
+        self.flip, self.shift, self.noise, self.sigma = flip, shift, noise, sigma
+        c, r, w = np.indices(shape)
+        n_rows, n_cols = shape[1:]
+        offsets = range(-shift, shift + 1)
+        # table[(flipped * (2 shift + 1) + dy + shift) * (2 shift + 1) + dx + shift] is the source pixel of every
+        # pixel, kept in both orders so that the index of a batch is gathered in the layout of the output
+        self.table = np.array([((c * n_rows + np.clip(r - dy, 0, n_rows - 1)) * n_cols
+                                + np.clip((n_cols - 1 - w if flipped else w) - dx, 0, n_cols - 1)).ravel()
+                               for flipped in (False, True) for dy in offsets for dx in offsets])
+        self.table_T = np.ascontiguousarray(self.table.T)
+
+    def permutes(self):
+        return self.flip > 0 or self.shift > 0
+
+    def __call__(self, X, out=None, rng=None):
+        """ Augmented copy of the batch X (d, n), written to out if given """
+        rng = np.random.default_rng() if rng is None else rng
+        if out is None:
+            out = np.empty_like(X)
+        d, n = X.shape
+        if self.permutes():
+            width = 2 * self.shift + 1
+            ids = (rng.random(n) < self.flip) * width ** 2
+            if self.shift > 0:
+                ids += rng.integers(0, width, n) * width + rng.integers(0, width, n)
+            # flat position in the memory of X of the source of every element of out
+            if not (X.flags['C_CONTIGUOUS'] or X.flags['F_CONTIGUOUS']):
+                X = np.ascontiguousarray(X)
+            row, col = (stride // X.itemsize for stride in X.strides)
+            flat = X.ravel(order='K')
+            if out.flags['F_CONTIGUOUS'] and not out.flags['C_CONTIGUOUS']:
+                src = self.table[ids]
+                src *= row
+                src += np.arange(n)[:, None] * col
+                np.take(flat, src, out=out.T, mode='clip')
+            else:
+                src = np.take(self.table_T, ids, axis=1)
+                src *= row
+                src += np.arange(n) * col
+                np.take(flat, src, out=out, mode='clip')
+        elif out is not X:
+            out[...] = X
+        if self.noise > 0:
+            noisy = np.nonzero(rng.random(n) < self.noise)[0]
+            if len(noisy):
+                # drawn on the thread gathering the batch (the prefetch thread of a BatchLoader), in single
+                # precision which is enough for noise
+                noise = rng.standard_normal((len(noisy), d), dtype=np.float32)
+                noise *= self.sigma
+                block = out[:, noisy]
+                block += noise.T
+                block /= np.sqrt(1 + self.sigma ** 2)
+                out[:, noisy] = block
+        return out
+
+
+class BatchLoader():
+    """ Iterates over shuffled minibatches of (X, Y, y) without copying the dataset (Y may be None).
+    A single permutation is drawn per epoch and every batch is gathered into preallocated
+    contiguous buffers, the next batch being prepared on a background thread """
+
+    def __init__(self, X, Y, y, batch_size, prefetch=True, augment=None):
+        self.X, self.Y, self.y = X, Y, y
+        # Augmenter applied to the X batches as they are gathered, on the prefetch thread
+        self.augment = augment
+        self.batch_size = batch_size
+        self.n = X.shape[1]
+        self.n_batches = self.n // batch_size
+        self.prefetch = prefetch
+        # one set of buffers is consumed while the other one is being filled,
+        # they follow the memory layout of the source so that columns are copied as contiguous runs
+        self.buffers = [(np.empty((X.shape[0], batch_size), dtype=X.dtype, order=self.layout(X)),
+                         None if Y is None else np.empty(
+                             (Y.shape[0], batch_size), dtype=Y.dtype, order=self.layout(Y)),
+                         np.empty(batch_size, dtype=y.dtype)) for _ in range(2)]
+        # the columns are gathered here and augmented into the batch buffer
+        self.scratch = None if augment is None else np.empty_like(self.buffers[0][0])
+        self.executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+    def __len__(self):
+        return self.n_batches
+
+    @staticmethod
+    def layout(A):
+        return 'F' if A.strides[0] < A.strides[1] else 'C'
+
+    @staticmethod
+    def take_columns(A, idx, out):
+        # mode='clip' avoids the buffered copy np.take makes with out= (indices are always valid)
+        if out.flags['F_CONTIGUOUS']:
+            np.take(A.T, idx, axis=0, out=out.T, mode='clip')
+        else:
+            np.take(A, idx, axis=1, out=out, mode='clip')
+
+    def gather(self, idx, buffers, seed=None):
+        X_batch, Y_batch, y_batch = buffers
+        if self.augment is None:
+            self.take_columns(self.X, idx, X_batch)
+        else:
+            self.take_columns(self.X, idx, self.scratch)
+            self.augment(self.scratch, X_batch, np.random.default_rng(seed))
+        if Y_batch is not None:
+            self.take_columns(self.Y, idx, Y_batch)
+        np.take(self.y, idx, out=y_batch, mode='clip')
+        return buffers
+
+    def epoch(self, seed, start=0):
+        """ Yields the (X_batch, Y_batch, y_batch) of one epoch shuffled with RandomState(seed), from the
+        start-th batch on, the augmentation of the j-th batch drawn from (seed, j). The yielded arrays are reused:
+        they are only valid until the next batch is requested """
+        perm = np.random.RandomState(seed).permutation(self.n)
+        batches = [perm[j*self.batch_size:(j+1)*self.batch_size]
+                   for j in range(start, self.n_batches)]
+
+        if not batches:
+            return
+
+        if not self.prefetch:
+            for k, idx in enumerate(batches):
+                yield self.gather(idx, self.buffers[k % 2], (seed, start + k))
+            return
+
+        future = self.executor.submit(self.gather, batches[0], self.buffers[0], (seed, start))
+        for k in range(len(batches)):
+            batch = future.result()
+            if k + 1 < len(batches):
+                future = self.executor.submit(
+                    self.gather, batches[k+1], self.buffers[(k+1) % 2], (seed, start + k + 1))
+            yield batch
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
 def plotCifar(X, Y):
     """ Util function to plot cifar original images along with their labels """
+    import matplotlib.pyplot as plt
     fig, axes1 = plt.subplots(5, 5, figsize=(12, 12))
     print(X.shape)
     for j in range(5):
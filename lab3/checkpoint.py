@@ -0,0 +1,117 @@
+""" Pickle-free checkpoints: a directory holding one .npy file per array (layer parameters, BN statistics,
+optimizer state) and a meta.json with the architecture, the history and the training state. The arrays
+can be memory mapped when loaded. Run as a script from the lab directory to convert pickled backups,
+the layers files being merged with their history and optimizer files:
+
+    python checkpoint.py History/*_layers_*.npy
+"""
+import json
+import os
+import sys
+
+import numpy as np
+
+META = "meta.json"
+LAYER_ARRAYS = ["W", "b", "gamma", "beta", "mu_av", "v_av"]
+
+
+def to_json(value):
+    """ Python numbers and lists from numpy ones, for json.dump """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def save_checkpoint(path, arrays, meta=None):
+    """ Saves the named arrays, one .npy file each, and the meta data in the directory path """
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), np.asarray(array), allow_pickle=False)
+    with open(os.path.join(path, META), "w") as f:
+        json.dump({**(meta or {}), "arrays": list(arrays)}, f, default=to_json)
+
+
+def load_checkpoint(path, mmap_mode=None):
+    """ Named arrays and meta data of a checkpoint, the arrays being memory mapped with mmap_mode
+    ("r" read only, "c" copy on write) if given """
+    with open(os.path.join(path, META)) as f:
+        meta = json.load(f)
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode, allow_pickle=False)
+              for name in meta["arrays"]}
+    return arrays, meta
+
+
+def is_checkpoint(path):
+    return os.path.isfile(os.path.join(path, META))
+
+
+def layer_arrays(layers):
+    """ Parameters and BN statistics of the layers, named layer{i}_{name} """
+    return {f"layer{i}_{name}": getattr(layer, name) for i, layer in enumerate(layers)
+            for name in LAYER_ARRAYS if getattr(layer, name, None) is not None}
+
+
+def set_layer_arrays(layers, arrays):
+    for i, layer in enumerate(layers):
+        for name in LAYER_ARRAYS:
+            if f"layer{i}_{name}" in arrays:
+                setattr(layer, name, arrays[f"layer{i}_{name}"])
+
+
+def optimizer_arrays(state_dict):
+    """ State buffers of an optimizer state dict, named optimizer_{key}_{slot}, and the state dict
+    with the names of the buffers in place of the buffers """
+    arrays = {f"optimizer_{key}_{slot}": buffer for key, buffers in state_dict["state"].items()
+              for slot, buffer in buffers.items()}
+    meta = {**state_dict, "state": {key: list(buffers) for key, buffers in state_dict["state"].items()}}
+    return arrays, meta
+
+
+def optimizer_state(meta, arrays):
+    """ Optimizer state dict from the output of optimizer_arrays """
+    return {**meta, "state": {key: {slot: np.array(arrays[f"optimizer_{key}_{slot}"]) for slot in slots}
+                              for key, slots in meta["state"].items()}}
+
+
+def convert_history(filename):
+    """ Converts a pickled backup to a checkpoint directory: a list of layers saved by backup or
+    backup_cyclic, merged with its history and optimizer files, or a dict of arrays.
+    Unpickling the layers needs their classes, so it runs from the lab directory. Returns the path """
+    obj = np.load(filename, allow_pickle=True)
+    if obj.dtype == object and obj.ndim == 0:
+        obj = obj.item()
+    if isinstance(obj, dict):
+        path = filename[:-len(".npy")]
+        save_checkpoint(path, obj, {"converted_from": filename})
+        return path
+
+    layers = list(obj)
+    arrays = layer_arrays(layers)
+    meta = {"k": len(layers), "dims": [layers[0].W.shape[1]] + [layer.W.shape[0] for layer in layers],
+            "batch_norm": any(getattr(layer, "gamma", None) is not None for layer in layers),
+            "dtype": layers[0].W.dtype.name, "converted_from": filename}
+    path = filename.replace("_layers_", "_checkpoint_")[:-len(".npy")]
+    try:
+        # backups are named ..._{lamda}_{seed}
+        lamda, seed = os.path.basename(path).split("_")[-2:]
+        meta.update(lamda=float(lamda), seed=int(seed))
+    except ValueError:
+        pass
+    hist = filename.replace("_layers_", "_hist_")
+    if os.path.exists(hist):
+        meta["history"] = np.load(hist, allow_pickle=True).item()
+    optimizer = filename.replace("_layers_", "_optimizer_")
+    if os.path.exists(optimizer):
+        state, meta["optimizer"] = optimizer_arrays(np.load(optimizer, allow_pickle=True).item())
+        arrays.update(state)
+    save_checkpoint(path, arrays, meta)
+    return path
+
+
+if __name__ == "__main__":
+    for filename in sys.argv[1:]:
+        if "_hist_" in filename or "_optimizer_" in filename:
+            continue
+        print(f"{filename} -> {convert_history(filename)}")
@@ -0,0 +1,184 @@
+""" Kernels of the fused parts of a train step (batch norm, ReLU, softmax and cross entropy),
+working in place on the layer workspace buffers. The NumPy backend is always available, the Numba
+backend compiles multi-threaded versions of the same kernels when numba is installed. """
+import warnings
+
+import numpy as np
+
+from utils import cross_entropy, cross_entropy_grad
+
+
+class NumpyKernels():
+    name = "numpy"
+
+    @staticmethod
+    def relu(S, mask):
+        """ ReLU of S in place, mask receives the positive entries """
+        np.greater(S, 0, out=mask)
+        return np.multiply(S, mask, out=S)
+
+    @staticmethod
+    def relu_backward(G, mask):
+        G *= mask
+        return G
+
+    @staticmethod
+    def softmax(S, col):
+        """ Softmax of the columns of S in place, col is a buffer of shape (n,) """
+        S -= np.max(S, axis=0, out=col)
+        np.exp(S, out=S)
+        S /= np.sum(S, axis=0, out=col)
+        return S
+
+    # the fused loss and its gradient shared with the rest of the lab
+    cross_entropy = staticmethod(cross_entropy)
+    cross_entropy_grad = staticmethod(cross_entropy_grad)
+
+    @staticmethod
+    def bn_forward(scores, gamma, beta, eps, D, scores_hat, out, tmp):
+        """ Normalizes the rows of scores with their batch mean and variance (the biased one,
+        which the gradients of bn_backward are derived from) into scores_hat,
+        then scales and shifts them into out. D receives the centered scores.
+        Returns the mean, the variance and sigma = (v + eps)^-1/2 """
+        n_batch = scores.shape[1]
+        mu = np.mean(scores, axis=1, keepdims=True)
+        np.subtract(scores, mu, out=D)
+        v = np.sum(np.square(D, out=tmp), axis=1, keepdims=True) / n_batch
+        sigma = np.power(v + eps, -0.5)
+        np.multiply(D, sigma, out=scores_hat)
+        np.multiply(scores_hat, gamma, out=out)
+        out += beta
+        return mu, v, sigma
+
+    @staticmethod
+    def bn_backward(G, D, scores_hat, gamma, v, sigma, eps, tmp):
+        """ Backpropagates G in place through the scale and shift and the batch normalization.
+        Returns the gradients of gamma and beta """
+        n_batch = G.shape[1]
+        grad_gamma = np.sum(np.multiply(G, scores_hat, out=tmp), axis=1, keepdims=True) / n_batch
+        grad_beta = np.sum(G, axis=1, keepdims=True) / n_batch
+
+        G *= gamma
+        # batch_norm_back_pass: G1 = G sigma1, c = sum(G2 D) = sum(G1 D) / (v + eps)
+        G *= sigma
+        c = np.sum(np.multiply(G, D, out=tmp), axis=1, keepdims=True) / (v + eps)
+        G -= np.sum(G, axis=1, keepdims=True) / n_batch
+        G -= np.multiply(D, c / n_batch, out=tmp)
+        return grad_gamma, grad_beta
+
+
+class NumbaKernels(NumpyKernels):
+    """ Compiled on first use, falls back to the NumPy kernels until then """
+    name = "numba"
+    compiled = False
+
+
+def compile_numba_kernels():
+    from numba import njit, prange
+
+    @njit(parallel=True, cache=True)
+    def relu(S, mask):
+        d, n = S.shape
+        for i in prange(d):
+            for j in range(n):
+                mask[i, j] = S[i, j] > 0
+                if not mask[i, j]:
+                    S[i, j] = 0
+        return S
+
+    @njit(parallel=True, cache=True)
+    def relu_backward(G, mask):
+        d, n = G.shape
+        for i in prange(d):
+            for j in range(n):
+                if not mask[i, j]:
+                    G[i, j] = 0
+        return G
+
+    @njit(parallel=True, cache=True)
+    def softmax(S, col):
+        K, n = S.shape
+        for j in prange(n):
+            m = S[0, j]
+            for i in range(1, K):
+                m = max(m, S[i, j])
+            z = 0.
+            for i in range(K):
+                S[i, j] = np.exp(S[i, j] - m)
+                z += S[i, j]
+            for i in range(K):
+                S[i, j] /= z
+        return S
+
+    @njit(parallel=True, cache=True)
+    def cross_entropy_grad(P, y):
+        for j in prange(P.shape[1]):
+            P[y[j], j] -= 1
+        return P
+
+    @njit(parallel=True, cache=True)
+    def bn_forward(scores, gamma, beta, eps, D, scores_hat, out, tmp):
+        d, n = scores.shape
+        mu = np.empty((d, 1), dtype=scores.dtype)
+        v = np.empty((d, 1), dtype=scores.dtype)
+        sigma = np.empty((d, 1), dtype=scores.dtype)
+        for i in prange(d):
+            s = 0.
+            for j in range(n):
+                s += scores[i, j]
+            m = s / n
+            s2 = 0.
+            for j in range(n):
+                D[i, j] = scores[i, j] - m
+                s2 += D[i, j] * D[i, j]
+            mu[i, 0], v[i, 0] = m, s2 / n
+            sigma[i, 0] = (v[i, 0] + eps) ** -0.5
+            for j in range(n):
+                scores_hat[i, j] = D[i, j] * sigma[i, 0]
+                out[i, j] = gamma[i, 0] * scores_hat[i, j] + beta[i, 0]
+        return mu, v, sigma
+
+    @njit(parallel=True, cache=True)
+    def bn_backward(G, D, scores_hat, gamma, v, sigma, eps, tmp):
+        d, n = G.shape
+        grad_gamma = np.empty((d, 1), dtype=G.dtype)
+        grad_beta = np.empty((d, 1), dtype=G.dtype)
+        for i in prange(d):
+            g_gamma, g_beta = 0., 0.
+            for j in range(n):
+                g_gamma += G[i, j] * scores_hat[i, j]
+                g_beta += G[i, j]
+            grad_gamma[i, 0], grad_beta[i, 0] = g_gamma / n, g_beta / n
+
+            scale = gamma[i, 0] * sigma[i, 0]
+            s1, c = 0., 0.
+            for j in range(n):
+                G[i, j] *= scale
+                s1 += G[i, j]
+                c += G[i, j] * D[i, j]
+            s1 /= n
+            c /= (v[i, 0] + eps) * n
+            for j in range(n):
+                G[i, j] -= s1 + D[i, j] * c
+        return grad_gamma, grad_beta
+
+    for kernel in [relu, relu_backward, softmax, cross_entropy_grad, bn_forward, bn_backward]:
+        setattr(NumbaKernels, kernel.__name__, staticmethod(kernel))
+    NumbaKernels.compiled = True
+
+
+def get_kernels(backend="numpy"):
+    """ Kernels of the given backend: "numpy", "numba", or "auto" for numba when it is installed.
+    Falls back to the NumPy kernels when numba is not available """
+    if backend == "numpy":
+        return NumpyKernels
+    if backend not in ["numba", "auto"]:
+        raise ValueError(f"unknown kernels backend {backend}")
+    if not NumbaKernels.compiled:
+        try:
+            compile_numba_kernels()
+        except ImportError:
+            if backend == "numba":
+                warnings.warn("numba is not installed, falling back to the numpy kernels")
+            return NumpyKernels
+    return NumbaKernels
@@ -1,10 +1,22 @@
-from sklearn.utils import shuffle
-import matplotlib.pyplot as plt
-from sklearn.metrics import accuracy_score
+import copy
+import json
+import multiprocessing as mp
+import os
+import time
 import numpy as np
-from tqdm import tqdm
 from collections import defaultdict
 from enum import Enum
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from utils import BatchLoader, labels
+from kernels import NumpyKernels, get_kernels
+from optimizers import SGD, load_optimizer
+from results import RESULTS_DB, ResultsStore
+from checkpoint import (is_checkpoint, layer_arrays, load_checkpoint, optimizer_arrays, optimizer_state,
+                        save_checkpoint, set_layer_arrays)
+
+
+# python float so that it does not promote float32 arrays to float64
+EPS = float(np.finfo(np.float64).eps)
 
 
 class Initialization(Enum):
@@ -16,69 +28,228 @@ def batch_normalize(X, mean, std):
     return (X - mean)/std
 
 
+def relative_error(g1, g2, eps):
+    return np.abs(g1 - g2) / np.maximum(eps, np.abs(g1) + np.abs(g2))
+
+
+# state of the gradient check workers: a copy of the network and the batch
+_check = {}
+
+
+def _init_check_worker(net, X, Y):
+    _check.update(net=net, X=X, Y=Y)
+
+
+def _check_directions(directions, h):
+    net, X, Y = _check["net"], _check["X"], _check["Y"]
+    return [net.directional_difference(X, Y, direction, h) for direction in directions]
+
+
 def softmax(x):
-    """ Standard definition of the softmax function """
-    return np.exp(x) / np.sum(np.exp(x), axis=0)
+    """ Standard definition of the softmax function, shifted by the column max for stability """
+    e = np.exp(x - np.max(x, axis=0))
+    e /= np.sum(e, axis=0)
+    return e
 
 
 def relu(x):
     return np.maximum(0, x)
 
 
+# state of the search workers: the dataset, inherited through fork rather than pickled for every trial
+_search = {}
+
+
+def _init_search_worker(data, threads):
+    _search["data"] = data
+    if threads is not None:
+        # one BLAS pool per worker, sized so that the workers do not oversubscribe the cores
+        try:
+            from threadpoolctl import threadpool_limits
+            threadpool_limits(threads)
+        except ImportError:
+            pass
+
+
+def _search_trial(lamda, GDparams, params, store):
+    """ Trains the MLP of one lambda of a search, returning its summary, which is also appended to the
+    results store if any """
+    mlp = MLP(lamda=lamda, **params)
+    mlp.cyclic_learning(_search["data"], GDparams, verbose=False, backup=True)
+    summary = mlp.summary(GDparams)
+    if store is not None:
+        with ResultsStore(store) as results:
+            results.add(**summary)
+    return summary
+
+
+def _halving_trial(mlp, GDparams, n_steps, backup, store):
+    """ Resumes the cyclic learning of mlp for n_steps updates (up to the end of the cycles if None) and
+    evaluates it without adding to its history, returning the trained network and the metrics it is ranked
+    by. The summaries of the backed up networks are stored """
+    data = _search["data"]
+    mlp.cyclic_learning(data, GDparams, verbose=False, backup=backup, n_steps=n_steps)
+    t_loss, _, t_acc, v_loss, _, v_acc = mlp.history_metrics(data, GDparams.get("eval_subsample"))
+    if backup and store is not None:
+        with ResultsStore(store) as results:
+            results.add(**mlp.summary(GDparams))
+    # the activations and gradients of the last passes are not sent back to the search process
+    for layer in mlp.layers:
+        layer.input = None
+        if isinstance(layer, BNLayer):
+            layer.scores, layer.scores_hat = None, None
+        for p in layer.params:
+            setattr(layer, "grad_" + p, None)
+    return mlp, {"train_acc": t_acc, "val_acc": v_acc, "val_loss": v_loss}
+
+
 class Layer():
-    def __init__(self, d_in, d_out, activation, init=Initialization.XAVIER):
+    params = ["W", "b"]
+    # non-trainable state needed at inference
+    stats = []
+    master = None
+    # backend of the in place kernels run on the workspace buffers
+    kernels = NumpyKernels
+    # preallocated buffers of train mode steps, and the ones used by the current step
+    workspace = None
+    buffers = None
+
+    def __init__(self, d_in, d_out, activation, init=Initialization.XAVIER, dtype=np.float64):
         self.d_in = d_in
         self.d_out = d_out
         init = init.value if isinstance(init, Initialization) else init 
         self.W = np.random.normal(
-            0, init/np.sqrt(d_in), (d_out, d_in))
-        self.b = np.zeros((d_out, 1))
+            0, init/np.sqrt(d_in), (d_out, d_in)).astype(dtype)
+        self.b = np.zeros((d_out, 1), dtype=dtype)
         self.activation = activation
         self.init = init
         self.input = None
         self.grad_W = None
         self.grad_b = None
 
-    def evaluate_layer(self, input, train_mode=True, init=False):
+    def keep_master_copy(self):
+        """ Keeps float64 master copies of the parameters, updates are accumulated in full precision """
+        self.master = {p: getattr(self, p).astype(np.float64) for p in self.params}
+
+    def allocate_workspace(self, n_batch, propagate):
+        """ Preallocates the activation, mask and gradient buffers of a train mode step """
+        dtype = self.W.dtype
+        self.workspace = {
+            "n_batch": n_batch,
+            "scores": np.empty((self.d_out, n_batch), dtype=dtype),
+            "mask": np.empty((self.d_out, n_batch), dtype=bool),
+            "col": np.empty(n_batch, dtype=dtype),
+            "G": np.empty((self.d_in, n_batch), dtype=dtype) if propagate else None,
+            "grad_W": np.empty_like(self.W),
+            "grad_b": np.empty_like(self.b),
+            "scratch_W": np.empty_like(self.W),
+        }
+
+    def use_buffers(self, input, train_mode):
+        """ The workspace is only used by train mode passes on batches of the size it was made for """
+        ws = self.workspace
+        self.buffers = ws if train_mode and ws is not None and ws["n_batch"] == input.shape[1] else None
+        return self.buffers is not None
+
+    def activate_inplace(self, S):
+        ws = self.buffers
+        if self.activation is relu:
+            return self.kernels.relu(S, ws["mask"])
+        if self.activation is softmax:
+            return self.kernels.softmax(S, ws["col"])
+        return self.activation(S)
+
+    def evaluate_layer(self, input, train_mode=True, init=False, logits=False):
+        if self.use_buffers(input, train_mode):
+            # the input is referenced, it stays untouched until the backward pass
+            self.input = input
+            scores = np.matmul(self.W, input, out=self.buffers["scores"])
+            scores += self.b
+            return scores if logits else self.activate_inplace(scores)
         self.input = input.copy()
-        return self.activation(self.W @ self.input + self.b)
+        scores = self.W @ self.input + self.b
+        return scores if logits else self.activation(scores)
+
+    def infer(self, input, logits=False):
+        """ Inference only evaluation: nothing is kept for a backward pass """
+        scores = self.W @ input
+        scores += self.b
+        return scores if logits else self.activation(scores)
 
     def compute_gradients(self, G, n_batch, lamda, propagate=False):
+        if self.buffers is not None:
+            # with buffers, each layer applies the derivative of its own ReLU with the forward mask
+            if self.activation is relu:
+                G = self.kernels.relu_backward(G, self.buffers["mask"])
+            return self.linear_gradients(G, n_batch, lamda, propagate)
         self.grad_W = G @ self.input.T / n_batch + \
-            2 * lamda * self.W
-        self.grad_b = np.mean(G, axis=1, keepdims=True) 
+            2 * float(lamda) * self.W
+        self.grad_b = np.sum(G, axis=1, keepdims=True) / n_batch
         if propagate:
             G = self.W.T @ G
             G = np.multiply(G, np.heaviside(self.input, 0))
         return G
 
-    def update_params(self, eta):
-        self.W -= eta * self.grad_W
-        self.b -= eta * self.grad_b
+    def linear_gradients(self, G, n_batch, lamda, propagate):
+        ws = self.buffers
+        self.grad_W = np.matmul(G, self.input.T, out=ws["grad_W"])
+        self.grad_W /= n_batch
+        self.grad_W += np.multiply(self.W, 2 * float(lamda), out=ws["scratch_W"])
+        self.grad_b = np.mean(G, axis=1, keepdims=True, out=ws["grad_b"])
+        if propagate:
+            return np.matmul(self.W.T, G, out=ws["G"])
+        return G
+
+    def apply_update(self, p, delta):
+        """ Subtracts delta from parameter p in place, going through its master copy if any """
+        param = getattr(self, p)
+        if self.master is None:
+            param -= delta
+        else:
+            self.master[p] -= delta
+            param[...] = self.master[p]
 
 
 class BNLayer(Layer):
-    def __init__(self, d_in, d_out, activation, init=Initialization.HE, alpha=0.9):
-        super().__init__(d_in, d_out, activation, init)
+    params = Layer.params + ["gamma", "beta"]
+    stats = ["mu_av", "v_av"]
+    # all-reduce of the batch sums over the workers of data parallel training, see parallel.py
+    sync = None
+
+    def __init__(self, d_in, d_out, activation, init=Initialization.HE, alpha=0.9, dtype=np.float64):
+        super().__init__(d_in, d_out, activation, init, dtype)
         self.alpha = alpha
-        self.mu = np.zeros((self.d_out, 1))
-        self.v = np.zeros((self.d_out, 1))
-        self.mu_av = np.zeros((self.d_out, 1))
-        self.v_av = np.zeros((self.d_out, 1))
-        self.gamma = np.ones((self.d_out, 1))
-        self.beta = np.zeros((self.d_out, 1))
+        self.mu = np.zeros((self.d_out, 1), dtype=dtype)
+        self.v = np.zeros((self.d_out, 1), dtype=dtype)
+        self.mu_av = np.zeros((self.d_out, 1), dtype=dtype)
+        self.v_av = np.zeros((self.d_out, 1), dtype=dtype)
+        self.gamma = np.ones((self.d_out, 1), dtype=dtype)
+        self.beta = np.zeros((self.d_out, 1), dtype=dtype)
         self.grad_gamma = None
         self.grad_beta = None
         self.scores = None
         self.scores_hat = None
+        self.sigma = None
+
+    def allocate_workspace(self, n_batch, propagate):
+        super().allocate_workspace(n_batch, propagate)
+        for name in ["D", "scores_hat", "out", "tmp"]:
+            self.workspace[name] = np.empty((self.d_out, n_batch), dtype=self.W.dtype)
 
     def evaluate_layer(self, input, train_mode=True, init=False):
+        if self.use_buffers(input, train_mode):
+            return self.evaluate_layer_inplace(input, init)
         self.input = input.copy()
         self.scores = self.W @ self.input + self.b
 
         if train_mode:
-            self.mu = np.mean(self.scores, axis=1, keepdims=True)
-            self.v = np.var(self.scores, axis=1, ddof=1, keepdims=True)
+            if self.sync is None:
+                self.mu = np.mean(self.scores, axis=1, keepdims=True)
+                self.v = np.var(self.scores, axis=1, keepdims=True)
+            else:
+                n_batch = self.sync.n_batch
+                self.mu = self.batch_sum(self.scores) / n_batch
+                self.v = self.batch_sum(np.square(self.scores - self.mu)) / n_batch
 
             if init:
                 self.mu_av = self.mu
@@ -88,16 +259,47 @@ class BNLayer(Layer):
                 self.v_av = self.alpha * self.v_av + (1-self.alpha) * self.v
 
             self.scores_hat = batch_normalize(
-                self.scores, self.mu, np.sqrt(self.v + np.finfo(float).eps))
+                self.scores, self.mu, np.sqrt(self.v + EPS))
 
         # test mode
         else:
             self.scores_hat = batch_normalize(
-                self.scores, self.mu_av, np.sqrt(self.v_av + np.finfo(np.float64).eps))
+                self.scores, self.mu_av, np.sqrt(self.v_av + EPS))
 
         return self.activation(np.multiply(self.gamma, self.scores_hat) + self.beta)
 
+    def evaluate_layer_inplace(self, input, init):
+        ws = self.buffers
+        self.input = input
+        self.scores = np.matmul(self.W, input, out=ws["scores"])
+        self.scores += self.b
+
+        self.mu, self.v, self.sigma = self.kernels.bn_forward(
+            self.scores, self.gamma, self.beta, EPS, ws["D"], ws["scores_hat"], ws["out"], ws["tmp"])
+        self.scores_hat = ws["scores_hat"]
+
+        if init:
+            self.mu_av = self.mu
+            self.v_av = self.v
+        else:
+            self.mu_av = self.alpha * self.mu_av + (1-self.alpha) * self.mu
+            self.v_av = self.alpha * self.v_av + (1-self.alpha) * self.v
+
+        return self.activate_inplace(ws["out"])
+
+    def infer(self, input, logits=False):
+        """ Inference only evaluation with the running statistics, nothing is kept for a backward pass """
+        scores = self.W @ input
+        scores += self.b
+        scores -= self.mu_av
+        scores /= np.sqrt(self.v_av + EPS)
+        scores *= self.gamma
+        scores += self.beta
+        return self.activation(scores)
+
     def compute_gradients(self, G, n_batch, lamda, propagate=False):
+        if self.buffers is not None:
+            return self.compute_gradients_inplace(G, n_batch, lamda, propagate)
         self.grad_gamma = np.sum(np.multiply(
             G, self.scores_hat), axis=1, keepdims=True) / n_batch
         self.grad_beta = np.sum(G, axis=1, keepdims=True) / n_batch
@@ -108,30 +310,41 @@ class BNLayer(Layer):
         G = super().compute_gradients(G, n_batch, lamda, propagate=propagate)
         return G
 
+    def compute_gradients_inplace(self, G, n_batch, lamda, propagate):
+        """ Same as compute_gradients, overwriting G and using the forward buffers """
+        ws = self.buffers
+        if self.activation is relu:
+            G = self.kernels.relu_backward(G, ws["mask"])
+        self.grad_gamma, self.grad_beta = self.kernels.bn_backward(
+            G, ws["D"], self.scores_hat, self.gamma, self.v, self.sigma, EPS, ws["tmp"])
+        return self.linear_gradients(G, n_batch, lamda, propagate)
+
+    def batch_sum(self, X):
+        """ Sums the columns of X, over the shards of all the workers in data parallel training """
+        S = np.sum(X, axis=1, keepdims=True)
+        return S if self.sync is None else self.sync.allreduce(S)
+
     def batch_norm_back_pass(self, G, n_batch):
 
-        sigma1 = np.power(self.v + np.finfo(np.float64).eps, -0.5)
-        sigma2 = np.power(self.v + np.finfo(np.float64).eps, -1.5)
+        sigma1 = np.power(self.v + EPS, -0.5)
+        sigma2 = np.power(self.v + EPS, -1.5)
 
         G1 = np.multiply(G, sigma1)
         G2 = np.multiply(G, sigma2)
 
         D = self.scores - self.mu
 
-        c = np.sum(np.multiply(G2, D), axis=1, keepdims=True)
+        c = self.batch_sum(np.multiply(G2, D))
 
-        G = G1 - np.sum(G1, axis=1, keepdims=True) / \
+        G = G1 - self.batch_sum(G1) / \
             n_batch - np.multiply(D, c) / n_batch
         return G
 
-    def update_params(self, eta):
-        super().update_params(eta)
-        self.gamma -= eta * self.grad_gamma
-        self.beta -= eta * self.grad_beta
 
 
 class MLP():
-    def __init__(self, k=2, dims=[3072, 50, 10], lamda=0, seed=42, batch_norm=False, alpha=0.9, init=Initialization.HE):
+    def __init__(self, k=2, dims=[3072, 50, 10], lamda=0, seed=42, batch_norm=False, alpha=0.9, init=Initialization.HE,
+                 dtype=np.float64, master_weights=False, workspace=False, kernels="numpy", optimizer=None):
         np.random.seed(seed)
         self.seed = seed
         self.k = k
@@ -139,10 +352,29 @@ class MLP():
         self.dims = dims
         self.layers = []
         self.batch_norm = batch_norm
+        # compute precision of parameters, activations, gradients and BN statistics
+        self.dtype = np.dtype(dtype)
+        # "numpy", "numba" or "auto", see kernels.get_kernels
+        self.kernels = get_kernels(kernels)
         self.add_layers(init, alpha)
+        if master_weights:
+            for layer in self.layers:
+                layer.keep_master_copy()
+        # train on preallocated per layer buffers instead of allocating at every step,
+        # the compiled kernels working on these buffers
+        self.workspace = workspace or self.kernels is not NumpyKernels
         self.train_loss, self.val_loss = [], []
         self.train_cost, self.val_cost = [], []
         self.train_acc, self.val_acc = [], []
+        self.evaluator, self.pending = None, []
+        self.optimizer = optimizer if optimizer is not None else SGD()
+        self.patience, self.monitor = 0, "val_loss"
+        self.best, self.stale = None, 0
+        self.best_eval, self.stop_reason, self.stop_step = None, None, None
+        # updates made by cyclic_learning so far, from which it resumes
+        self.step = 0
+        # wall time spent in cyclic_learning
+        self.train_time = 0.
 
     def add_layers(self, init, alpha):
         for i in range(self.k):
@@ -150,36 +382,53 @@ class MLP():
             activation = relu if i < self.k-1 else softmax
             if self.batch_norm and i < self.k-1:
                 layer = BNLayer(d_in, d_out, activation,
-                                alpha=alpha, init=init)
+                                alpha=alpha, init=init, dtype=self.dtype)
             else:
-                layer = Layer(d_in, d_out, activation, init)
+                layer = Layer(d_in, d_out, activation, init, dtype=self.dtype)
+            layer.kernels = self.kernels
             self.layers.append(layer)
 
-    def forward_pass(self, X, train_mode=True, init=False):
-        input = X.copy()
-        for layer in self.layers:
+    def allocate_workspace(self, n_batch):
+        """ Preallocates the buffers of every layer for train mode steps on batches of n_batch samples """
+        for i, layer in enumerate(self.layers):
+            layer.allocate_workspace(n_batch, propagate=(i != 0))
+
+    def forward_pass(self, X, train_mode=True, init=False, logits=False):
+        """ Returns the class probabilities, or the scores of the last layer if logits """
+        input = X.astype(self.dtype, copy=False)
+        for layer in self.layers[:-1]:
             input = layer.evaluate_layer(input, train_mode, init)
-        return input
+        return self.layers[-1].evaluate_layer(input, train_mode, init, logits=logits)
+
+    def predict_proba(self, X, logits=False):
+        """ Class probabilities, or scores if logits, of an inference only pass: unlike forward_pass in
+        test mode, the layers do not copy their inputs, and the network is left untouched """
+        input = X.astype(self.dtype, copy=False)
+        for layer in self.layers[:-1]:
+            input = layer.infer(input)
+        return self.layers[-1].infer(input, logits=logits)
 
     def compute_cost(self, X, Y, train_mode=True, init=False):
-        """ Computes the cost function: cross entropy loss + L2 regularization """
-        P = self.forward_pass(X, train_mode, init)
-        loss = np.log(np.sum(np.multiply(Y, P), axis=0))
-        loss = - np.sum(loss)/X.shape[1]
+        """ Computes the cost function: cross entropy loss + L2 regularization.
+        Y can be one hot encoded (K, n) or integer labels (n,) """
+        S = self.forward_pass(X, train_mode, init, logits=True)
+        loss, _ = self.kernels.cross_entropy(S, labels(Y))
+        loss = np.sum(loss)/X.shape[1]
         r = np.sum([np.linalg.norm(layer.W) ** 2 for layer in self.layers])
         cost = loss + self.lamda * r
         return loss, cost
 
     def compute_gradients(self, X, Y, P):
-        G = - (Y - P)
+        """ Backpropagates the cross entropy of the probabilities P (overwritten)
+        against the labels Y, one hot encoded or integers """
+        G = self.kernels.cross_entropy_grad(P, labels(Y))
         n_batch = X.shape[1]
         for i, layer in enumerate(reversed(self.layers)):
             G = layer.compute_gradients(
                 G, n_batch, self.lamda, propagate=(i != self.k-1))
 
     def update_parameters(self, eta=1e-2):
-        for layer in self.layers:
-            layer.update_params(eta)
+        self.optimizer.step(self.layers, eta)
 
     def compute_gradients_num(self, X_batch, Y_batch, h=1e-5):
         """ Numerically computes the gradients of the weight and bias parameters
@@ -242,7 +491,7 @@ class MLP():
                     layer.beta = np.copy(beta_try)
                     layer.beta[i] += h
                     _, c1 = self.compute_cost(X_batch, Y_batch)
-                    layer.beta = np.copy(gamma_try)
+                    layer.beta = np.copy(beta_try)
                     layer.beta[i] -= h
                     _, c2 = self.compute_cost(X_batch, Y_batch)
                     grads['beta' + str(j)][i] = (c1-c2) / (2*h)
@@ -256,12 +505,8 @@ class MLP():
         rerr_w, rerr_b, rerr_gamma, rerr_beta = [], [], [], []
         aerr_w, aerr_b, aerr_gamma, aerr_beta = [], [], [], []
 
-        def _rel_error(x, y, eps): return np.abs(
-            x-y)/max(eps, np.abs(x)+np.abs(y))
-
         def rel_error(g1, g2, eps):
-            vfunc = np.vectorize(_rel_error)
-            return fun(vfunc(g1, g2, eps))
+            return fun(relative_error(g1, g2, eps))
 
         for i, layer in enumerate(self.layers):
             rerr_w.append(rel_error(layer.grad_W, gn[f'W{i}'], eps))
@@ -283,45 +528,145 @@ class MLP():
         else:
             return rerr_w, aerr_w, rerr_b, aerr_b
 
+    def running_stats(self):
+        return [(layer, s, getattr(layer, s)) for layer in self.layers for s in layer.stats]
+
+    def restore_stats(self, stats):
+        """ Undoes the updates of the BN running averages made by train mode forward passes """
+        for layer, s, value in stats:
+            setattr(layer, s, value)
+
+    def perturbed_cost(self, X, Y, direction, h):
+        """ Cost with the parameters moved in place by h along direction, a list of
+        (layer index, parameter, index, step). Parameters and BN statistics are restored after """
+        stats = self.running_stats()
+        saved = []
+        for i, p, idx, step in direction:
+            param = getattr(self.layers[i], p)
+            saved.append((param, idx, np.array(param[idx])))
+            param[idx] += h * step
+        try:
+            _, cost = self.compute_cost(X, Y)
+        finally:
+            for param, idx, value in saved:
+                param[idx] = value
+            self.restore_stats(stats)
+        return cost
+
+    def directional_difference(self, X, Y, direction, h=1e-5):
+        """ Central difference of the cost along direction """
+        return (self.perturbed_cost(X, Y, direction, h) - self.perturbed_cost(X, Y, direction, -h)) / (2*h)
+
+    def check_gradients(self, X, Y, n_samples=10, n_directions=0, h=1e-5, eps=1e-10, seed=None, n_workers=None):
+        """ Checks the analytical gradients against central differences at n_samples random coordinates
+        of every parameter tensor, and along n_directions random unit directions of the whole parameter
+        space. The differences are spread over n_workers processes (1 to run them in this process).
+        Returns the relative errors, keyed 'W0', 'b0', 'gamma0', ... and 'directions' """
+        stats = self.running_stats()
+        self.compute_gradients(X, Y, self.forward_pass(X))
+        self.restore_stats(stats)
+
+        rng = np.random.RandomState(seed)
+        keys, analytic, directions = [], [], []
+        for i, layer in enumerate(self.layers):
+            for p in layer.params:
+                param, grad = getattr(layer, p), getattr(layer, "grad_" + p)
+                flat = rng.choice(param.size, min(n_samples, param.size), replace=False)
+                for idx in zip(*np.unravel_index(flat, param.shape)):
+                    keys.append(f"{p}{i}")
+                    analytic.append(grad[idx])
+                    directions.append([(i, p, idx, 1.)])
+        for _ in range(n_directions):
+            steps = [(i, p, rng.standard_normal(getattr(layer, p).shape))
+                     for i, layer in enumerate(self.layers) for p in layer.params]
+            norm = np.sqrt(sum(np.sum(v**2) for _, _, v in steps))
+            keys.append("directions")
+            analytic.append(sum(np.sum(getattr(self.layers[i], "grad_" + p) * v) / norm for i, p, v in steps))
+            directions.append([(i, p, Ellipsis, v / norm) for i, p, v in steps])
+
+        if n_workers == 1:
+            numerical = [self.directional_difference(X, Y, direction, h) for direction in directions]
+        else:
+            n_chunks = n_workers or os.cpu_count()
+            with ProcessPoolExecutor(n_chunks, initializer=_init_check_worker,
+                                     initargs=(self.snapshot(), X, Y)) as pool:
+                chunks = [directions[j::n_chunks] for j in range(n_chunks)]
+                results = list(pool.map(_check_directions, chunks, [h] * n_chunks))
+            numerical = [None] * len(directions)
+            for j, result in enumerate(results):
+                numerical[j::n_chunks] = result
+
+        errors = relative_error(np.array(analytic, dtype=np.float64), np.array(numerical), eps)
+        keys = np.array(keys)
+        return {key: errors[keys == key] for key in dict.fromkeys(keys)}
+
     def compute_accuracy(self, X, y, train_mode=False):
         """ Computes the prediction accuracy of a given state of the network """
-        P = self.forward_pass(X, train_mode=train_mode)
+        P = self.forward_pass(X, train_mode=True) if train_mode else self.predict_proba(X)
         y_pred = np.argmax(P, axis=0)
-        return accuracy_score(y, y_pred)
-
-    def mini_batch_gd(self, data, GDparams, verbose=True, backup=False):
+        return np.mean(y_pred == y)
+
+    def train_loader(self, X, y, batch_size, n_workers=1):
+        """ Minibatch loader of the training loops, computing the gradients on n_workers processes if n_workers > 1 """
+        if n_workers > 1:
+            from parallel import DataParallel
+            return DataParallel(self, X, y, batch_size, n_workers)
+        if self.workspace:
+            self.allocate_workspace(batch_size)
+        return BatchLoader(X, None, y, batch_size)
+
+    def mini_batch_gd(self, data, GDparams, verbose=True, backup=False, async_history=False, patience=0,
+                      monitor="val_loss", n_workers=1):
         """ Performas minibatch gradient descent """
+        from tqdm import tqdm
+        self.start_evaluator(async_history)
+        self.start_early_stopping(patience, monitor)
 
         X, Y, y = data["X_train"], data["Y_train"], data["y_train"]
-        _, n = X.shape
 
         epochs, batch_size, eta = GDparams["n_epochs"], GDparams["n_batch"], GDparams["eta"]
-        self.history(data, 0, verbose, cyclic=False)
+        # epoch of the last evaluation, the one training stops at
+        epoch = 0
+        self.history(data, epoch, verbose, cyclic=False, subsample=GDparams.get("eval_subsample"))
 
-        for epoch in tqdm(range(epochs)):
+        loader = self.train_loader(X, y, batch_size, n_workers)
 
-            X, Y, y = shuffle(X.T, Y.T, y.T, random_state=epoch)
-            X, Y, y = X.T, Y.T, y.T
+        # the worker processes and shared memory of a DataParallel loader are released on errors too
+        try:
+            for epoch in tqdm(range(epochs)):
+                for j, batch in enumerate(loader.epoch(seed=epoch)):
 
-            for j in range(n//batch_size):
-                j_start = j * batch_size
-                j_end = (j+1) * batch_size
-                X_batch = X[:, j_start:j_end]
-                Y_batch = Y[:, j_start:j_end]
+                    if n_workers > 1:
+                        loader.train_step(batch, init=(epoch==0 and j==0))
+                    else:
+                        X_batch, _, y_batch = batch
+                        P_batch = self.forward_pass(X_batch, train_mode=True, init=(epoch==0 and j==0))
 
-                P_batch = self.forward_pass(X_batch, train_mode=True, init=(epoch==0 and j==0))
+                        self.compute_gradients(X_batch, y_batch, P_batch)
 
-                self.compute_gradients(X_batch, Y_batch, P_batch)
+                    self.update_parameters(eta)
 
-                self.update_parameters(eta)
+                self.history(data, epoch, verbose, cyclic=False, subsample=GDparams.get("eval_subsample"))
 
-            self.history(data, epoch, verbose, cyclic=False)
+                if self.patience > 0:
+                    self.collect_history(verbose, wait=True)
+                    if self.early_stop(epoch, cyclic=False, verbose=verbose):
+                        break
+        finally:
+            loader.close()
+        self.stop_evaluator(verbose)
+        self.finish_early_stopping(epoch)
 
         if backup:
             self.backup(GDparams)
 
-    def cyclic_learning(self, data, GDparams, verbose=True, backup=False):
-        """ Performas minibatch gradient descent """
+    def cyclic_learning(self, data, GDparams, verbose=True, backup=False, async_history=False, patience=0,
+                        monitor="val_loss", n_workers=1, n_steps=None):
+        """ Performas minibatch gradient descent, early stopping being decided at the end of the cycles.
+        Training resumes from self.step, for n_steps updates or up to the end of the n_cycles """
+        from tqdm import tqdm
+        self.start_evaluator(async_history)
+        self.start_early_stopping(patience, monitor)
         X, Y, y = data["X_train"], data["Y_train"], data["y_train"]
 
         _, n = X.shape
@@ -329,51 +674,192 @@ class MLP():
         n_cycles, batch_size, eta_min, eta_max, ns, freq = GDparams["n_cycles"], GDparams[
             "n_batch"], GDparams["eta_min"], GDparams["eta_max"], GDparams["ns"], GDparams['freq']
 
-        eta = eta_min
-        t = 0
-
         epochs = batch_size * 2 * ns * n_cycles // n
 
-        for epoch in tqdm(range(epochs)):
+        loader = self.train_loader(X, y, batch_size, n_workers)
 
-            X, Y, y = shuffle(X.T, Y.T, y.T, random_state=epoch)
-            X, Y, y = X.T, Y.T, y.T
+        start, start_time = self.step, time.perf_counter()
+        end = epochs * len(loader) if n_steps is None else start + n_steps
+        t = start % (2*ns)
+        eta = eta_min if start == 0 else self.cyclic_eta((start - 1) % (2*ns), eta_min, eta_max, ns)
 
-            for j in range(n//batch_size):
-                j_start = j * batch_size
-                j_end = (j+1) * batch_size
-                X_batch = X[:, j_start:j_end]
-                Y_batch = Y[:, j_start:j_end]
+        # the worker processes and shared memory of a DataParallel loader are released on errors too
+        try:
+            for epoch in tqdm(range(start // len(loader), -(-end // len(loader)))):
+                offset = max(start - epoch * len(loader), 0)
+                for j, batch in enumerate(loader.epoch(seed=epoch, start=offset), start=offset):
 
-                P_batch = self.forward_pass(
-                    X_batch, train_mode=True, init=(epoch == 0 & j == 0))
+                    if n_workers > 1:
+                        loader.train_step(batch, init=(epoch == 0 and j == 0))
+                    else:
+                        X_batch, _, y_batch = batch
+                        P_batch = self.forward_pass(
+                            X_batch, train_mode=True, init=(epoch == 0 and j == 0))
 
-                self.compute_gradients(X_batch, Y_batch, P_batch)
-                self.update_parameters(eta)
+                        self.compute_gradients(X_batch, y_batch, P_batch)
+                    self.update_parameters(eta)
+
+                    if t % (2*ns//freq) == 0:
+                        self.history(data, t, verbose, subsample=GDparams.get("eval_subsample"))
 
-                if t % (2*ns//freq) == 0:
-                    self.history(data, t, verbose)
+                    eta = self.cyclic_eta(t, eta_min, eta_max, ns)
 
-                if t <= ns:
-                    eta = eta_min + t/ns * (eta_max - eta_min)
+                    t = (t+1) % (2*ns)
+                    self.step = epoch * len(loader) + j + 1
+
+                    if t == 0 and self.patience > 0:
+                        self.collect_history(verbose, wait=True)
+                        if self.early_stop(self.step, verbose=verbose):
+                            break
+                    if self.step == end:
+                        break
                 else:
-                    eta = eta_max - (t - ns)/ns * (eta_max - eta_min)
+                    continue
+                break
+        finally:
+            loader.close()
+        self.stop_evaluator(verbose)
+        self.finish_early_stopping(self.step)
+        self.train_time += time.perf_counter() - start_time
 
-                t = (t+1) % (2*ns)
         if backup:
             self.backup_cyclic(GDparams)
 
-    def history(self, data, epoch, verbose=True, cyclic=True):
-        """ Creates history of the training """
+    def lr_finder(self, data, batch_size=100, eta_min=1e-7, eta_max=10., n_steps=100, beta=0.98, divergence=4.,
+                  drop=0.05, verbose=True):
+        """ Learning rate range test: eta grows exponentially from eta_min to eta_max over n_steps updates
+        while the minibatch loss is tracked with a bias corrected exponential moving average (beta), no
+        evaluation on the full sets involved. The test stops as soon as the smoothed loss exceeds divergence
+        times its minimum or is not finite, and the parameters with the BN statistics and optimizer are restored afterwards.
+        Returns the suggested bounds of cyclic_learning as a dict to update GDparams with, eta_max being a
+        tenth of the eta of the lowest loss and eta_min the eta at which the loss has dropped by the fraction drop
+        (at most eta_max / 4), along with the etas and the smoothed losses """
+        X, y = data["X_train"], data["y_train"]
+        etas = eta_min * (eta_max / eta_min) ** (np.arange(n_steps) / max(n_steps - 1, 1))
+        net, optimizer = self.snapshot(), self.optimizer
+        self.optimizer = copy.deepcopy(optimizer)
+        loader = self.train_loader(X, y, batch_size)
+        losses, avg, best = [], 0., np.inf
+        try:
+            for step, eta in enumerate(etas):
+                # the test is meant to take a fraction of an epoch, longer ones go on with the next permutation
+                if step % len(loader) == 0:
+                    batches = loader.epoch(seed=step // len(loader))
+                X_batch, _, y_batch = next(batches)
+                P_batch = self.forward_pass(X_batch, train_mode=True, init=(step == 0))
+                p_label = P_batch[y_batch, np.arange(len(y_batch))]
+                loss = -np.mean(np.log(np.maximum(p_label, np.finfo(P_batch.dtype).tiny)))
+                self.compute_gradients(X_batch, y_batch, P_batch)
+                self.update_parameters(eta)
+
+                avg = beta * avg + (1 - beta) * loss
+                smoothed = avg / (1 - beta ** (step + 1))
+                losses.append(smoothed)
+                best = min(best, smoothed)
+                if not np.isfinite(smoothed) or smoothed > divergence * best:
+                    if verbose:
+                        print(f"Diverged at step {step}, eta={eta:.3g}")
+                    break
+        finally:
+            loader.close()
+            self.restore(net)
+            self.optimizer = optimizer
+
+        etas = etas[:len(losses)]
+        losses = np.array(losses)
+        i = int(np.nanargmin(np.where(np.isfinite(losses), losses, np.nan)))
+        suggested_max = float(etas[i]) / 10
+        # the drop is measured from a tenth of the test on, the first averages being those of a few batches
+        warmup = min(len(losses) // 10, i)
+        started = np.nonzero(losses[warmup:i+1] < (1 - drop) * losses[warmup])[0]
+        suggested_min = min(float(etas[warmup + started[0]]) if len(started) else suggested_max / 4, suggested_max / 4)
+        if verbose:
+            print(f"Lowest loss {losses[i]:.4f} at eta={etas[i]:.3g}: eta_min={suggested_min:.3g}, eta_max={suggested_max:.3g}")
+        return {"eta_min": suggested_min, "eta_max": suggested_max}, etas, losses
+
+    def summary(self, GDparams):
+        """ Hyperparameters, final and best metrics, wall time and checkpoint of a cyclic learning run,
+        as a row of the results store """
+        n_cycles, batch_size, eta_min, eta_max, ns, exp = GDparams["n_cycles"], GDparams[
+            "n_batch"], GDparams["eta_min"], GDparams["eta_max"], GDparams["ns"], GDparams["exp"]
+        return {"exp": exp, "lamda": self.lamda, "seed": self.seed, "n_cycles": n_cycles, "n_batch": batch_size,
+                "eta_min": eta_min, "eta_max": eta_max, "ns": ns, "steps": self.step,
+                "train_acc": self.train_acc[-1], "val_acc": self.val_acc[-1], "val_loss": self.val_loss[-1],
+                "best_val_acc": max(self.val_acc), "best_val_loss": min(self.val_loss), "wall_time": self.train_time,
+                "checkpoint": f'History/{exp}_checkpoint_{self.backup_name(GDparams, lamda=self.lamda, seed=self.seed)}',
+                "params": {"k": self.k, "dims": self.dims, "batch_norm": self.batch_norm}}
 
-        X, Y, y, X_val, Y_val, y_val = data["X_train"], data["Y_train"], data[
-            "y_train"], data["X_val"], data["Y_val"], data["y_val"]
+    @staticmethod
+    def cyclic_eta(t, eta_min, eta_max, ns):
+        """ Learning rate of the triangular schedule at step t of a cycle of 2 ns steps """
+        if t <= ns:
+            return eta_min + t/ns * (eta_max - eta_min)
+        return eta_max - (t - ns)/ns * (eta_max - eta_min)
+
+    def evaluate(self, X, y, chunk_size=5000):
+        """ Computes loss, cost and accuracy with a single forward pass, made over chunks
+        of columns so that the peak memory does not grow with the number of samples """
+        n = X.shape[1]
+        loss, correct = 0., 0
+        for j in range(0, n, chunk_size):
+            S = self.predict_proba(X[:, j:j+chunk_size], logits=True)
+            losses, _ = self.kernels.cross_entropy(S, y[j:j+chunk_size])
+            loss += np.sum(losses, dtype=np.float64)
+            correct += np.count_nonzero(np.argmax(S, axis=0) == y[j:j+chunk_size])
+        loss = loss / n
+        r = np.sum([np.linalg.norm(layer.W) ** 2 for layer in self.layers])
+        cost = loss + self.lamda * r
+        return loss, cost, correct / n
 
-        t_loss, t_cost = self.compute_cost(X, Y, train_mode=False)
-        v_loss, v_cost = self.compute_cost(X_val, Y_val, train_mode=False)
+    def eval_subset(self, n, subsample):
+        """ Fixed random subset of the training set used for the train-side metrics """
+        return np.sort(np.random.RandomState(self.seed).choice(n, subsample, replace=False))
 
-        t_acc = self.compute_accuracy(X, y, train_mode=False)
-        v_acc = self.compute_accuracy(X_val, y_val, train_mode=False)
+    def snapshot(self):
+        """ Copy of the network holding its own copies of the parameters, cheap enough to be
+        taken at every history step and evaluated while the original keeps training """
+        net = copy.copy(self)
+        net.layers = []
+        for layer in self.layers:
+            clone = copy.copy(layer)
+            clone.master = None
+            clone.workspace, clone.buffers = None, None
+            for p in layer.params + layer.stats:
+                setattr(clone, p, getattr(layer, p).copy())
+            net.layers.append(clone)
+        net.evaluator, net.pending = None, []
+        return net
+
+    def history(self, data, epoch, verbose=True, cyclic=True, subsample=None):
+        """ Creates history of the training, the train metrics being computed on a fixed
+        subset of subsample columns if given. When an evaluator is running, the metrics of a
+        snapshot are computed in the background and recorded in step order by collect_history """
+
+        if self.evaluator is None:
+            self.record_history(epoch, cyclic, self.history_metrics(data, subsample), verbose)
+            return
+
+        # backpressure: never let more than two evaluations queue behind training
+        if len(self.pending) >= 2:
+            self.pending[0][2].result()
+        net = self.snapshot()
+        self.pending.append((epoch, cyclic, self.evaluator.submit(
+            net.history_metrics, data, subsample), net))
+        self.collect_history(verbose)
+
+    def history_metrics(self, data, subsample=None):
+        X, y, X_val, y_val = data["X_train"], data["y_train"], data["X_val"], data["y_val"]
+
+        if subsample is not None and subsample < X.shape[1]:
+            idx = self.eval_subset(X.shape[1], subsample)
+            X, y = X[:, idx], y[idx]
+
+        t_loss, t_cost, t_acc = self.evaluate(X, y)
+        v_loss, v_cost, v_acc = self.evaluate(X_val, y_val)
+        return t_loss, t_cost, t_acc, v_loss, v_cost, v_acc
+
+    def record_history(self, epoch, cyclic, metrics, verbose=True, net=None):
+        t_loss, t_cost, t_acc, v_loss, v_cost, v_acc = metrics
 
         if verbose:
             pref = "Update Step " if cyclic else "Epoch "
@@ -387,37 +873,141 @@ class MLP():
         self.train_acc.append(t_acc)
         self.val_acc.append(v_acc)
 
-    def backup(self, GDparams):
-        """ Saves networks params in order to be able to reuse it """
-
-        epochs, batch_size, eta, exp = GDparams["n_epochs"], GDparams["n_batch"], GDparams["eta"], GDparams["exp"]
+        if self.patience > 0:
+            self.track_best(net)
+
+    def start_evaluator(self, async_history):
+        if async_history:
+            self.evaluator = ThreadPoolExecutor(max_workers=1)
+
+    def collect_history(self, verbose=True, wait=False):
+        """ Records the finished background evaluations in step order, waiting for all of them if asked """
+        while self.pending and (wait or self.pending[0][2].done()):
+            epoch, cyclic, future, net = self.pending.pop(0)
+            self.record_history(epoch, cyclic, future.result(), verbose, net)
+
+    def stop_evaluator(self, verbose=True):
+        if self.evaluator is not None:
+            self.collect_history(verbose, wait=True)
+            self.evaluator.shutdown()
+            self.evaluator = None
+
+    def start_early_stopping(self, patience=0, monitor="val_loss"):
+        """ Stops the training once the monitored validation metric (val_loss, val_cost or val_acc)
+        has not improved for patience evaluations, 0 disables early stopping """
+        self.patience, self.monitor = patience, monitor
+        self.best, self.stale = None, 0
+        self.best_eval, self.stop_reason, self.stop_step = None, None, None
+
+    def track_best(self, net=None):
+        """ Keeps a copy of the parameters of the best evaluation so far, net being the evaluated
+        snapshot if any, and counts the evaluations without improvement since """
+        values = getattr(self, self.monitor)
+        value = values[-1]
+        if self.monitor.endswith("acc"):
+            value = -value
+        if self.best is None or value < self.best["value"]:
+            self.best = {"value": value, "net": net if net is not None else self.snapshot()}
+            self.best_eval, self.stale = len(values) - 1, 0
+        else:
+            self.stale += 1
+
+    def early_stop(self, step, cyclic=True, verbose=True):
+        if self.patience > 0 and self.stale >= self.patience:
+            self.stop_reason, self.stop_step = "patience", step
+            if verbose:
+                pref = "Update Step " if cyclic else "Epoch "
+                print(f"Early Stopping @ {pref}{step}")
+            return True
+        return False
+
+    def finish_early_stopping(self, step):
+        """ Records the stop of a completed training and restores the best parameters """
+        if self.stop_reason is None:
+            self.stop_reason, self.stop_step = "completed", step
+        if self.best is not None:
+            self.restore(self.best["net"])
+            self.best = None
+
+    def restore(self, net):
+        """ Copies the parameters of net, a snapshot of this network, into its layers """
+        for layer, saved in zip(self.layers, net.layers):
+            for p in layer.params:
+                getattr(layer, p)[...] = getattr(saved, p)
+            for s in layer.stats:
+                setattr(layer, s, getattr(saved, s).copy())
+            if layer.master is not None:
+                layer.keep_master_copy()
 
-        np.save(
-            f'History/{exp}_layers_{epochs}_{batch_size}_{eta}_{self.lamda}_{self.seed}.npy', self.layers)
+    @staticmethod
+    def backup_name(GDparams, cyclic=True, lamda=None, seed=None):
+        """ Training parameters, lambda and seed identifying a backup """
+        if cyclic:
+            name = f'{GDparams["n_cycles"]}_{GDparams["n_batch"]}_{GDparams["eta_min"]}_{GDparams["eta_max"]}_{GDparams["ns"]}'
+        else:
+            name = f'{GDparams["n_epochs"]}_{GDparams["n_batch"]}_{GDparams["eta"]}'
+        return f'{name}_{lamda}_{seed}'
+
+    def hist(self):
+        """ History and training state saved with the parameters """
+        return {"train_loss": self.train_loss, "train_acc": self.train_acc, "train_cost": self.train_cost,
+                "val_loss": self.val_loss, "val_acc": self.val_acc, "val_cost": self.val_cost,
+                "best_eval": self.best_eval, "stop_reason": self.stop_reason, "stop_step": self.stop_step,
+                "step": self.step}
+
+    def load_hist(self, hist):
+        self.train_acc = hist['train_acc']
+        self.train_loss = hist["train_loss"]
+        self.train_cost = hist["train_cost"]
+        self.val_acc = hist['val_acc']
+        self.val_loss = hist["val_loss"]
+        self.val_cost = hist["val_cost"]
+        self.best_eval, self.stop_reason, self.stop_step = (
+            hist.get(key) for key in ["best_eval", "stop_reason", "stop_step"])
+        self.step = hist.get("step", 0)
+
+    def checkpoint(self):
+        """ Arrays and meta data of the network for save_checkpoint: parameters, BN statistics and
+        optimizer state as arrays, architecture, optimizer hyperparameters and history as meta data """
+        arrays = layer_arrays(self.layers)
+        state, optimizer = optimizer_arrays(self.optimizer.state_dict())
+        arrays.update(state)
+        meta = {"k": self.k, "dims": self.dims, "lamda": self.lamda, "seed": self.seed, "batch_norm": self.batch_norm,
+                "dtype": self.dtype.name, "optimizer": optimizer, "history": self.hist()}
+        return arrays, meta
+
+    def restore_checkpoint(self, arrays, meta):
+        """ Sets the parameters, optimizer and history of the output of load_checkpoint """
+        set_layer_arrays(self.layers, arrays)
+        for layer in self.layers:
+            if layer.master is not None:
+                layer.keep_master_copy()
+        if "optimizer" in meta:
+            self.optimizer = load_optimizer(optimizer_state(meta["optimizer"], arrays))
+        if "history" in meta:
+            self.load_hist(meta["history"])
 
-        hist = {"train_loss": self.train_loss, "train_acc": self.train_acc, "train_cost": self.train_cost,
-                "val_loss": self.val_loss, "val_acc": self.val_acc, "val_cost": self.val_cost}
+    @staticmethod
+    def from_checkpoint(path, mmap_mode=None):
+        """ Network saved in the checkpoint directory path, see checkpoint.load_checkpoint for mmap_mode """
+        arrays, meta = load_checkpoint(path, mmap_mode)
+        mlp = MLP(meta["k"], meta["dims"], meta.get("lamda", 0), meta.get("seed", 42), batch_norm=meta["batch_norm"], dtype=meta["dtype"])
+        mlp.restore_checkpoint(arrays, meta)
+        return mlp
 
-        np.save(
-            f'History/{exp}_hist_{epochs}_{batch_size}_{eta}_{self.lamda}_{self.seed}.npy', hist)
+    def backup(self, GDparams):
+        """ Saves networks params in order to be able to reuse it """
+        name = self.backup_name(GDparams, cyclic=False, lamda=self.lamda, seed=self.seed)
+        save_checkpoint(f'History/{GDparams["exp"]}_checkpoint_{name}', *self.checkpoint())
 
     def backup_cyclic(self, GDparams):
         """ Saves networks params in order to be able to reuse it for cyclic learning"""
-
-        n_cycles, batch_size, eta_min, eta_max, ns, exp = GDparams["n_cycles"], GDparams[
-            "n_batch"], GDparams["eta_min"], GDparams["eta_max"], GDparams["ns"], GDparams["exp"]
-
-        np.save(
-            f'History/{exp}_layers_{n_cycles}_{batch_size}_{eta_min}_{eta_max}_{ns}_{self.lamda}_{self.seed}.npy', self.layers)
-
-        hist = {"train_loss": self.train_loss, "train_acc": self.train_acc, "train_cost": self.train_cost,
-                "val_loss": self.val_loss, "val_acc": self.val_acc, "val_cost": self.val_cost}
-
-        np.save(
-            f'History/{exp}_hist_{n_cycles}_{batch_size}_{eta_min}_{eta_max}_{ns}_{self.lamda}_{self.seed}.npy', hist)
+        name = self.backup_name(GDparams, lamda=self.lamda, seed=self.seed)
+        save_checkpoint(f'History/{GDparams["exp"]}_checkpoint_{name}', *self.checkpoint())
 
     def plot_metric(self, GDparams, metric="loss", cyclic=True):
         """ Plots a given metric (loss or accuracy) """
+        import matplotlib.pyplot as plt
 
         if cyclic:
             n_cycles, batch_size, eta_min, eta_max, ns = GDparams["n_cycles"], GDparams[
@@ -456,43 +1046,31 @@ class MLP():
         plt.show()
 
     @staticmethod
-    def load_mlp(GDparams, cyclic=True, k=2, dims=[3072, 50, 10], lamda=0, seed=42, batch_norm=True, init=Initialization.HE):
+    def load_mlp(GDparams, cyclic=True, k=2, dims=[3072, 50, 10], lamda=0, seed=42, batch_norm=True, init=Initialization.HE,
+                 mmap_mode=None):
+        """ Loads a network saved by backup or backup_cyclic, from its checkpoint directory, the arrays
+        being memory mapped with mmap_mode, or from the pickled files of older backups """
         mlp = MLP(k, dims, lamda, seed, batch_norm=batch_norm, init=init)
-        if cyclic:
-
-            n_cycles, batch_size, eta_min, eta_max, ns, exp = GDparams["n_cycles"], GDparams[
-                "n_batch"], GDparams["eta_min"], GDparams["eta_max"], GDparams["ns"], GDparams["exp"]
-            layers = np.load(
-                f'History/{exp}_layers_{n_cycles}_{batch_size}_{eta_min}_{eta_max}_{ns}_{mlp.lamda}_{mlp.seed}.npy', allow_pickle=True)
-            hist = np.load(
-                f'History/{exp}_hist_{n_cycles}_{batch_size}_{eta_min}_{eta_max}_{ns}_{mlp.lamda}_{mlp.seed}.npy', allow_pickle=True)
-        else:
-
-            epochs, batch_size, eta, exp = GDparams["n_epochs"], GDparams[
-                "n_batch"], GDparams["eta"], GDparams["exp"]
-
-            layers = np.load(
-                f'History/{exp}_layers_{epochs}_{batch_size}_{eta}_{mlp.lamda}_{mlp.seed}.npy', allow_pickle=True)
-
-            hist = np.load(
-                f'History/{exp}_hist_{epochs}_{batch_size}_{eta}_{mlp.lamda}_{mlp.seed}.npy', allow_pickle=True)
+        exp, name = GDparams["exp"], MLP.backup_name(GDparams, cyclic, mlp.lamda, mlp.seed)
+        if is_checkpoint(f'History/{exp}_checkpoint_{name}'):
+            mlp.restore_checkpoint(*load_checkpoint(f'History/{exp}_checkpoint_{name}', mmap_mode))
+            return mlp
 
-        mlp.layers = layers
-
-        mlp.train_acc = hist.item()['train_acc']
-        mlp.train_loss = hist.item()["train_loss"]
-        mlp.train_cost = hist.item()["train_cost"]
-        mlp.val_acc = hist.item()['val_acc']
-        mlp.val_loss = hist.item()["val_loss"]
-        mlp.val_cost = hist.item()["val_cost"]
+        mlp.layers = np.load(f'History/{exp}_layers_{name}.npy', allow_pickle=True)
+        optimizer = f'History/{exp}_optimizer_{name}.npy'
+        if os.path.exists(optimizer):
+            mlp.optimizer = load_optimizer(np.load(optimizer, allow_pickle=True).item())
+        mlp.load_hist(np.load(f'History/{exp}_hist_{name}.npy', allow_pickle=True).item())
 
         return mlp
 
 
 class Search():
     
-    def __init__(self, l_min=-5, l_max=-1, n_lambda=20, sample=True, seed=42):
+    def __init__(self, l_min=-5, l_max=-1, n_lambda=20, sample=True, seed=42, store=RESULTS_DB):
         np.random.seed(seed)
+        # SQLite file the trials append their summaries to, None to disable
+        self.store = store
         self.l_min = l_min
         self.l_max = l_max
         self.n_lambda = n_lambda
@@ -507,23 +1085,143 @@ class Search():
         lambdas = [10**e for e in exp]
         return lambdas
 
-    def random_search(self, data, GDparams, lamdas=None, k=3, dims=[3072,50,50,10], batch_norm=True, init=Initialization.HE):
+    def random_search(self, data, GDparams, lamdas=None, k=3, dims=[3072,50,50,10], batch_norm=True, init=Initialization.HE,
+                      n_workers=1, threads=None, verbose=True):
+        """ Trains an MLP per lambda with cyclic learning, on n_workers processes sharing the dataset through fork,
+        each with threads BLAS threads (cpu count // n_workers by default). The results are collected in
+        self.results as the trials finish, a failed trial being recorded with its error, and appended to
+        the results store """
         if lamdas is not None:
             self.lambdas = lamdas
-        for lmda in self.lambdas:
-            mlp = MLP(lamda=lmda, k=k, dims=dims, batch_norm=batch_norm, init=init)
-            mlp.cyclic_learning(
-                data, GDparams, verbose=False, backup=True)
-
-    def random_search_perf(self, GDparams, lamdas=None, k=3, dims=[3072,50,50,10], batch_norm=True, init=Initialization.HE):
+        params = {"k": k, "dims": dims, "batch_norm": batch_norm, "init": init}
+        self.results = []
+        trials = [(lmda, _search_trial, (lmda, GDparams, params, self.store)) for lmda in self.lambdas]
+        for lmda, result in self.run_trials(data, trials, n_workers, threads):
+            if isinstance(result, Exception):
+                result = {"lamda": lmda, "error": repr(result)}
+            self.collect(result, len(trials), verbose)
+        return self.results
+
+    def successive_halving(self, data, GDparams, lamdas=None, k=3, dims=[3072,50,50,10], batch_norm=True,
+                           init=Initialization.HE, min_steps=None, reduction=3, n_workers=1, threads=None, verbose=True):
+        """ Successive halving over the lambdas: every candidate is trained for min_steps updates (one cycle
+        by default), the 1/reduction best ones by validation accuracy are resumed with reduction times more
+        updates, and so on until the survivors reach the end of the n_cycles. The ranking of every rung
+        is kept in self.rungs, and the final networks are backed up as by random_search.
+        Returns the best lambda and its network """
         if lamdas is not None:
             self.lambdas = lamdas
+        params = {"k": k, "dims": dims, "batch_norm": batch_norm, "init": init}
+        n_cycles, ns = GDparams["n_cycles"], GDparams["ns"]
+        total = 2 * ns * n_cycles
+        budget = min(2 * ns if min_steps is None else min_steps, total)
+
+        nets = {lmda: MLP(lamda=lmda, **params) for lmda in self.lambdas}
+        self.rungs = []
+        while nets:
+            final = budget >= total
+            trials = [(lmda, _halving_trial, (mlp, GDparams, None if final else budget - mlp.step, final,
+                                                    self.store))
+                      for lmda, mlp in nets.items()]
+            self.results = []
+            for lmda, result in self.run_trials(data, trials, n_workers, threads):
+                if isinstance(result, Exception):
+                    del nets[lmda]
+                    self.collect({"lamda": lmda, "error": repr(result)}, len(trials), verbose)
+                    continue
+                nets[lmda], metrics = result
+                self.collect({"lamda": lmda, **metrics}, len(trials), verbose)
+
+            ranking = sorted((r for r in self.results if "error" not in r), key=lambda r: -r["val_acc"])
+            self.rungs.append({"steps": budget, "ranking": ranking})
+            if verbose:
+                print(f"Rung {len(self.rungs)}: {len(ranking)} candidates after {budget} steps")
+                self.print_ranking(ranking)
+            if final or not ranking:
+                break
+
+            keep = max(1, len(ranking) // reduction)
+            nets = {r["lamda"]: nets[r["lamda"]] for r in ranking[:keep]}
+            budget = total if keep == 1 else min(budget * reduction, total)
+
+        best = self.rungs[-1]["ranking"][0]["lamda"] if ranking else None
+        return best, nets.get(best)
+
+    def run_trials(self, data, trials, n_workers=1, threads=None):
+        """ Runs the trials, (key, function, args) tuples, on n_workers processes and yields the (key, result)
+        pairs as they finish, result being the exception raised by a failed trial """
+        if n_workers == 1:
+            _search["data"] = data
+            try:
+                for key, fn, args in trials:
+                    try:
+                        result = fn(*args)
+                    except Exception as e:
+                        result = e
+                    yield key, result
+            finally:
+                _search.clear()
+            return
+
+        if threads is None:
+            threads = max(1, os.cpu_count() // n_workers)
+        ctx = mp.get_context("fork" if "fork" in mp.get_all_start_methods() else "spawn")
+        with ProcessPoolExecutor(n_workers, mp_context=ctx, initializer=_init_search_worker,
+                                 initargs=(data, threads)) as pool:
+            futures = {pool.submit(fn, *args): key for key, fn, args in trials}
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = e
+                yield futures[future], result
+
+    def collect(self, result, n_trials, verbose=True):
+        """ Records the result of a finished trial """
+        self.results.append(result)
+        if verbose:
+            if "error" in result:
+                print(f'lamda={result["lamda"]} failed: {result["error"]}')
+            else:
+                print(f'[{len(self.results)}/{n_trials}] lamda={result["lamda"]} | '
+                      f'train_acc={result["train_acc"]} | val_acc={result["val_acc"]}')
+
+    @staticmethod
+    def print_ranking(results):
+        """ Prints lambda, train and validation accuracies as LaTeX table rows, best validation accuracy first """
         models = defaultdict(list)
-        for lmda in self.lambdas:
-            model = MLP.load_mlp(GDparams, cyclic=True, lamda=lmda,
-                                 k=k, dims=dims, batch_norm=batch_norm, init=init)
-            models[model.val_acc[-1]*100
-                ].append({"lamda": round(lmda,7), "train_acc": round(model.train_acc[-1]*100, 5)})
+        for result in results:
+            models[result["val_acc"]*100
+                ].append({"lamda": round(result["lamda"],7), "train_acc": round(result["train_acc"]*100, 5)})
         for acc in sorted(models.keys(), reverse=True):
             for v in models[acc]:
                 print(f'{v["lamda"]} & {v["train_acc"]} & {round(acc,5)} \\\\')
+
+    def random_search_perf(self, GDparams, lamdas=None, k=3, dims=[3072,50,50,10], batch_norm=True, init=Initialization.HE):
+        """ Prints the ranking of the lambdas, from the results store when it has all of them,
+        from the backed up histories otherwise """
+        if lamdas is not None:
+            self.lambdas = lamdas
+        results = self.stored_results(GDparams, k=k, dims=dims, batch_norm=batch_norm)
+        if results is None:
+            results = []
+            for lmda in self.lambdas:
+                model = MLP.load_mlp(GDparams, cyclic=True, lamda=lmda,
+                                     k=k, dims=dims, batch_norm=batch_norm, init=init)
+                results.append({"lamda": lmda, "train_acc": model.train_acc[-1], "val_acc": model.val_acc[-1]})
+        self.print_ranking(results)
+
+    def stored_results(self, GDparams, seed=42, **params):
+        """ Latest stored summary of every lambda trained with GDparams and the network params,
+        None if the store misses some of them """
+        if self.store is None or not os.path.exists(self.store):
+            return None
+        with ResultsStore(self.store) as store:
+            rows = store.query(order_by="id", descending=False, exp=GDparams["exp"], seed=seed,
+                               n_cycles=GDparams["n_cycles"], n_batch=GDparams["n_batch"], eta_min=GDparams["eta_min"],
+                               eta_max=GDparams["eta_max"], ns=GDparams["ns"], lamda=list(self.lambdas))
+        latest = {row["lamda"]: row for row in rows
+                  if all(json.loads(row["params"]).get(key) == value for key, value in params.items())}
+        if not all(lmda in latest for lmda in self.lambdas):
+            return None
+        return [latest[lmda] for lmda in self.lambdas]
@@ -0,0 +1,208 @@
+""" Data parallel training of the MLP. Worker processes compute the gradients of shards of every
+minibatch, the training set and the parameters being shared through shared memory. The training
+process sums the gradients of the workers and makes a synchronous update of the shared parameters.
+BN layers all-reduce their batch sums, so that every shard is normalized with the statistics of the
+whole minibatch and the training is equivalent to the single process one. """
+import multiprocessing as mp
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+
+class SharedArray():
+    """ Numpy array backed by a shared memory block, attached by name when unpickled """
+
+    def __init__(self, shape, dtype, name=None):
+        self.shape, self.dtype = tuple(shape), np.dtype(dtype)
+        size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def __getstate__(self):
+        return self.shape, self.dtype, self.shm.name
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+        # the block belongs to the training process, which unlinks it
+        resource_tracker.unregister(self.shm._name, "shared_memory")
+
+    def close(self, unlink=False):
+        del self.array
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def param_layout(layers, names):
+    """ Keys, shapes and offsets of the arrays names(layer) of the layers packed in a flat buffer """
+    layout, offset = [], 0
+    for i, layer in enumerate(layers):
+        for name in names(layer):
+            shape = getattr(layer, name).shape
+            layout.append((i, name, offset, shape))
+            offset += int(np.prod(shape))
+    return layout, offset
+
+
+def unpack(flat, layout):
+    """ Views of the flat buffer, in the order of the layout """
+    return [flat[offset:offset+int(np.prod(shape))].reshape(shape) for _, _, offset, shape in layout]
+
+
+class Sync():
+    """ All-reduce of the BN batch sums: every worker writes its partial sums in its slot, waits for
+    the others and adds the slots up in the same order, the k-th reduction of a step using the k-th slot """
+
+    def __init__(self, rank, slots, barrier, n_batch):
+        self.rank, self.slots, self.barrier = rank, slots, barrier
+        self.n_batch = n_batch
+        self.k = 0
+
+    def allreduce(self, S):
+        slot = self.slots[self.k]
+        self.k += 1
+        d = S.shape[0]
+        slot[self.rank, :d] = S[:, 0]
+        self.barrier.wait()
+        return np.sum(slot[:, :d], axis=0).reshape(S.shape).astype(S.dtype, copy=False)
+
+
+def _worker(rank, n_workers, net, shared, layouts, batch_size, step_barrier, sync_barrier):
+    try:
+        try:
+            from threadpoolctl import threadpool_limits
+            threadpool_limits(1)
+        except ImportError:
+            pass
+        X, y, idx, control = (shared[key].array for key in ["X", "y", "idx", "control"])
+        params, stats = layouts["params"], layouts["stats"]
+
+        for (i, p, _, _), view in zip(params, unpack(shared["params"].array, params)):
+            setattr(net.layers[i], p, view)
+        grads = unpack(shared["grads"].array[rank], params)
+        stat_views = unpack(shared["stats"].array, stats)
+
+        sync = Sync(rank, shared["slots"].array, sync_barrier, batch_size)
+        for layer in net.layers:
+            if layer.stats:
+                layer.sync = sync
+        # the regularization term of the gradients is only added by the first worker
+        lamda = net.lamda if rank == 0 else 0
+        start, end = rank * batch_size // n_workers, (rank + 1) * batch_size // n_workers
+
+        while True:
+            step_barrier.wait()
+            if control[0]:
+                break
+            cols = idx[start:end]
+            sync.k = 0
+            P = net.forward_pass(X[:, cols], train_mode=True, init=bool(control[1]))
+            G = net.kernels.cross_entropy_grad(P, y[cols])
+            for j, layer in enumerate(reversed(net.layers)):
+                G = layer.compute_gradients(G, batch_size, lamda, propagate=(j != net.k-1))
+
+            for (i, p, _, _), view in zip(params, grads):
+                view[...] = getattr(net.layers[i], "grad_" + p)
+            if rank == 0:
+                for (i, s, _, _), view in zip(stats, stat_views):
+                    view[...] = getattr(net.layers[i], s)
+            step_barrier.wait()
+    except BaseException:
+        # releases the training process and the other workers
+        step_barrier.abort()
+        sync_barrier.abort()
+        raise
+    finally:
+        for array in shared.values():
+            array.close()
+
+
+class DataParallel():
+    """ Computes the gradients of the minibatches of (X, y) on n_workers processes, for the training
+    loops of net: the parameters of net live in shared memory while it is open, and train_step leaves
+    the summed gradients in the layers for update_parameters """
+
+    def __init__(self, net, X, y, batch_size, n_workers):
+        if net.workspace:
+            raise ValueError("data parallel training does not use the layer workspace")
+        self.net = net
+        self.n, self.batch_size, self.n_workers = X.shape[1], batch_size, n_workers
+        self.n_batches = self.n // batch_size
+        ctx = mp.get_context("fork" if "fork" in mp.get_all_start_methods() else "spawn")
+
+        params, n_params = param_layout(net.layers, lambda layer: layer.params)
+        stats, n_stats = param_layout(net.layers, lambda layer: layer.stats)
+        self.layouts = {"params": params, "stats": stats}
+        bn_dims = [layer.d_out for layer in net.layers if layer.stats]
+
+        self.shared = {
+            "X": SharedArray(X.shape, X.dtype),
+            "y": SharedArray(y.shape, y.dtype),
+            "idx": SharedArray((batch_size,), np.int64),
+            # stop flag and BN init flag
+            "control": SharedArray((2,), np.int64),
+            "params": SharedArray((n_params,), net.dtype),
+            "grads": SharedArray((n_workers, n_params), net.dtype),
+            "stats": SharedArray((n_stats,), net.dtype),
+            # 2 reductions in the forward pass and 2 in the backward pass of every BN layer
+            "slots": SharedArray((4 * len(bn_dims), n_workers, max(bn_dims, default=0)), net.dtype),
+        }
+        self.shared["X"].array[...] = X
+        self.shared["y"].array[...] = y
+        self.shared["control"].array[...] = 0
+
+        for (i, p, _, _), view in zip(params, unpack(self.shared["params"].array, params)):
+            view[...] = getattr(net.layers[i], p)
+            setattr(net.layers[i], p, view)
+
+        self.step_barrier = ctx.Barrier(n_workers + 1)
+        sync_barrier = ctx.Barrier(n_workers)
+        self.workers = [ctx.Process(target=_worker, daemon=True, args=(
+            rank, n_workers, net.snapshot(), self.shared, self.layouts, batch_size, self.step_barrier, sync_barrier))
+            for rank in range(n_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def __len__(self):
+        return self.n_batches
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def epoch(self, seed, start=0):
+        """ Yields the column indices of the minibatches of one epoch, shuffled as by BatchLoader.epoch """
+        perm = np.random.RandomState(seed).permutation(self.n)
+        for j in range(start, self.n_batches):
+            yield perm[j*self.batch_size:(j+1)*self.batch_size]
+
+    def train_step(self, idx, init=False):
+        """ Computes the gradients of the minibatch of columns idx on the workers """
+        self.shared["idx"].array[...] = idx
+        self.shared["control"].array[1] = init
+        self.step_barrier.wait()
+        self.step_barrier.wait()
+
+        grads = np.sum(self.shared["grads"].array, axis=0)
+        for (i, p, _, _), grad in zip(self.layouts["params"], unpack(grads, self.layouts["params"])):
+            setattr(self.net.layers[i], "grad_" + p, grad)
+        for (i, s, _, _), stat in zip(self.layouts["stats"], unpack(self.shared["stats"].array, self.layouts["stats"])):
+            setattr(self.net.layers[i], s, stat.copy())
+
+    def close(self):
+        """ Stops the workers and gives the network its own copy of the parameters back """
+        if self.workers:
+            self.shared["control"].array[0] = 1
+            try:
+                self.step_barrier.wait()
+            except Exception:
+                pass
+            for worker in self.workers:
+                worker.join()
+            self.workers = []
+            for i, p, _, _ in self.layouts["params"]:
+                setattr(self.net.layers[i], p, getattr(self.net.layers[i], p).copy())
+            for array in self.shared.values():
+                array.close(unlink=True)
@@ -0,0 +1,198 @@
+""" Local prediction service for the networks saved by MLP.backup and backup_cyclic (checkpoint directories).
+The model is loaded once. Concurrent single-image requests are gathered by a MicroBatcher into batches of up
+to max_batch columns, or of whatever arrived within max_delay seconds of the first one, and every batch is
+answered by a single inference only pass (MLP.predict_proba). Latency percentiles and throughput are reported.
+
+    python serve.py History/<exp>_checkpoint_<name> [--port 8000] [--max_batch 64] [--max_delay 0.002]
+
+POST /predict with a JSON body {"x": [3072 features]}, or the raw float32 features as application/octet-stream,
+returns {"probabilities": [...], "class": k}. GET /stats returns the latency and throughput report. The features
+are expected preprocessed as for training, unless a Standardizer saved with Standardizer.save is given.
+"""
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from mlp import MLP
+from utils import Standardizer
+
+
+class MicroBatcher():
+    """ Runs the requests submitted from any thread in micro batches on a single worker thread, which
+    owns the batch buffer and the network """
+
+    def __init__(self, model, max_batch=64, max_delay=0.002, standardizer=None, window=10000):
+        self.model = model
+        self.max_batch, self.max_delay = max_batch, max_delay
+        self.standardizer = standardizer
+        self.d = model.dims[0]
+        # one column per request, columns being contiguous so that filling the batch copies runs of memory
+        self.batch = np.empty((self.d, max_batch), dtype=model.dtype, order='F')
+        self.requests = queue.Queue()
+        # latencies (queueing and computation) of the last window requests and sizes of the batches
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.n_requests, self.start = 0, time.perf_counter()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, x):
+        """ Future of the class probabilities of the features x (d,) """
+        future = Future()
+        self.requests.put((time.perf_counter(), x, future))
+        return future
+
+    def predict(self, x, timeout=None):
+        return self.submit(x).result(timeout)
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            batch, deadline = [request], request[0] + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    request = self.requests.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    # answer what has been gathered, then stop
+                    self.requests.put(None)
+                    break
+                batch.append(request)
+            self.process(batch)
+
+    def process(self, batch):
+        n = len(batch)
+        X = self.batch[:, :n]
+        try:
+            for j, (_, x, _) in enumerate(batch):
+                X[:, j] = x
+            if self.standardizer is not None:
+                self.standardizer.transform(X, inplace=True)
+            P = self.model.predict_proba(X)
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        done = time.perf_counter()
+        for j, (_, _, future) in enumerate(batch):
+            future.set_result(P[:, j].copy())
+        with self.lock:
+            self.latencies.extend(done - arrival for arrival, _, _ in batch)
+            self.batch_sizes.append(n)
+            self.n_requests += n
+
+    def stats(self):
+        """ Requests served, throughput since start, p50/p99 latency (ms) and mean batch size of the last requests """
+        with self.lock:
+            latencies, sizes, n = np.array(self.latencies), np.array(self.batch_sizes), self.n_requests
+        report = {"requests": n, "throughput": n / (time.perf_counter() - self.start)}
+        if n:
+            report.update(p50_ms=1000 * float(np.percentile(latencies, 50)),
+                          p99_ms=1000 * float(np.percentile(latencies, 99)), mean_batch=float(np.mean(sizes)))
+        return report
+
+    def reset_stats(self):
+        with self.lock:
+            self.latencies.clear()
+            self.batch_sizes.clear()
+            self.n_requests, self.start = 0, time.perf_counter()
+
+    def close(self):
+        self.requests.put(None)
+        self.worker.join()
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    # keep-alive connections, every reply having a Content-Length
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        if self.path != "/predict":
+            return self.reply(404, {"error": f"unknown path {self.path}"})
+        batcher = self.server.batcher
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            if self.headers.get("Content-Type") == "application/octet-stream":
+                x = np.frombuffer(body, dtype=np.float32)
+            else:
+                x = np.asarray(json.loads(body)["x"], dtype=np.float64)
+            if x.shape != (batcher.d,):
+                raise ValueError(f"expected {batcher.d} features, got shape {x.shape}")
+        except (ValueError, KeyError, TypeError) as e:
+            return self.reply(400, {"error": str(e)})
+        p = batcher.predict(x)
+        self.reply(200, {"probabilities": p.tolist(), "class": int(np.argmax(p))})
+
+    def do_GET(self):
+        if self.path == "/stats":
+            return self.reply(200, self.server.batcher.stats())
+        self.reply(404, {"error": f"unknown path {self.path}"})
+
+    def do_DELETE(self):
+        if self.path == "/stats":
+            self.server.batcher.reset_stats()
+            return self.reply(200, {})
+        self.reply(404, {"error": f"unknown path {self.path}"})
+
+    def reply(self, status, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PredictionServer(ThreadingHTTPServer):
+    # listen backlog, the default of 5 resets the connections of concurrent clients
+    request_queue_size = 128
+
+
+def make_server(model, host="127.0.0.1", port=8000, **batcher_args):
+    """ HTTP server answering with a MicroBatcher of model, see MicroBatcher for batcher_args """
+    server = PredictionServer((host, port), PredictionHandler)
+    server.batcher = MicroBatcher(model, **batcher_args)
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro batching prediction server of a saved MLP")
+    parser.add_argument("checkpoint", help="checkpoint directory saved by MLP.backup or backup_cyclic")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch", type=int, default=64)
+    parser.add_argument("--max_delay", type=float, default=0.002, help="seconds")
+    parser.add_argument("--standardizer", help="statistics saved by Standardizer.save")
+    args = parser.parse_args()
+
+    model = MLP.from_checkpoint(args.checkpoint)
+    standardizer = Standardizer.load(args.standardizer) if args.standardizer else None
+    server = make_server(model, args.host, args.port, max_batch=args.max_batch, max_delay=args.max_delay,
+                         standardizer=standardizer)
+    print(f"Serving {args.checkpoint} on http://{args.host}:{server.server_port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
+        print(json.dumps(server.batcher.stats()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,37 @@
 from six.moves import cPickle
-from keras.utils.np_utils import to_categorical
-import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
 import numpy as np
 
+def labels(Y):
+    """ Integer labels from either integer labels or one hot encoded labels (K, n) """
+    return Y if Y.ndim == 1 else np.argmax(Y, axis=0)
+
+
+def cross_entropy(S, y):
+    """ Fused log-softmax cross entropy of the scores S (K, n) against the integer labels y:
+    log-sum-exp over the shifted scores minus the score of the label, no one hot matrix involved.
+    Returns the per-sample losses and the softmax probabilities """
+    S = S - np.max(S, axis=0)
+    P = np.exp(S)
+    Z = np.sum(P, axis=0)
+    losses = np.log(Z) - S[y, np.arange(S.shape[1])]
+    P /= Z
+    return losses, P
+
+
+def cross_entropy_grad(P, y):
+    """ Gradient of the cross entropy w.r.t. the scores, P - Y, computed in place in P """
+    P[y, np.arange(P.shape[1])] -= 1
+    return P
+
+
+def one_hot(y, num_classes=10):
+    """ One hot encodes integer labels as a (n, num_classes) float32 matrix """
+    return np.eye(num_classes, dtype=np.float32)[y]
+
+
 def loadData(filename, reshape=False, clipping=False):
     """ Loads data and creates one hot encoded labels """
 
@@ -23,14 +52,156 @@ def loadData(filename, reshape=False, clipping=False):
 
     y = np.array(y)
     # One hot Encoded labels
-    Y = to_categorical(y, num_classes=10)
+    Y = one_hot(y, num_classes=10)
+    Y = Y.T
+
+    return X, y, Y
+
+
+CACHE_VERSION = 1
+CACHE_DIR = '../Dataset/cifar-10-cache/'
+BATCHES = ['data_batch_1', 'data_batch_2', 'data_batch_3',
+           'data_batch_4', 'data_batch_5', 'test_batch']
+
+
+def cache_batch(filename, cache_dir=CACHE_DIR, stats=True):
+    """ Converts a cifar batch into a versioned, memory-mappable cache entry:
+    feature-major float32 X (d, n), int labels and optionally the per-feature mean/std """
+    X, y, _ = loadData(filename, clipping=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    prefix = cache_dir + filename
+    # an existing entry is invalidated before its arrays are overwritten
+    if os.path.exists(prefix + '_meta.json'):
+        os.remove(prefix + '_meta.json')
+
+    X_map = np.lib.format.open_memmap(
+        prefix + '_X.npy', mode='w+', dtype=np.float32, shape=X.shape)
+    X_map[:] = X
+    X_map.flush()
+    del X_map
+    np.save(prefix + '_y.npy', y.astype(np.int64))
+
+    if stats:
+        np.save(prefix + '_mean.npy', np.mean(X, axis=1))
+        np.save(prefix + '_std.npy', np.std(X, axis=1))
+
+    # the meta file is written last so that an interrupted conversion is never picked up
+    meta = {"version": CACHE_VERSION, "shape": list(X.shape),
+            "dtype": "float32", "stats": stats}
+    with open(prefix + '_meta.json', 'w') as f:
+        json.dump(meta, f)
+
+
+def cache_dataset(filenames=BATCHES, cache_dir=CACHE_DIR, stats=True):
+    """ One-time conversion of the cifar batches into the on-disk cache """
+    for filename in filenames:
+        cache_batch(filename, cache_dir, stats)
+
+
+def is_cached(filename, cache_dir=CACHE_DIR):
+    """ Checks that a valid cache entry of the current version exists """
+    try:
+        with open(cache_dir + filename + '_meta.json') as f:
+            return json.load(f)["version"] == CACHE_VERSION
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def loadCachedData(filename, cache_dir=CACHE_DIR, mmap_mode='r'):
+    """ Drop-in replacement of loadData(filename, clipping=True) backed by the memory-mapped cache.
+    X is shared through the page cache between processes, use mmap_mode='c' to modify it locally """
+    if not is_cached(filename, cache_dir):
+        cache_batch(filename, cache_dir)
+
+    X = np.load(cache_dir + filename + '_X.npy', mmap_mode=mmap_mode)
+    y = np.load(cache_dir + filename + '_y.npy')
+    # One hot Encoded labels
+    Y = one_hot(y, num_classes=10)
     Y = Y.T
 
     return X, y, Y
 
 
+def loadCachedStats(filename, cache_dir=CACHE_DIR):
+    """ Loads the precomputed per-feature mean and std of a cached batch """
+    if not is_cached(filename, cache_dir) or not os.path.exists(cache_dir + filename + '_mean.npy'):
+        cache_batch(filename, cache_dir)
+    return np.load(cache_dir + filename + '_mean.npy'), np.load(cache_dir + filename + '_std.npy')
+
+
+class BatchLoader():
+    """ Iterates over shuffled minibatches of (X, Y, y) without copying the dataset (Y may be None).
+    A single permutation is drawn per epoch and every batch is gathered into preallocated
+    contiguous buffers, the next batch being prepared on a background thread """
+
+    def __init__(self, X, Y, y, batch_size, prefetch=True):
+        self.X, self.Y, self.y = X, Y, y
+        self.batch_size = batch_size
+        self.n = X.shape[1]
+        self.n_batches = self.n // batch_size
+        self.prefetch = prefetch
+        # one set of buffers is consumed while the other one is being filled,
+        # they follow the memory layout of the source so that columns are copied as contiguous runs
+        self.buffers = [(np.empty((X.shape[0], batch_size), dtype=X.dtype, order=self.layout(X)),
+                         None if Y is None else np.empty(
+                             (Y.shape[0], batch_size), dtype=Y.dtype, order=self.layout(Y)),
+                         np.empty(batch_size, dtype=y.dtype)) for _ in range(2)]
+        self.executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+    def __len__(self):
+        return self.n_batches
+
+    @staticmethod
+    def layout(A):
+        return 'F' if A.strides[0] < A.strides[1] else 'C'
+
+    @staticmethod
+    def take_columns(A, idx, out):
+        # mode='clip' avoids the buffered copy np.take makes with out= (indices are always valid)
+        if out.flags['F_CONTIGUOUS']:
+            np.take(A.T, idx, axis=0, out=out.T, mode='clip')
+        else:
+            np.take(A, idx, axis=1, out=out, mode='clip')
+
+    def gather(self, idx, buffers):
+        X_batch, Y_batch, y_batch = buffers
+        self.take_columns(self.X, idx, X_batch)
+        if Y_batch is not None:
+            self.take_columns(self.Y, idx, Y_batch)
+        np.take(self.y, idx, out=y_batch, mode='clip')
+        return buffers
+
+    def epoch(self, seed, start=0):
+        """ Yields the (X_batch, Y_batch, y_batch) of one epoch shuffled with RandomState(seed), from the
+        start-th batch on. The yielded arrays are reused: they are only valid until the next batch is requested """
+        perm = np.random.RandomState(seed).permutation(self.n)
+        batches = [perm[j*self.batch_size:(j+1)*self.batch_size]
+                   for j in range(start, self.n_batches)]
+
+        if not batches:
+            return
+
+        if not self.prefetch:
+            for k, idx in enumerate(batches):
+                yield self.gather(idx, self.buffers[k % 2])
+            return
+
+        future = self.executor.submit(self.gather, batches[0], self.buffers[0])
+        for k in range(len(batches)):
+            batch = future.result()
+            if k + 1 < len(batches):
+                future = self.executor.submit(
+                    self.gather, batches[k+1], self.buffers[(k+1) % 2])
+            yield batch
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
 def plotCifar(X, Y):
     """ Util function to plot cifar original images along with their labels """
+    import matplotlib.pyplot as plt
     fig, axes1 = plt.subplots(5, 5, figsize=(12, 12))
     print(X.shape)
     for j in range(5):
@@ -42,19 +213,93 @@ def plotCifar(X, Y):
 
 
 def batch_normalize(X, mean, std):
-    Xc = np.copy(X)
-    Xc -= np.outer(mean, np.ones(X.shape[1]))
-    Xc /= np.outer(std, np.ones(X.shape[1]))
+    Xc = X - mean[:, np.newaxis]
+    Xc /= std[:, np.newaxis]
     return Xc
 
 
-def preprocess_data(X_train, y_train, Y_train, X_val, y_val, Y_val, X_test, y_test, Y_test):
-    mean_X = np.mean(X_train, axis=1)
-    std_X = np.std(X_train, axis=1)
+class Standardizer():
+    """ Per-feature standardization whose statistics are computed in a single streaming pass:
+    the mean and sum of squared deviations of every chunk are merged into the running ones
+    (Chan et al.), so memory-mapped or batch-wise data never has to be loaded at once """
+
+    def __init__(self, chunk_size=2048):
+        self.chunk_size = chunk_size
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.n)
+
+    def merge(self, n, mean, m2):
+        """ Merges the statistics of n samples into the running ones """
+        if self.n == 0:
+            self.n, self.mean, self.m2 = n, mean.astype(np.float64), m2.astype(np.float64)
+            return
+        delta = mean - self.mean
+        total = self.n + n
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.n * n / total
+        self.n = total
+
+    def partial_fit(self, X):
+        """ Updates the statistics with the columns of X (d, n) """
+        for j in range(0, X.shape[1], self.chunk_size):
+            chunk = np.asarray(X[:, j:j+self.chunk_size], dtype=np.float64)
+            mean = np.mean(chunk, axis=1)
+            chunk -= mean[:, np.newaxis]
+            self.merge(chunk.shape[1], mean, np.einsum('ij,ij->i', chunk, chunk))
+        return self
+
+    def fit(self, X):
+        self.n = 0
+        return self.partial_fit(X)
+
+    def fit_cached(self, filenames, cache_dir=CACHE_DIR):
+        """ Fits on cached cifar batches from their precomputed statistics, without reading X """
+        self.n = 0
+        for filename in filenames:
+            mean, std = loadCachedStats(filename, cache_dir)
+            X_shape = np.load(cache_dir + filename + '_X.npy', mmap_mode='r').shape
+            self.merge(X_shape[1], mean, std.astype(np.float64) ** 2 * X_shape[1])
+        return self
+
+    def transform(self, X, inplace=False):
+        """ Standardizes X chunk by chunk, in place if asked, keeping the dtype of X """
+        out = X if inplace else np.empty(X.shape, dtype=X.dtype, order=BatchLoader.layout(X))
+        mean = self.mean.astype(X.dtype)[:, np.newaxis]
+        std = self.std.astype(X.dtype)[:, np.newaxis]
+        for j in range(0, X.shape[1], self.chunk_size):
+            np.subtract(X[:, j:j+self.chunk_size], mean, out=out[:, j:j+self.chunk_size])
+            out[:, j:j+self.chunk_size] /= std
+        return out
+
+    def save(self, filename):
+        # through a file object, np.savez would append .npz to the name load is given
+        with open(filename, "wb") as f:
+            np.savez(f, n=self.n, mean=self.mean, m2=self.m2)
+
+    @staticmethod
+    def load(filename):
+        stats = np.load(filename)
+        standardizer = Standardizer()
+        standardizer.merge(int(stats["n"]), stats["mean"], stats["m2"])
+        return standardizer
+
+
+def preprocess_data(X_train, y_train, Y_train, X_val, y_val, Y_val, X_test, y_test, Y_test, standardizer=None, inplace=False):
+    """ Standardizes the three sets with the statistics of the training set, or with those of
+    a given (fitted) standardizer. inplace=True overwrites the input matrices """
+    if standardizer is None:
+        standardizer = Standardizer()
+    if standardizer.n == 0:
+        standardizer.fit(X_train)
 
-    X_train = batch_normalize(X_train, mean_X, std_X)
-    X_val = batch_normalize(X_val, mean_X, std_X)
-    X_test = batch_normalize(X_test, mean_X, std_X).copy()
+    X_train = standardizer.transform(X_train, inplace)
+    X_val = standardizer.transform(X_val, inplace)
+    X_test = standardizer.transform(X_test, inplace)
     data = {"X_train": X_train, "y_train": y_train, "Y_train": Y_train,
             "X_val": X_val, "y_val": y_val, "Y_val": Y_val, 
             "X_test": X_test, "y_test": y_test, "Y_test": Y_test}
@@ -0,0 +1,61 @@
+""" Pickle-free checkpoints: a directory holding one .npy file per parameter array and a meta.json with
+the architecture and the training state. The arrays can be memory mapped when loaded. Run as a script
+to convert the pickled parameter dicts saved by older versions of RNN.train_rnn:
+
+    python checkpoint.py History/params_*.npy
+"""
+import json
+import os
+import sys
+
+import numpy as np
+
+META = "meta.json"
+
+
+def to_json(value):
+    """ Python numbers and lists from numpy ones, for json.dump """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def save_checkpoint(path, arrays, meta=None):
+    """ Saves the named arrays, one .npy file each, and the meta data in the directory path """
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), np.asarray(array), allow_pickle=False)
+    with open(os.path.join(path, META), "w") as f:
+        json.dump({**(meta or {}), "arrays": list(arrays)}, f, default=to_json)
+
+
+def load_checkpoint(path, mmap_mode=None):
+    """ Named arrays and meta data of a checkpoint, the arrays being memory mapped with mmap_mode
+    ("r" read only, "c" copy on write) if given """
+    with open(os.path.join(path, META)) as f:
+        meta = json.load(f)
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode, allow_pickle=False)
+              for name in meta["arrays"]}
+    return arrays, meta
+
+
+def is_checkpoint(path):
+    return os.path.isfile(os.path.join(path, META))
+
+
+def convert_history(filename):
+    """ Converts a pickled dict of arrays to a checkpoint directory, returning its path """
+    params = np.load(filename, allow_pickle=True).item()
+    path = filename[:-len(".npy")]
+    meta = {"converted_from": filename}
+    if "U" in params:
+        meta.update(m=params["U"].shape[0], K=params["U"].shape[1])
+    save_checkpoint(path, params, meta)
+    return path
+
+
+if __name__ == "__main__":
+    for filename in sys.argv[1:]:
+        print(f"{filename} -> {convert_history(filename)}")
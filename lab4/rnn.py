@@ -4,6 +4,7 @@ import matplotlib.pyplot as plt
 import random
 from collections import OrderedDict
 from tqdm import tqdm
+from checkpoint import is_checkpoint, load_checkpoint, save_checkpoint
 
 
 def softmax(x):
@@ -266,15 +267,27 @@ class RNN():
             plt.plot(history_loss)
             plt.show()
 
-        np.save(f"History/params_{s}_{prev_loss}.npy", rnn_params)
+        save_checkpoint(f"History/params_{s}_{prev_loss}", rnn_params,
+                        {"m": self.m, "K": self.K, "seq_length": self.seq_length, "seed": self.seed,
+                         "step": s, "smooth_loss": prev_loss})
         return syn_text
 
     @staticmethod
-    def load_rnn(filename):
-        params = np.load(filename, allow_pickle=True).item()
-        rnn = RNN()
-        rnn_params = {"W": rnn.W, "V": rnn.V,
-                       "U": rnn.U, "b": rnn.b, "c": rnn.c}
-        for p in params:
-            rnn_params[p] = params[p].copy()
+    def load_rnn(filename, mmap_mode=None):
+        """ RNN with the parameters saved by train_rnn, from a checkpoint directory, the arrays being
+        memory mapped with mmap_mode, or from the pickled .npy file of older versions. The hidden size,
+        sequence length and seed are those of the checkpoint, the vocabulary must match its K """
+        if is_checkpoint(filename):
+            params, meta = load_checkpoint(filename, mmap_mode)
+        else:
+            params, meta = np.load(filename, allow_pickle=True).item(), {}
+        # older files have no meta data, the sizes are read from the arrays
+        m = meta.get("m", params["W"].shape[0] if "W" in params else 100)
+        rnn = RNN(m=m, seq_length=meta.get("seq_length", 25), seed=meta.get("seed", 42))
+        K = meta.get("K", params["U"].shape[1] if "U" in params else rnn.K)
+        if K != rnn.K:
+            raise ValueError(f"{filename} was trained on {K} characters, the book has {rnn.K}")
+        for p in ["W", "V", "U", "b", "c"]:
+            if p in params:
+                setattr(rnn, p, params[p])
         return rnn